@@ -0,0 +1,229 @@
+'''Benchmark suite for timetable parsing, graph precalculation and query phases,
+	running these on bundled Shizuoka GTFS data and on synthetic networks of increasing size.
+	Run as "python -m bench --help" from the project dir.'''
+
+import itertools as it, operator as op, functools as ft
+from collections import OrderedDict
+from pathlib import Path
+import os, sys, math, time, json, random, resource, tempfile, shutil, platform, multiprocessing
+
+import tb_routing as tb
+
+
+@tb.u.attr_struct(vals_to_attrs=True)
+class BenchConf:
+	seed = 'bench'
+	synth_sizes = 100, 200, 400, 800 # stop counts, with line count being 1/10 of that
+	synth_conf = dict(line_stops=(5, 20), line_trip_max_count=30)
+	query_count = 30
+	query_hours = 6, 20 # to pick random departure times from
+	profile_window = 2 * 3600
+	tp_max_stops = 100 # all-to-all TP tree precalculation is skipped for bigger networks
+	threshold = 0.2 # relative difference from baseline to report as regression
+
+
+# Name -> (unit, timer_func name), where latter is for phases ran as part of other ones
+phases = OrderedDict([
+	('parse', ('trips', None)),
+	('lines', ('trips', 'timetable_lines')),
+	('transfer-set', ('trips', 'precalc_transfer_set')),
+	('query-ea', ('queries', None)),
+	('query-profile', ('queries', None)),
+	('tp-tree', ('stops', None)),
+	('tp-query', ('queries', None)) ])
+
+def rss_peak_mb():
+	'Returns peak RSS of this process in MiB (ru_maxrss is in KiB on linux, bytes on macos).'
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+class PhaseTimer:
+	'''Records wall time, peak RSS and throughput for each benchmark phase,
+		either ran via run() method or as a call passed through this object as engine timer_func.'''
+
+	def __init__(self):
+		self.results, self.timer_phases = OrderedDict(), dict(
+			(timer_name, name) for name, (unit, timer_name) in phases.items() if timer_name )
+
+	def add(self, name, td, count):
+		self.results[name] = OrderedDict([ ('time', td), ('count', count),
+			('unit', phases[name][0]), ('rate', count / td if td > 0 else None),
+			('rss_peak_mb', round(rss_peak_mb(), 1)) ])
+
+	def __call__(self, func, *args, timer_name=None, **kws):
+		name = (timer_name or tb.trace.timer_name_for_func(func)).rsplit('.', 1)[-1]
+		name = self.timer_phases.get(name)
+		if not name: return func(*args, **kws)
+		ts0 = time.monotonic()
+		data = func(*args, **kws)
+		self.add(name, time.monotonic() - ts0, len(args[1].trips)) # args = self, timetable, ...
+		return data
+
+	def run(self, name, func, count=len):
+		'''Run func for phase, with count being number of units it processes,
+			or a function to get that number from its result.'''
+		ts0 = time.monotonic()
+		data = func()
+		self.add(name, time.monotonic() - ts0, count(data) if callable(count) else count)
+		return data
+
+
+def query_args(conf, timetable, seed):
+	'Returns list of (stop_src, stop_dst, dts_src) tuples for random queries, same for same seed.'
+	rng, stops = random.Random(seed), sorted(timetable.stops, key=op.attrgetter('id'))
+	queries = list()
+	for n in range(conf.query_count):
+		stop_src, stop_dst = rng.sample(stops, 2)
+		dts_src = timetable.dts_parse('{:02d}:{:02d}'.format(
+			rng.randint(*conf.query_hours), rng.randrange(0, 60, 5) ))
+		queries.append((stop_src, stop_dst, dts_src))
+	return queries
+
+def run_case(conf, name, gtfs_path):
+	'''Runs all phases for GTFS data at gtfs_path, returning (size, phase_results) tuple.
+		Should be ran in a separate process, for RSS peak values to be meaningful.'''
+	bench = PhaseTimer()
+	timetable = bench.run( 'parse', lambda: tb.gtfs.parse_timetable(
+		gtfs_path, tb.gtfs.GTFSConf()), lambda tt: len(tt.trips) )
+	router = tb.engine.TBRoutingEngine(timetable, timer_func=bench)
+	queries = query_args(conf, timetable, '{}.{}'.format(conf.seed, name))
+
+	bench.run( 'query-ea', lambda: list(
+		router.query_earliest_arrival(*q) for q in queries ) )
+	bench.run( 'query-profile', lambda: list(
+		router.query_profile(src, dst, dts, dts + conf.profile_window) for src, dst, dts in queries ) )
+	if len(timetable.stops) <= conf.tp_max_stops:
+		tp_tree = bench.run('tp-tree', router.build_tp_tree, len(timetable.stops))
+		tp_router = router.build_tp_engine(tp_tree)
+		bench.run( 'tp-query', lambda: list(
+			tp_router.query_profile(src, dst, dts, dts + conf.profile_window) for src, dst, dts in queries ) )
+
+	size = OrderedDict([ ('stops', len(timetable.stops)),
+		('trips', len(timetable.trips)), ('transfers', len(router.graph.transfers)) ])
+	return size, bench.results
+
+def run_case_process(conf, name, gtfs_path):
+	'Same as run_case(), but in a forked subprocess.'
+	with multiprocessing.get_context('fork').Pool(1) as pool:
+		return pool.apply(run_case, (conf, name, gtfs_path))
+
+
+def iter_cases(conf, names):
+	'Yields (name, gtfs_path) for all benchmark cases, generating synthetic GTFS data as needed.'
+	if 'shizuoka' in names:
+		from test import _common as c
+		path_test = Path(c.__file__).parent
+		fx = c.GTFSTestFixture(
+			path_test / 'gtfs_shizuoka.data.2016-10-13.zip', path_test / 'gtfs_shizuoka.py' )
+		yield 'shizuoka', fx.path_unzip
+	if 'synth' in names:
+		for n in conf.synth_sizes:
+			synth_conf = tb.synth.SynthConf()
+			synth_conf.stop_count, synth_conf.line_count = n, max(1, n // 10)
+			for k, v in conf.synth_conf.items(): setattr(synth_conf, k, v)
+			path = Path(tempfile.mkdtemp(prefix='tb-bench.'))
+			try:
+				tb.synth.write_gtfs(tb.synth.generate_timetable(synth_conf, conf.seed), path)
+				yield 'synth-{}'.format(n), path
+			finally: shutil.rmtree(str(path))
+
+def scaling_curves(cases):
+	'''Returns {phase: {trips: [...], time: [...], exponent: k}} for synth-* cases,
+		where k is a log-log slope of time vs trip count between smallest and largest network.'''
+	curves = OrderedDict()
+	for name, case in sorted( ((k, v) for k, v in cases.items()
+			if k.startswith('synth-')), key=lambda kv: kv[1]['size']['trips'] ):
+		for phase, res in case['phases'].items():
+			curve = curves.setdefault(phase, OrderedDict([('trips', list()), ('time', list())]))
+			curve['trips'].append(case['size']['trips'])
+			curve['time'].append(res['time'])
+	for curve in curves.values():
+		(n1, n2), (t1, t2) = ((curve[k][0], curve[k][-1]) for k in ['trips', 'time'])
+		curve['exponent'] = round(math.log(t2 / t1) / math.log(n2 / n1), 2)\
+			if len(curve['trips']) > 1 and n1 != n2 and t1 > 0 and t2 > 0 else None
+	return curves
+
+def compare(results, baseline, threshold):
+	'''Returns list of regressions for results vs baseline (both as produced by run()),
+		with each one being a dict of case, phase, metric, value, baseline and ratio.
+		Time is compared per-unit (e.g. per query), as these counts can differ between runs.'''
+	regressions = list()
+	for name, case in results['cases'].items():
+		case_base = baseline.get('cases', dict()).get(name)
+		if not case_base: continue
+		for phase, res in case['phases'].items():
+			res_base = case_base['phases'].get(phase)
+			if not res_base: continue
+			for metric, val, val_base in [
+					('time_per_unit', res['time'] / max(1, res['count']),
+						res_base['time'] / max(1, res_base['count'])),
+					('rss_peak_mb', res['rss_peak_mb'], res_base['rss_peak_mb']) ]:
+				if not val_base or val / val_base <= 1 + threshold: continue
+				regressions.append(OrderedDict([ ('case', name), ('phase', phase),
+					('metric', metric), ('value', val), ('baseline', val_base), ('ratio', val / val_base) ]))
+	return regressions
+
+def run(conf, names, log=tb.u.get_logger('tb.bench')):
+	cases = OrderedDict()
+	for name, gtfs_path in iter_cases(conf, names):
+		log.info('Running benchmark case: {}', name)
+		size, case_phases = run_case_process(conf, name, gtfs_path)
+		cases[name] = OrderedDict([('size', size), ('phases', case_phases)])
+		for phase, res in case_phases.items():
+			log.info( '  {}: {:.3f}s, {:,.1f} {}/s, rss-peak={:,.1f} MiB',
+				phase, res['time'], res['rate'] or 0, res['unit'], res['rss_peak_mb'] )
+	meta = OrderedDict([ ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+		('python', platform.python_version()), ('platform', platform.platform()),
+		('seed', conf.seed), ('query_count', conf.query_count) ])
+	return OrderedDict([('meta', meta), ('cases', cases), ('scaling', scaling_curves(cases))])
+
+
+def main(args=None, conf=None):
+	if not conf: conf = BenchConf()
+
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Run benchmarks for parsing, precalculation and query phases'
+			' on bundled GTFS data and synthetic networks, reporting results as JSON.')
+	parser.add_argument('cases', nargs='*', choices=['shizuoka', 'synth'], metavar='case',
+		help='Benchmark cases to run - "shizuoka" and/or "synth". Default is to run both.')
+	parser.add_argument('-o', '--output', metavar='path',
+		help='JSON file to store results to. Printed to stdout by default.')
+	parser.add_argument('-b', '--baseline', metavar='path',
+		help='JSON results of previous run to compare these to,'
+			' exiting with non-zero code if any regressions are detected.')
+	parser.add_argument('-t', '--threshold', type=float, metavar='float', default=conf.threshold,
+		help='Relative difference from baseline to report as regression. Default: %(default)s')
+	parser.add_argument('-s', '--sizes', metavar='n1,n2,...',
+		default=','.join(map(str, conf.synth_sizes)),
+		help='Stop counts for generated synthetic networks. Default: %(default)s')
+	parser.add_argument('-q', '--queries', type=int, metavar='n', default=conf.query_count,
+		help='Number of random queries to run for each query type. Default: %(default)s')
+	parser.add_argument('--tp-max-stops', type=int, metavar='n', default=conf.tp_max_stops,
+		help='Skip transfer-patterns phases for networks with'
+			' more stops than that, as these are very slow. Default: %(default)s')
+	parser.add_argument('--seed', default=conf.seed,
+		help='Seed for synthetic networks and random queries. Default: %(default)s')
+	parser.add_argument('-d', '--debug', action='store_true', help='Verbose operation mode.')
+	opts = parser.parse_args(sys.argv[1:] if args is None else args)
+
+	import logging
+	logging.basicConfig(level=logging.DEBUG if opts.debug else logging.INFO)
+
+	conf.synth_sizes = list(map(int, opts.sizes.split(',')))
+	conf.query_count, conf.tp_max_stops, conf.seed = opts.queries, opts.tp_max_stops, opts.seed
+	results = run(conf, opts.cases or ['shizuoka', 'synth'])
+
+	regressions = None
+	if opts.baseline:
+		with open(opts.baseline) as src: baseline = json.load(src)
+		regressions = results['regressions'] = compare(results, baseline, opts.threshold)
+		for reg in regressions:
+			print( 'REGRESSION: {case} {phase} {metric}: {value:.6g}'
+				' vs {baseline:.6g} baseline (x{ratio:.2f})'.format(**reg), file=sys.stderr )
+
+	if opts.output:
+		with tb.u.safe_replacement(opts.output) as dst: json.dump(results, dst, indent=2)
+	else: json.dump(results, sys.stdout, indent=2)
+	if regressions: return 1
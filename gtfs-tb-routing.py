@@ -67,6 +67,21 @@ def main(args=None):
 	group.add_argument('--engine-conf', metavar='yaml-data',
 		help='Override values for EngineConf as a YAML mapping.'
 			' Example: {log_progress_steps: 1000}')
+	group.add_argument('--trace', metavar='path',
+		help='Record timing spans for timetable parsing, pre-calculation'
+			' and queries, and write these to specified file on exit.')
+	group.add_argument('--trace-format', metavar='format',
+		choices=['chrome', 'json'], default='chrome',
+		help='Format for --trace file - either Chrome trace-event JSON'
+			' (for chrome://tracing or perfetto), or JSON with aggregated'
+			' per-span stats and all recorded spans. Default: %(default)s')
+	group.add_argument('--profile-dir', metavar='path',
+		help='Store cProfile stats (.pstats files) for each major calculation phase'
+			' (timetable parsing, lines, transfer set, transfer-patterns tree, queries)'
+			' in specified directory, to compare CPU usage between runs/feeds.')
+	group.add_argument('--trace-malloc', metavar='n', type=int, nargs='?', const=30,
+		help='Also store top-n (default: %(const)s, if value is omitted) memory allocation'
+			' sites for each phase (.malloc.txt files) in --profile-dir, using tracemalloc module.')
 	group.add_argument('--debug', action='store_true', help='Verbose operation mode.')
 
 	cmds = parser.add_subparsers(title='Commands', dest='call')
@@ -76,21 +91,45 @@ def main(args=None):
 		help='Generate/store all the caches and exit.')
 
 
+	cmd = cmds.add_parser('stats',
+		help='Print counts of timetable/graph elements and optionally memory usage breakdown.')
+	cmd.add_argument('-m', '--memory', action='store_true',
+		help='Walk all timetable/graph structures and print object counts and deep sizes'
+			' for each one, as well as average size per element (e.g. per stop event or transfer).'
+			' Can take a while for large graphs.')
+	cmd.add_argument('--tree-cache', metavar='path',
+		help='Also include Transfer-Patterns tree from'
+			' specified pickle file (see query-transfer-patterns command).')
+
+
 	cmd = cmds.add_parser('query-earliest-arrival',
 		help='Run earliest arrival query, output resulting journey set.')
-	cmd.add_argument('stop_from', help='Stop ID to query journey from. Example: J22209723_0')
-	cmd.add_argument('stop_to', help='Stop ID to query journey to. Example: J2220952426_0')
+	cmd.add_argument('stop_from',
+		help='Stop ID or "lat,lon" point to query journey from. Example: J22209723_0')
+	cmd.add_argument('stop_to',
+		help='Stop ID or "lat,lon" point to query journey to. Example: J2220952426_0')
 	cmd.add_argument('day_time', nargs='?', default='00:00',
 		help='Day time to start journey at, either as HH:MM,'
 			' HH:MM:SS or just seconds int/float. Default: %(default)s')
 
 
+	cmd = cmds.add_parser('query-latest-departure',
+		help='Run latest departure ("arrive by") query, output resulting journey set.')
+	cmd.add_argument('stop_from', help='Stop ID to query journey from. Example: J22209723_0')
+	cmd.add_argument('stop_to', help='Stop ID to query journey to. Example: J2220952426_0')
+	cmd.add_argument('day_time', nargs='?', default='24:00',
+		help='Day time to arrive at stop_to by, either as HH:MM,'
+			' HH:MM:SS or just seconds int/float. Default: %(default)s')
+
+
 	cmd = cmds.add_parser('query-profile',
 		help='Run profile query, output resulting journey set.')
 
 	group = cmd.add_argument_group('Query parameters')
-	group.add_argument('stop_from', help='Stop ID to query journey from. Example: J22209723_0')
-	group.add_argument('stop_to', help='Stop ID to query journey to. Example: J2220952426_0')
+	group.add_argument('stop_from',
+		help='Stop ID or "lat,lon" point to query journey from. Example: J22209723_0')
+	group.add_argument('stop_to',
+		help='Stop ID or "lat,lon" point to query journey to. Example: J2220952426_0')
 	group.add_argument('day_time_earliest', nargs='?', default='00:00',
 		help='Earliest day time to start journey(s) at, either as HH:MM,'
 			' HH:MM:SS or just seconds int/float. Default: %(default)s')
@@ -103,6 +142,8 @@ def main(args=None):
 		type=int, metavar='n', default=15,
 		help='Max number of transfers (i.e. interchanges)'
 			' between journey trips allowed in the results. Default: %(default)s')
+	group.add_argument('-t', '--timeout', type=float, metavar='seconds',
+		help='Stop query after specified time, printing best journeys found until then.')
 
 
 	cmd = cmds.add_parser('query-transfer-patterns',
@@ -139,6 +180,93 @@ def main(args=None):
 			' stop_from/stop_to pair (in graphviz dot format) to a file and exit.')
 
 
+	cmd = cmds.add_parser('query-batch',
+		help='Run queries from CSV/JSONL file or stdin in forked processes,'
+			' streaming results as compact JSONL, one line per query.')
+	cmd.add_argument('queries', nargs='?', default='-',
+		help='CSV (with header) or JSONL file with queries, "-" for stdin (default).'
+			' Fields/keys are same as for "serve" queries and bench-queries workloads -'
+			' type (ea, ld, profile), src, dst, dts, dts_end, max_transfers, timeout,'
+			' plus optional "id", which is copied to results (1-based query number otherwise).')
+	cmd.add_argument('-f', '--format', choices=['csv', 'jsonl'],
+		help='Input format. Default is to detect it by the first character of input.')
+	cmd.add_argument('-o', '--output', metavar='path',
+		help='JSONL file to write results to. Printed to stdout by default.')
+	cmd.add_argument('-w', '--workers', type=int, metavar='n',
+		help='Number of forked query processes, 0 - run queries in this process. Default: cpu count.')
+	cmd.add_argument('--unordered', action='store_true',
+		help='Write results in order of completion instead of input order.')
+	cmd.add_argument('--chunk-size', type=int, metavar='n', default=16,
+		help='Number of queries sent to worker processes at once. Default: %(default)s')
+	cmd.add_argument('-m', '--max-transfers', type=int, metavar='n', default=15,
+		help='Default max number of transfers for profile queries. Default: %(default)s')
+	cmd.add_argument('-t', '--query-timeout', type=float, metavar='seconds',
+		help='Default time limit for each query, returning partial results on expiry.')
+	cmd.add_argument('--no-pack', action='store_true',
+		help='Do not convert transfer set into compact array-based structure'
+			' and freeze gc before forking workers, same as for "serve" command.')
+
+
+	cmd = cmds.add_parser('serve',
+		help='Run long-running query server with graph loaded once,'
+			' answering queries over HTTP/JSON on tcp and/or unix socket.')
+	cmd.add_argument('--host', metavar='addr', default='127.0.0.1',
+		help='Address to listen on. Default: %(default)s')
+	cmd.add_argument('--port', type=int, metavar='n', default=8080,
+		help='TCP port to listen on, 0 to only use --unix socket. Default: %(default)s')
+	cmd.add_argument('--unix', metavar='path', help='Unix socket path to listen on.')
+	cmd.add_argument('-w', '--workers', type=int, metavar='n',
+		help='Number of forked query worker processes, sharing loaded graph.'
+			' 0 - run queries in threads of the main process. Default: cpu count.')
+	cmd.add_argument('-m', '--max-transfers', type=int, metavar='n', default=15,
+		help='Default max number of transfers for profile queries. Default: %(default)s')
+	cmd.add_argument('--no-pack', action='store_true',
+		help='Do not convert transfer set into compact array-based structure'
+			' and freeze gc before forking workers, which allows these to share its memory.')
+	cmd.add_argument('--result-cache', type=int, metavar='n', default=0,
+		help='Max number of query results to cache in each worker, 0 to disable (default).')
+	cmd.add_argument('--result-cache-bucket', type=int, metavar='seconds', default=15*60,
+		help='Profile query windows are extended to start on multiple of that'
+			' for caching, so that they can be reused for queries starting later. Default: %(default)s')
+	cmd.add_argument('-t', '--query-timeout', type=float, metavar='seconds',
+		help='Default time limit for each query, returning partial results on expiry.')
+
+
+	cmd = cmds.add_parser('bench-queries',
+		help='Replay query workload, reporting latency percentiles and throughput as JSON.')
+
+	group = cmd.add_argument_group('Workload')
+	group.add_argument('-w', '--workload', metavar='path',
+		help='CSV file with queries to replay, with "type,src,dst,dts,dts_end" header,'
+			' where type is one of "ea", "ld" (dts is arrival deadline) or "profile" (dts to dts_end),'
+			' src/dst are stop ids and dts/dts_end are day-time values (e.g. 08:15).'
+			' Random workload is generated for timetable (see --count) if not specified.')
+	group.add_argument('-n', '--count', type=int, metavar='n', default=200,
+		help='Number of queries to generate, if no --workload is specified. Default: %(default)s')
+	group.add_argument('--mix', metavar='type:weight,...', default='ea:6,profile:3,ld:1',
+		help='Relative frequencies of query types to generate. Default: %(default)s')
+	group.add_argument('--seed', help='Randomness seed (any string) for generated workload.')
+	group.add_argument('--save-workload', metavar='path',
+		help='Store generated workload as CSV file, to replay it via --workload later.')
+
+	group = cmd.add_argument_group('Replay')
+	group.add_argument('-j', '--concurrency', type=int, metavar='n', default=1,
+		help='Number of queries to run concurrently. Default: %(default)s')
+	group.add_argument('-p', '--processes', action='store_true',
+		help='Run concurrent queries in forked processes instead of threads,'
+			' to have these actually run in parallel, despite python GIL.')
+	group.add_argument('-m', '--max-transfers',
+		type=int, metavar='n', default=15,
+		help='Max number of transfers for profile queries. Default: %(default)s')
+	group.add_argument('--result-cache', type=int, metavar='n', default=0,
+		help='Run queries through engine.QueryResultCache of specified size.')
+	group.add_argument('-s', '--server', metavar='url',
+		help='Send queries to running query server (see "serve" command)'
+			' instead of running these in-process, e.g. http://localhost:8080 or unix:/path/to/socket.')
+	group.add_argument('-o', '--output', metavar='path',
+		help='JSON file to store report to. Printed to stdout by default.')
+
+
 	opts = parser.parse_args(sys.argv[1:] if args is None else args)
 
 	tb.u.logging.basicConfig(
@@ -170,13 +298,30 @@ def main(args=None):
 			if not hasattr(conf_engine, k):
 				parser.error('Unrecognized engine conf option: {!r} (value: {!r})'.format(k, v))
 			setattr(conf_engine, k, v)
+	if opts.trace_malloc and not opts.profile_dir:
+		parser.error('--trace-malloc option requires --profile-dir to store data in.')
+	if opts.profile_dir:
+		conf_engine.profile_dir, conf_engine.trace_malloc = opts.profile_dir, opts.trace_malloc
+
+	if opts.call in ['serve', 'query-batch'] and opts.workers != 0 and not opts.no_pack:
+		conf_engine.packed_transfers = True # to avoid creating full TransferSet objects at all
 
 	conf.parse_start_date, conf.parse_days, conf.parse_days_pre =\
 		day, opts.parse_days_after, opts.parse_days_before
 
+	tracer = None
+	if opts.trace:
+		import atexit
+		tracer = tb.trace.Tracer(log=tb.u.get_logger('tb.timer'))
+		def trace_dump():
+			with tb.u.safe_replacement(opts.trace) as dst:
+				if opts.trace_format == 'chrome': tracer.dump_chrome_trace(dst)
+				else: tracer.dump_json(dst)
+		atexit.register(trace_dump)
+
 	timetable, router = tb.init_gtfs_router(
 		tt_path, cache_path, tt_path_dump=opts.cache_timetable,
-		conf=conf, conf_engine=conf_engine, timer_func=tb.calc_timer )
+		conf=conf, conf_engine=conf_engine, timer_func=tracer or tb.calc_timer )
 
 	dot_opts = dict()
 	if opts.dot_opts:
@@ -187,18 +332,58 @@ def main(args=None):
 			tb.vis.dot_for_lines(router.graph.lines, dst, dot_opts=dot_opts)
 		return
 
+	def query_stops(stop_from, stop_to):
+		'''Returns (a, b, multi) tuple, where multi=True means that a/b
+			are lists of (stop, dt) tuples (for lat,lon points), and stops otherwise.'''
+		stops = list()
+		for v in stop_from, stop_to:
+			m = re.search(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$', v)
+			if not m: stops.append(timetable.stops[v])
+			else:
+				lat, lon = map(float, m.groups())
+				stops.append(router.stops_near(lon, lat))
+				if not stops[-1]: parser.error('No stops found near lat,lon point: {}'.format(v))
+		if all(isinstance(v, tb.t.public.Stop) for v in stops): return stops + [False]
+		return list((v if isinstance(v, list) else [(v, 0)]) for v in stops) + [True]
+
 	if opts.call == 'cache': pass
 
+	elif opts.call == 'stats':
+		timetable, lines, transfers = router.graph
+		tp_tree = tb.u.pickle_load(opts.tree_cache, fail=True) if opts.tree_cache else None
+		print('Timetable:')
+		print('  stops: {:,}'.format(len(timetable.stops)))
+		print('  trips: {:,} (stop events: {:,})'.format(
+			len(timetable.trips), sum(map(len, timetable.trips)) ))
+		print('  footpaths: {:,} (same-stop: {:,})'.format(
+			len(timetable.footpaths), timetable.footpaths.stat_same_stop_count() ))
+		print('Graph:')
+		print('  lines: {:,}'.format(len(lines)))
+		print('  transfers: {:,}'.format(len(transfers)))
+		if tp_tree: print('  transfer-patterns tree nodes: {:,}'.format(tp_tree.stat_counts().nodes))
+		if opts.memory:
+			print('Memory usage:')
+			tb.memory.memory_stats_print(tb.memory.memory_stats(timetable, router.graph, tp_tree))
+
 	elif opts.call == 'query-earliest-arrival':
 		dts_start = timetable.dts_parse(opts.day_time)
+		a, b, multi = query_stops(opts.stop_from, opts.stop_to)
+		query = router.query_earliest_arrival if not multi else router.query_earliest_arrival_multi
+		journeys = query(a, b, dts_start)
+		journeys.pretty_print(timetable.dts_format)
+
+	elif opts.call == 'query-latest-departure':
+		dts_arr_max = timetable.dts_parse(opts.day_time)
 		a, b = timetable.stops[opts.stop_from], timetable.stops[opts.stop_to]
-		journeys = router.query_earliest_arrival(a, b, dts_start)
+		journeys = router.query_latest_departure(a, b, dts_arr_max)
 		journeys.pretty_print(timetable.dts_format)
 
 	elif opts.call == 'query-profile':
 		dts_edt, dts_ldt = map(timetable.dts_parse, [opts.day_time_earliest, opts.day_time_latest])
-		a, b = timetable.stops[opts.stop_from], timetable.stops[opts.stop_to]
-		journeys = router.query_profile(a, b, dts_edt, dts_ldt, max_transfers=opts.max_transfers)
+		a, b, multi = query_stops(opts.stop_from, opts.stop_to)
+		query = router.query_profile if not multi else router.query_profile_multi
+		budget = tb.engine.QueryBudget(opts.timeout) if opts.timeout is not None else None
+		journeys = query(a, b, dts_edt, dts_ldt, max_transfers=opts.max_transfers, budget=budget)
 		journeys.pretty_print(timetable.dts_format)
 
 	elif opts.call == 'query-transfer-patterns':
@@ -224,6 +409,51 @@ def main(args=None):
 		journeys = tp_router.query_profile(a, b, dts_edt, dts_ldt, query_tree)
 		journeys.pretty_print(timetable.dts_format)
 
+	elif opts.call == 'bench-queries':
+		import json
+		if opts.workload: queries = tb.workload.load_workload(opts.workload)
+		else:
+			conf_wl = tb.workload.WorkloadConf()
+			conf_wl.mix = dict((k, float(v)) for k, v in (
+				spec.split(':', 1) for spec in opts.mix.split(',') ))
+			queries = tb.workload.generate_workload(timetable, opts.count, opts.seed, conf_wl)
+			if opts.save_workload: tb.workload.save_workload(queries, opts.save_workload)
+		if opts.result_cache: router = tb.engine.QueryResultCache(router, opts.result_cache)
+		query_func = tb.workload.engine_query_func(router, max_transfers=opts.max_transfers)\
+			if not opts.server else tb.workload.server_query_func(opts.server, opts.max_transfers)
+		results, wall_time = tb.workload.replay(
+			query_func, queries, opts.concurrency, processes=opts.processes )
+		report = tb.workload.replay_report(results, wall_time)
+		report['concurrency'] = opts.concurrency
+		if opts.result_cache and not opts.processes: report['cache'] = dict(router.stats)
+		if opts.output:
+			with tb.u.safe_replacement(opts.output) as dst: json.dump(report, dst, indent=2)
+		else: json.dump(report, sys.stdout, indent=2)
+
+	elif opts.call == 'query-batch':
+		conf_batch = tb.batch.BatchConf()
+		conf_batch.workers, conf_batch.ordered, conf_batch.chunk_size =\
+			opts.workers, not opts.unordered, opts.chunk_size
+		conf_batch.max_transfers, conf_batch.query_timeout = opts.max_transfers, opts.query_timeout
+		conf_batch.pack_graph = not opts.no_pack
+		with open(opts.queries) if opts.queries != '-' else sys.stdin as src:
+			queries = tb.batch.read_queries(src, opts.format)
+			if not opts.output: tb.batch.run_batch(router, queries, sys.stdout, conf_batch)
+			else:
+				with tb.u.safe_replacement(opts.output) as dst:
+					tb.batch.run_batch(router, queries, dst, conf_batch)
+
+	elif opts.call == 'serve':
+		conf_server = tb.server.ServerConf()
+		conf_server.host, conf_server.port, conf_server.unix_socket = opts.host, opts.port, opts.unix
+		conf_server.workers, conf_server.max_transfers, conf_server.query_timeout =\
+			opts.workers, opts.max_transfers, opts.query_timeout
+		conf_server.pack_graph = not opts.no_pack
+		conf_server.cache_size, conf_server.cache_bucket = opts.result_cache, opts.result_cache_bucket
+		if not (conf_server.port or conf_server.unix_socket):
+			parser.error('Either non-zero --port or --unix socket path must be specified.')
+		tb.server.serve(router, conf_server)
+
 	else: parser.error('Action not implemented: {}'.format(opts.call))
 
 if __name__ == '__main__': sys.exit(main())
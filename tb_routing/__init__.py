@@ -2,13 +2,13 @@ import itertools as it, operator as op, functools as ft
 from pathlib import Path
 import time
 
-from . import engine, vis, gtfs, utils as u, types as t
+from . import engine, vis, gtfs, trace, synth, workload, memory, server, batch, utils as u, types as t
 
 
 def calc_timer(func, *args, log=u.get_logger('tb.timer'), timer_name=None, **kws):
-	if not timer_name:
-		func_base = func if not isinstance(func, ft.partial) else func.func
-		timer_name = '.'.join([func_base.__module__.strip('__'), func_base.__qualname__])
+	'''Logs start/finish for calls passed through it, without keeping any other state.
+		trace.Tracer can be used as timer_func instead, to also record spans and histograms.'''
+	if not timer_name: timer_name = trace.timer_name_for_func(func)
 	log.debug('[{}] Starting...', timer_name)
 	td = time.monotonic()
 	data = func(*args, **kws)
@@ -18,12 +18,18 @@ def calc_timer(func, *args, log=u.get_logger('tb.timer'), timer_name=None, **kws
 
 
 def init_gtfs_router(
-		tt_path, cache_path=None, tt_path_dump=None,
-		conf=None, conf_engine=None, timer_func=None, log=u.get_logger('tb.init') ):
+		tt_path, cache_path=None, tt_path_dump=None, conf=None,
+		conf_engine=None, timer_func=None, tracer=None, log=u.get_logger('tb.init') ):
 	if not conf: conf = gtfs.GTFSConf()
+	if not tracer and isinstance(timer_func, trace.Tracer): tracer = timer_func
+	if not timer_func: timer_func = tracer
+	if conf_engine and conf_engine.profile_dir: # to also profile timetable parsing/loading
+		timer_func = trace.PhaseProfiler(
+			conf_engine.profile_dir, conf_engine.trace_malloc, timer_func=timer_func )
 
-	timetable_func, router_func = gtfs.parse_timetable,\
-		ft.partial(engine.TBRoutingEngine, conf=conf_engine, timer_func=timer_func)
+	timetable_func = ft.partial(gtfs.parse_timetable, tracer=tracer)
+	router_func = ft.partial( engine.TBRoutingEngine,
+		conf=conf_engine, timer_func=timer_func, tracer=tracer )
 	if timer_func:
 		timetable_func, router_func = (
 			ft.partial(timer_func, func) for func in [timetable_func, router_func] )
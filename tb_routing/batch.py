@@ -0,0 +1,100 @@
+'''Batch query runs for offline jobs - reading queries from CSV/JSONL,
+	running these in a pool of processes forked after loading graph, and streaming results as JSONL.'''
+
+import itertools as it, operator as op, functools as ft
+from collections import OrderedDict
+import os, csv, json, time, threading, multiprocessing
+
+from . import utils as u, server
+
+
+@u.attr_struct(vals_to_attrs=True)
+class BatchConf:
+	workers = None # number of forked query processes, None - cpu count, 0 - run in this process
+	chunk_size = 16 # number of queries sent to worker processes at once
+	queue_chunks = 8 # max number of chunks per worker to read from input ahead of written results
+	ordered = True # write results in same order as queries, otherwise in order of completion
+	pack_graph = True # see server.prepare_fork()
+	max_transfers = 15 # default for profile queries
+	query_timeout = None # QueryBudget timeout for each query, in seconds
+
+
+def read_queries(src, fmt=None):
+	'''Yields query parameter dicts from CSV (with header) or JSONL file object,
+			with same keys as for server.run_query() params, and optional "id" value.
+		Format is detected by the first character, unless specified as "csv" or "jsonl".'''
+	if not fmt:
+		line = src.readline()
+		fmt = 'jsonl' if line.lstrip().startswith('{') else 'csv'
+		src = it.chain([line], src)
+	if fmt == 'csv':
+		for row in csv.DictReader(src): yield dict((k, v) for k, v in row.items() if k and v)
+	elif fmt == 'jsonl':
+		for n, line in enumerate(src, 1):
+			if not line.strip(): continue
+			try: yield json.loads(line)
+			except ValueError as err: raise ValueError('Invalid JSON on line {}: {}'.format(n, err))
+	else: raise ValueError('Unknown query file format: {!r}'.format(fmt))
+
+
+_batch_state = None # (router, conf) tuple, inherited by forked worker processes
+
+def _run_query(n_params):
+	'Returns result dict with "id" and either "error" or result keys, as returned by server.run_query().'
+	(n, params), (router, conf) = n_params, _batch_state
+	res = OrderedDict([('id', params.get('id', n))])
+	try: res.update(server.run_query(router, params, conf, server.journeys_compact))
+	except server.QueryError as err: res['error'] = str(err)
+	except Exception as err: res['error'] = '{}: {}'.format(err.__class__.__name__, err)
+	return res
+
+def run_batch(router, queries, dst, conf=None, log=u.get_logger('tb.batch')):
+	'''Run queries from iterable of parameter dicts (e.g. from read_queries()) on router,
+			writing one JSON result per line to dst file object, and return dict with run stats.
+		Results have "id" from query or its 1-based number in the input, and
+			search_time, partial and journeys (see JourneySet.compact) keys, or "error" for failed ones.
+		Input is read only as far as needed to keep worker processes busy.'''
+	global _batch_state
+	if not conf: conf = BatchConf()
+	_batch_state, queries = (router, conf), enumerate(queries, 1)
+	count = errors = 0
+	ts0 = time.monotonic()
+
+	def write(results, written=None):
+		nonlocal count, errors
+		for res in results:
+			count += 1
+			if 'error' in res: errors += 1
+			dst.write(json.dumps(res, separators=(',', ':')) + '\n')
+			if written: written()
+
+	def queries_read_ahead(queries, limit, stop):
+		# Pool reads input in a separate thread without any limit,
+		#  so it is throttled here by number of results written so far
+		for query in queries:
+			limit.acquire()
+			if stop.is_set(): break
+			yield query
+
+	try:
+		if conf.workers == 0: write(map(_run_query, queries))
+		else:
+			workers = conf.workers or os.cpu_count() or 1
+			if conf.pack_graph: server.prepare_fork(router)
+			limit = threading.Semaphore(workers * conf.chunk_size * conf.queue_chunks)
+			stop = threading.Event()
+			with multiprocessing.get_context('fork').Pool(
+					workers, initializer=server._worker_init ) as pool:
+				pool_map = pool.imap if conf.ordered else pool.imap_unordered
+				try:
+					write( pool_map( _run_query,
+						queries_read_ahead(queries, limit, stop), conf.chunk_size ), limit.release )
+				finally: # unblock pool input thread, if stopped early
+					stop.set()
+					limit.release()
+	finally: _batch_state = None
+
+	td = time.monotonic() - ts0
+	log.debug( 'Finished batch: queries={:,} errors={:,} time={:.1f}s rate={:,.1f}/s',
+		count, errors, td, count / td if td > 0 else 0 )
+	return OrderedDict([('queries', count), ('errors', errors), ('time', td)])
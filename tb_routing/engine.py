@@ -1,35 +1,76 @@
 import itertools as it, operator as op, functools as ft
-from collections import defaultdict, namedtuple, Counter
+from collections import defaultdict, namedtuple, Counter, OrderedDict
+import os, time, math, heapq, inspect, numbers, threading, array, multiprocessing, concurrent.futures
 
-from . import utils as u, types as t
+from . import utils as u, types as t, trace
 
 
 @u.attr_struct(vals_to_attrs=True)
 class EngineConf:
 	log_progress_for = None # or a set/list of prefixes
 	log_progress_steps = 30
+	dst_index_cache_size = 64 # max number of trips-to-destination indexes to keep cached
+	src_index_cache_size = 64 # same as dst_index_cache_size, but for source-stop seed sets
+	access_radius_km = 0.5 # max walking distance to stops from lon/lat query points
+	access_max_stops = 8 # max number of nearest stops to use for lon/lat query points
+	access_speed_kmh = 5 / 3600 # walking speed for lon/lat query points, same as in GTFSConf
+	lower_bounds_clusters = None # number of stop clusters for lower-bounds table, None to disable
+	profile_dir = None # dir to store cProfile stats for each major phase in, see trace.PhaseProfiler
+	trace_malloc = None # number of top tracemalloc allocation sites to also store there
+	packed_transfers = False # use read-only array-based PackedTransferSet, e.g. for forked workers
 
 
 def timer(self_or_func, func=None, *args, **kws):
-	'Calculation call wrapper for timer/progress logging.'
-	if not func: return lambda s,*a,**k: s.timer_wrapper(self_or_func, s, *a, **k)
+	'''Calculation call wrapper for timer/progress logging.
+		Generator methods have each step of iteration wrapped instead,
+			so that their results are still streamed, and each one is timed separately.'''
+	if not func:
+		if inspect.isgeneratorfunction(self_or_func):
+			return lambda s,*a,**k: _timer_gen(self_or_func, s, *a, **k)
+		return lambda s,*a,**k: s.timer_wrapper(self_or_func, s, *a, **k)
 	return self_or_func.timer_wrapper(func, *args, **kws)
 
-
-def jtrips_to_journeys(footpaths, stop_src, stop_dst, dts_src, results):
-	'Convert list/set of QueryResults to JourneySet with proper journey descriptions.'
+def _timer_gen(func, self, *args, **kws):
+	gen, end = func(self, *args, **kws), object()
+	step = ft.wraps(func)(lambda: next(gen, end)) # to have func name for timer_wrapper
+	while True:
+		res = self.timer_wrapper(step)
+		if res is end: break
+		yield res
+
+
+def jtrips_to_journeys( footpaths, stop_src,
+		stop_dst, dts_src, results, dts_arr_max=None, budget=None, compact=False ):
+	'''Convert list/set of QueryResults to JourneySet with proper journey descriptions.
+		dts_arr_max can be used to discard final footpaths to stop_dst arriving after that time.
+		Trips are only boarded from stop_src at or after dts_src (incl. footpath there),
+			or result.dts_dep, if it is later, e.g. departure time found in profile query.
+		JourneySet is marked as partial if QueryBudget for the query is passed and has expired.
+		compact=True builds CompactJourneys with JourneySet.compact() legs
+			directly from results, without creating journey segment objects.'''
+	journey_cls = t.public.CompactJourney if compact else t.public.Journey
 	JourneySoFar = namedtuple('JSF', 'ts_src journey prio') # unfinished journey up to ts_src
 
+	def queue_add(ts_src, prio, journey_func):
+		# Only least-walking (first one of these) journey is kept for each ts_src, as the rest
+		#  of the journey only depends on it, which is same as picking best one of all combinations.
+		#  Replacements are re-added to the end to keep same order as with all combinations queued.
+		if ts_src in queue:
+			if queue[ts_src].prio <= prio: return
+			del queue[ts_src]
+		queue[ts_src] = JourneySoFar(ts_src, journey_func(), prio)
+
 	journeys = t.public.JourneySet()
 	for result in results:
-		jtrips = result.jtrips
-		queue = [JourneySoFar(
-			t.public.TripStop.dummy_for_stop(stop_src),
-			t.public.Journey(dts_src), prio=0 )]
+		jtrips, dts_dep_min = result.jtrips, max(dts_src, result.dts_dep)
+		ts_src = t.public.TripStop.dummy_for_stop(stop_src)
+		queue = OrderedDict([(ts_src, JourneySoFar(ts_src, journey_cls(dts_src), prio=0))])
 
 		for trip in it.chain(jtrips, [None]): # +1 iteration to add fp to stop_dst
-			queue_prev, queue = queue, list()
-			for jsf in queue_prev:
+			queue_prev, queue = queue, OrderedDict()
+			trip_stops = defaultdict(list) # {stop: [ts, ...]}
+			for ts in trip or list(): trip_stops[ts.stop].append(ts)
+			for jsf in queue_prev.values():
 
 				if not trip: # final footpath to stop_dst
 					ts_list = jsf.ts_src.trip[jsf.ts_src.stopidx+1:] if jsf.ts_src.trip else [jsf.ts_src]
@@ -37,34 +78,191 @@ def jtrips_to_journeys(footpaths, stop_src, stop_dst, dts_src, results):
 						fp_delta = 0 if ts.stop == stop_dst else\
 							footpaths.time_delta(ts.stop, stop_dst, dts_src=ts.dts_arr)
 						if fp_delta is None: continue
-						jn = jsf.journey.copy()
-						if ts.trip: jn.append_trip(jsf.ts_src, ts)
-						jn.append_fp(ts.stop, stop_dst, fp_delta)
-						queue.append(JourneySoFar(None, jn, jsf.prio + fp_delta))
+						if dts_arr_max is not None and ts.dts_arr + fp_delta > dts_arr_max: continue
+						queue_add( None, jsf.prio + fp_delta, lambda: (
+							jsf.journey.copy().append_trip(jsf.ts_src, ts) if ts.trip
+							else jsf.journey.copy() ).append_fp(ts.stop, stop_dst, fp_delta) )
 
 				elif not jsf.ts_src.trip: # footpath from stop_src, not a trip
 					for ts in trip:
 						fp_delta = 0 if jsf.ts_src.stop == ts.stop else\
 							footpaths.time_delta(jsf.ts_src.stop, ts.stop, dts_dst=ts.dts_dep)
-						if fp_delta is None: continue
-						jn = jsf.journey.copy().append_fp(jsf.ts_src.stop, ts.stop, fp_delta)
-						queue.append(JourneySoFar(ts, jn, jsf.prio + fp_delta))
+						if fp_delta is None or ts.dts_dep - fp_delta < dts_dep_min: continue
+						queue_add( ts, jsf.prio + fp_delta, lambda: jsf.journey.copy()\
+							.append_fp(jsf.ts_src.stop, ts.stop, fp_delta) )
 
 				else: # footpath from previous trip - common case
-					for ts1, ts2 in it.product(jsf.ts_src.trip[jsf.ts_src.stopidx+1:], trip):
-						fp_delta = footpaths.time_delta(
-							ts1.stop, ts2.stop, dts_src=ts1.dts_arr, dts_dst=ts2.dts_dep )
-						if fp_delta is None: continue
-						jn = jsf.journey.copy()
-						jn.append_trip(jsf.ts_src, ts1)
-						jn.append_fp(ts1.stop, ts2.stop, fp_delta)
-						queue.append(JourneySoFar(ts2, jn, jsf.prio + fp_delta))
+					# Same as checking all stop pairs in same order, but only ones with footpaths
+					for ts1 in jsf.ts_src.trip[jsf.ts_src.stopidx+1:]:
+						ts2_list = list(it.chain.from_iterable( trip_stops[stop]
+							for stop, fp in footpaths.to_stops_from(ts1.stop) if stop in trip_stops ))
+						if len(ts2_list) > 1: ts2_list.sort(key=op.attrgetter('stopidx'))
+						for ts2 in ts2_list:
+							fp_delta = footpaths.time_delta(
+								ts1.stop, ts2.stop, dts_src=ts1.dts_arr, dts_dst=ts2.dts_dep )
+							if fp_delta is None: continue
+							queue_add( ts2, jsf.prio + fp_delta, lambda: jsf.journey.copy()\
+								.append_trip(jsf.ts_src, ts1).append_fp(ts1.stop, ts2.stop, fp_delta) )
+
+		if queue: journeys.add(queue[None].journey)
+
+	journeys.partial = bool(budget and budget.expired)
+	return journeys
 
-		if queue:
-			best_jsf = min(queue, key=op.attrgetter('prio'))
-			journeys.add(best_jsf.journey)
 
-	return journeys
+_query_matrix_state = None # (engine, stops_src, dts_list, dst_idx, max_transfers) for workers
+
+def _query_matrix_row(task):
+	'Returns (k_dts, k_src, row) with travel times to each destination, runs in worker pids.'
+	import numpy as np
+	engine, stops_src, dts_list, dst_idx, max_transfers = _query_matrix_state
+	k_dts, k_src = task
+	arrivals = engine._query_one_to_all(stops_src[k_src], dts_list[k_dts], max_transfers)
+	row = np.frombuffer(arrivals.dts_arr, dtype=np.float64)[dst_idx] - dts_list[k_dts]
+	return k_dts, k_src, row.astype(np.float32)
+
+
+def dts_bound(*bounds):
+	'''Returns initial t_min cutoff for queries from optional (None) arrival-time bounds.
+		Tiny delta is added to it, so that arrivals exactly at the bound are not discarded.'''
+	bounds = list(v for v in bounds if v is not None)
+	return min(bounds) + 1e-6 if bounds else u.inf
+
+
+class QueryBudget:
+	'''Latency budget (timeout/deadline) and cooperative cancellation token for queries.
+		Checked every check_interval trip segments in query main loops, and once it
+			is expired, these stop and return best-so-far results flagged as partial.
+		cancel() can be called from any thread to expire it immediately.'''
+
+	check_interval = 200
+
+	def __init__(self, timeout=None, deadline=None, check_interval=None):
+		'''deadline is time.monotonic() value, and both it and
+			timeout (in seconds, relative to now) can be None for no time limit.'''
+		if timeout is not None: deadline = min(u.inf if deadline is None else deadline, time.monotonic() + timeout)
+		self.deadline = u.inf if deadline is None else deadline
+		if check_interval: self.check_interval = check_interval
+		self.cancelled = self.expired = False
+		self.ticks = 0
+
+	def cancel(self): self.cancelled = True
+
+	def check(self):
+		'Returns True if budget is expired or cancelled, checking time.'
+		if not self.expired:
+			self.expired = self.cancelled or time.monotonic() >= self.deadline
+		return self.expired
+
+	def tick(self):
+		'Same as check(), but only actually checks anything every check_interval calls.'
+		self.ticks += 1
+		if self.ticks < self.check_interval: return self.expired
+		self.ticks = 0
+		return self.check()
+
+
+@u.attr_struct(vals_to_attrs=True)
+class QueryStats:
+	'''Per-query counters and phase timings (in seconds), filled-in by queries when passed as "stats".
+		Same object can be passed to any number of queries to get aggregate values for all of them.'''
+	queries = 0
+	seeds = 0 # initial trip segments or profile departure-time checks
+	rounds = 0 # main loop iterations, i.e. transfer count levels
+	segments = 0 # trip segments scanned
+	segments_enqueued = 0
+	labels_rejected = 0 # segments not enqueued due to trip labels
+	transfers_scanned = 0
+	results = 0 # pareto-optimal results, before constructing journeys from these
+	journeys = 0
+	time_seed = 0.0
+	time_scan = 0.0
+	time_journeys = 0.0
+
+	def time_add(self, phase, ts0):
+		'Add time since ts0 to specified phase timing, returning current time.'
+		ts1 = time.monotonic()
+		setattr(self, 'time_' + phase, getattr(self, 'time_' + phase) + (ts1 - ts0))
+		return ts1
+
+	def as_dict(self): return u.attr.asdict(self, dict_factory=OrderedDict)
+
+
+TripSegment = namedtuple('TripSeg', 'trip stopidx_a stopidx_b journey')
+DepartureCriteriaCheck = namedtuple('DCCheck', 'trip stopidx dts_src journey')
+
+
+class QueryWorkspace:
+	'''Reusable scratch state for TBRoutingEngine queries - trip labels (R) and queue (Q).
+		Labels are kept in per-transfer-count arrays, indexed by dense trip number,
+			and are invalidated lazily by bumping generation stamp in reset(),
+			so that back-to-back queries on a warm workspace allocate almost nothing.
+		Not thread-safe, use TBRoutingEngine.query_workspace() to get one for current thread.'''
+
+	_gen_max = 2**32 - 1
+
+	def __init__(self, timetable):
+		self.trip_idx = dict((trip.id, n) for n, trip in enumerate(timetable.trips))
+		self.gen, self.levels, self.queue = 0, list(), dict()
+
+	def reset(self, levels=1):
+		'''Invalidate all labels and queue, making sure that
+			label arrays are allocated for specified number of levels (transfer counts).'''
+		self.gen += 1
+		if self.gen > self._gen_max: # wraparound - stamps have to be actually cleared
+			for stamps, labels in self.levels: stamps[:] = array.array('L', [0]) * len(stamps)
+			self.gen = 1
+		for n in range(len(self.levels), levels):
+			self.levels.append(( array.array('L', [0]) * len(self.trip_idx),
+				array.array('H', [0]) * len(self.trip_idx) ))
+		self.queue.clear()
+		return self
+
+	def label(self, n, trip, default):
+		'Return label (earliest reached stopidx) for trip on level n, or default if unset.'
+		k, (stamps, labels) = self.trip_idx[trip.id], self.levels[n]
+		return labels[k] if stamps[k] == self.gen else default
+
+	def label_min(self, n, trip, i):
+		'Update label for trip on level n to stopidx i, if it is lower than current one.'
+		k, (stamps, labels) = self.trip_idx[trip.id], self.levels[n]
+		if stamps[k] != self.gen: stamps[k], labels[k] = self.gen, i
+		elif i < labels[k]: labels[k] = i
+
+	def label_max(self, n, trip, i):
+		'Same as label_min(), but for latest-stopidx labels, used in backward searches.'
+		k, (stamps, labels) = self.trip_idx[trip.id], self.levels[n]
+		if stamps[k] != self.gen: stamps[k], labels[k] = self.gen, i
+		elif i > labels[k]: labels[k] = i
+
+
+class PrecalcProgress:
+	'''Sampled progress logging and structured counters for long pre-calculation loops.
+		Loops are expected to only check "if n >= progress.n_next: progress.send(n, ...)",
+			which is never true if progress logging for prefix is disabled (see EngineConf),
+			so that message arguments are only built on sampled iterations, if ever.
+		counts are exported in TBRoutingEngine.precalc_stats[prefix] as they are updated,
+			and logged in the end via finish() call.'''
+
+	def __init__(self, log, prefix, n_max, steps=None):
+		self.log, self.prefix, self.counts = log, prefix, Counter()
+		self.steps = min(n_max, steps or 0)
+		self.step_n = self.steps and n_max / self.steps
+		self.n_next = 0 if self.steps else u.inf
+		self.msg_tpl = '[{{}}] Step {{:>{0}.0f}} / {{:{0}d}}{{}}'.format(len(str(self.steps)))
+
+	def send(self, n, msg=None, *msg_args):
+		'Log progress for n processed items, with optional str.format() message.'
+		if n < self.n_next: return
+		self.n_next = (math.floor(n / self.step_n) + 1) * self.step_n
+		msg = ': {}'.format(msg.format(*msg_args)) if msg else ''
+		self.log.debug(self.msg_tpl, self.prefix, n / self.step_n, self.steps, msg)
+
+	def finish(self):
+		if self.counts:
+			self.log.debug( '[{}] Counters: {}', self.prefix,
+				' '.join('{}={:,}'.format(k, v) for k, v in sorted(self.counts.items())) )
+		return self.counts
 
 
 class TimetableError(Exception): pass
@@ -73,9 +271,18 @@ class TBRoutingEngine:
 
 	graph = None
 
-	def __init__(self, timetable, conf=None, cached_graph=None, timer_func=None):
-		'''Creates Trip-Based Routing Engine from Timetable data.'''
+	def __init__(self, timetable, conf=None, cached_graph=None, timer_func=None, tracer=None):
+		'''Creates Trip-Based Routing Engine from Timetable data.
+			tracer (trace.Tracer) can be passed to record nested spans for query phases,
+				and is also used as timer_func for top-level calls, if latter is not specified.'''
 		self.conf, self.log = conf or EngineConf(), u.get_logger('tb')
+		if not tracer and isinstance(timer_func, trace.Tracer): tracer = timer_func
+		self.tracer = tracer or trace.null_tracer
+		if not timer_func: timer_func = tracer
+		if self.conf.profile_dir and not isinstance(timer_func, trace.PhaseProfiler):
+			timer_func = trace.PhaseProfiler(
+				self.conf.profile_dir, self.conf.trace_malloc, timer_func=timer_func )
+		self.precalc_stats = dict() # {prefix: Counter}, see PrecalcProgress
 		self.timer_wrapper = timer_func if timer_func else lambda f,*a,**k: f(*a,**k)
 		self.jtrips_to_journeys = ft.partial(self.timer_wrapper, jtrips_to_journeys)
 
@@ -84,30 +291,148 @@ class TBRoutingEngine:
 			transfers = self.precalc_transfer_set(timetable, lines)
 			graph = t.base.Graph(timetable, lines, transfers)
 		else:
-			graph = self.timer_wrapper(t.base.Graph.load, cached_graph, timetable)
+			graph = self.timer_wrapper( t.base.Graph.load,
+				cached_graph, timetable, packed=self.conf.packed_transfers )
+		if not graph.transfers_rev: # not in older graph dumps
+			graph.transfers_rev = self.precalc_transfer_set_rev(graph.timetable, graph.lines)
+		if self.conf.packed_transfers: graph.pack()
 		self.graph = graph
-
-	@u.coroutine
-	def progress_iter(self, prefix, n_max, steps=None, n=0):
-		'Progress logging helper coroutine for long calculations.'
+		self.stop_idx = t.base.StopIndex(graph.timetable.stops)
+		if self.conf.lower_bounds_clusters and not self._lower_bounds_match(
+				graph.lower_bounds, self.conf.lower_bounds_clusters ): # missing or for different conf/stops
+			graph.lower_bounds = self.build_lower_bounds(self.conf.lower_bounds_clusters)
+		graph.freeze()
+
+		# All query-time state is either in per-thread workspaces or in thread-safe caches below
+		self.lower_bounds_cache = u.LRUCache(self.conf.dst_index_cache_size)
+		self._workspaces, self._lock = threading.local(), threading.Lock()
+		self.dst_index_cache = u.LRUCache(self.conf.dst_index_cache_size)
+		self.dst_index_pinned, self.dst_query_counts = dict(), Counter()
+		self.src_index_cache = u.LRUCache(self.conf.src_index_cache_size)
+
+	def query_workspace(self):
+		'Return QueryWorkspace for the current thread, creating it on first use.'
+		ws = getattr(self._workspaces, 'ws', None)
+		if ws is None: ws = self._workspaces.ws = QueryWorkspace(self.graph.timetable)
+		return ws
+
+	def query_many(self, queries, query_func=None, workers=None):
+		'''Run queries in a thread pool with specified number of workers,
+				returning list of results (e.g. JourneySets) in the same order.
+			queries - iterable of argument tuples or keyword-argument dicts for query_func,
+				which is query_earliest_arrival by default, or can be a name of any other query method.
+			Graph is not modified by queries and all per-query state is kept in per-thread workspaces,
+				so on free-threaded python builds these run on multiple cores, sharing same graph.'''
+		if not query_func: query_func = self.query_earliest_arrival
+		elif isinstance(query_func, str): query_func = getattr(self, query_func)
+		query = lambda q: query_func(**q) if isinstance(q, dict) else query_func(*q)
+		with concurrent.futures.ThreadPoolExecutor(workers) as pool: return list(pool.map(query, queries))
+
+	def dst_trips_index(self, stop_dst, footpaths=None):
+		'''Returns trips-to-destination index for stop_dst as {trip: (stopidx, fp_delta)} dict.
+			Trips-to-destintaion index is used in queries instead of lines-to-destintaion,
+				because footpath time deltas are tied to each trip stop times, and can't be
+				generalized to lines with multiple of arrival-times for stop, as it is in the algo.
+			These are cached (see conf.dst_index_cache_size), and
+				can be pinned for popular destinations via precompute_dst_indexes().
+			Non-timetable footpaths (e.g. FootpathsOverlay) can be passed to build uncached index.'''
+		if footpaths is not None: return self._dst_trips_index_build(stop_dst, footpaths)
+		with self._lock: self.dst_query_counts[stop_dst] += 1
+		trips_to_dst = self.dst_index_pinned.get(stop_dst)
+		if trips_to_dst is None: trips_to_dst = self.dst_index_cache.get(stop_dst)
+		if trips_to_dst is None:
+			trips_to_dst = self._dst_trips_index_build(stop_dst)
+			self.dst_index_cache.set(stop_dst, trips_to_dst)
+		return trips_to_dst
+
+	def _dst_trips_index_build(self, stop_dst, footpaths=None):
+		timetable, lines, transfers = self.graph
+		if footpaths is None: footpaths = timetable.footpaths
+		span, trips_to_dst = self.tracer.start('dst_trips_index'), dict() # {trip: (i, fp_delta)}
+		for stop_q, fp in footpaths.from_stops_to(stop_dst):
+			if stop_q == stop_dst: fp = None
+			for i, line in lines.lines_with_stop(stop_q):
+				for trip in line:
+					fp_delta = 0 if fp is None else fp.get_shortest(dts_src=trip[i].dts_arr)
+					if fp_delta is None: continue
+					trips_to_dst[trip] = i, fp_delta
+		self.tracer.finish(span)
+		return trips_to_dst
+
+	def precompute_dst_indexes(self, stops=None, top_n=None):
+		'''Build and pin (exempt from cache eviction) trips-to-destination indexes
+				for specified stops or top_n most-queried destinations so far (or both).
+			Returns number of pinned indexes.'''
+		stops = list(stops or list())
+		if top_n: stops.extend(stop for stop, n in self.dst_query_counts.most_common(top_n))
+		for stop in stops:
+			if stop in self.dst_index_pinned: continue
+			trips_to_dst = self.dst_index_cache.get(stop)
+			if trips_to_dst is None: trips_to_dst = self._dst_trips_index_build(stop)
+			self.dst_index_pinned[stop] = trips_to_dst
+		return len(self.dst_index_pinned)
+
+	def src_seed_index(self, stop_src, footpaths=None):
+		'''Returns list of (stop, fp, stop_lines) tuples for stops reachable from stop_src,
+				where fp is None for stop_src itself and stop_lines is a list of (stopidx, line).
+			Used to seed initial set of trips for queries, cached same as dst_trips_index().'''
+		seeds = self.src_index_cache.get(stop_src) if footpaths is None else None
+		if seeds is None:
+			timetable, lines, transfers = self.graph
+			seeds = list(
+				(stop_q, fp if stop_q != stop_src else None, lines.lines_with_stop(stop_q))
+				for stop_q, fp in (footpaths or timetable.footpaths).to_stops_from(stop_src) )
+			if footpaths is None: self.src_index_cache.set(stop_src, seeds)
+		return seeds
+
+	def stops_near(self, lon, lat, radius_km=None, n=None):
+		'''Return list of (stop, walk_time_delta) tuples for stops nearest to lon/lat point,
+			using conf.access_* parameters as defaults, e.g. for use with query_*_multi() calls.'''
+		if radius_km is None: radius_km = self.conf.access_radius_km
+		if n is None: n = self.conf.access_max_stops
+		return list( (stop, km / self.conf.access_speed_kmh)
+			for km, stop in self.graph.timetable.stops.nearest(lon, lat, radius_km=radius_km, n=n) )
+
+	def _multi_stop_footpaths(self, stops_src, stops_dst):
+		'''Returns (stop_src, stop_dst, footpaths) tuple with virtual source/destination stops,
+				connected via FootpathsOverlay to (stop, time_delta) tuples in stops_src/stops_dst.
+			If same stop is in both of these, direct footpath is added for it between virtual ones.'''
+		stop_src, stop_dst = (t.public.Stop(k, k, None, None) for k in ['<source>', '<destination>'])
+		footpaths, delta_direct = t.public.FootpathsOverlay(self.graph.timetable.footpaths), dict()
+		with footpaths.populate() as fp_add:
+			for stop, delta in stops_src:
+				fp_add(stop_src, stop, delta)
+				delta_direct[stop] = min(delta, delta_direct.get(stop, u.inf))
+			for stop, delta in stops_dst:
+				fp_add(stop, stop_dst, delta)
+				if stop in delta_direct: fp_add(stop_src, stop_dst, delta_direct[stop] + delta)
+		return stop_src, stop_dst, footpaths
+
+	def dst_lower_bounds(self, stops_dst):
+		'''Returns {stop_id: lower_bound} dict of min travel time from
+				any stop to nearest of stops_dst, or None if lower-bounds table is not available.
+			Used to prune trip segments that can't reach stops_dst before current t_min in queries.
+			Table is only used with conf.lower_bounds_clusters set, even if it was loaded from graph.'''
+		lower_bounds = self.graph.lower_bounds
+		if not (lower_bounds and self.conf.lower_bounds_clusters): return
+		try: stop_nums = list(self.stop_idx[stop] for stop in stops_dst)
+		except KeyError: return # virtual stops
+		k = tuple(sorted(set(lower_bounds.stop_clusters[n] for n in stop_nums)))
+		bounds = self.lower_bounds_cache.get(k)
+		if bounds is None:
+			bounds = dict(zip(self.stop_idx.idx, lower_bounds.for_stops(stop_nums)))
+			self.lower_bounds_cache.set(k, bounds)
+		return bounds
+
+	def progress_iter(self, prefix, n_max, steps=None):
+		'''Returns PrecalcProgress helper for long calculations, with logging
+			enabled according to EngineConf.log_progress_for and log_progress_steps.'''
 		prefix_set = self.conf.log_progress_for
-		if not prefix_set or prefix not in prefix_set:
-			while True: yield # dry-run
-		if not steps: steps = self.conf.log_progress_steps
-		steps = min(n_max, steps)
-		step_n = steps and n_max / steps
-		msg_tpl = '[{{}}] Step {{:>{0}.0f}} / {{:{0}d}}{{}}'.format(len(str(steps)))
-		while True:
-			dn_msg = yield
-			if isinstance(dn_msg, tuple): dn, msg = dn_msg
-			elif isinstance(dn_msg, int): dn, msg = dn_msg, None
-			else: dn, msg = 1, dn_msg
-			n += dn
-			if n == dn or n % step_n < 1:
-				if msg:
-					if not isinstance(msg, str): msg = msg[0].format(*msg[1:])
-					msg = ': {}'.format(msg)
-				self.log.debug(msg_tpl, prefix, n / step_n, steps, msg or '')
+		if not prefix_set or prefix not in prefix_set: steps = 0
+		elif not steps: steps = self.conf.log_progress_steps
+		progress = PrecalcProgress(self.log, prefix, n_max, steps)
+		self.precalc_stats[prefix] = progress.counts
+		return progress
 
 
 	@timer
@@ -128,8 +453,8 @@ class TBRoutingEngine:
 			line_trips[line_stops(trip)].append(trip)
 
 		lines, progress = t.base.Lines(), self.progress_iter('lines', len(line_trips))
-		for trips in line_trips.values():
-			progress.send(['line-count={:,}', len(lines)])
+		for n, trips in enumerate(line_trips.values()):
+			if n >= progress.n_next: progress.send(n, 'line-count={:,}', len(lines))
 			lines_for_stopseq = list()
 
 			# Split same-stops trips into non-overtaking groups
@@ -145,7 +470,11 @@ class TBRoutingEngine:
 					lines_for_stopseq.append(t.base.Line(trip_a))
 
 			lines.add(*lines_for_stopseq)
+			if len(lines_for_stopseq) > 1:
+				progress.counts['overtaking-splits'] += len(lines_for_stopseq) - 1
 
+		progress.counts.update(stop_sequences=len(line_trips), lines=len(lines))
+		progress.finish()
 		return lines
 
 	@timer
@@ -159,10 +488,12 @@ class TBRoutingEngine:
 				return True
 			return False
 
-		counts, progress = Counter(), self.progress_iter('pre-initial-set', len(timetable.trips))
+		progress = self.progress_iter('pre-initial-set', len(timetable.trips))
+		counts = progress.counts
 		for n, trip_t in enumerate(timetable.trips):
-			progress.send([ 'transfer-set-size={:,} processed-trips={:,}, discarded'
-				' u-turns={:,} subopt={:,}', len(transfers), n, counts['uturns'], counts['worse'] ])
+			if n >= progress.n_next:
+				progress.send( n, 'transfer-set-size={:,} processed-trips={:,}, discarded'
+					' u-turns={:,} subopt={:,}', len(transfers), n, counts['uturns'], counts['worse'] )
 			min_time_arr, min_time_ch = dict(), dict()
 
 			for i in range(len(trip_t)-1, 0, -1): # first stop of the trip is skipped
@@ -217,185 +548,769 @@ class TBRoutingEngine:
 
 						transfers.add(t.base.Transfer(ts_p, ts_q, transfer_fp_delta))
 
-		self.log.debug( 'Discarded u-turns={:,}'
-			' no-improvement={:,}', counts['uturns'], counts['worse'] )
-		self.log.debug('Resulting transfer set size: {:,}', len(transfers))
+		# Per-stop fan-out is counted in the end, to avoid any extra work in the loop above
+		stop_fanout = self.precalc_stats['transfer-fanout'] =\
+			Counter(transfer.ts_from.stop.id for transfer in transfers)
+		counts.update( transfers=len(transfers),
+			fanout_max=max(stop_fanout.values(), default=0), fanout_stops=len(stop_fanout) )
+		progress.finish()
 		return transfers
 
+	@timer
+	def precalc_transfer_set_rev(self, timetable, lines):
+		'''Reverse transfer set for backward (latest-departure) searches, indexed by ts_to.
+			Mirror image of precalc_transfer_set(), with transfers from the latest trip of each line
+				arriving in time to each trip stop, with the same u-turn and no-improvement reductions,
+				but for latest departure times from stops before transfer, instead of earliest arrivals.
+			Can't be derived from forward transfer set, as that one only has transfers
+				to the earliest trip of each line, which misses ones feeding into later trips.'''
+		transfers = t.base.TransferSet(index_to=True)
+
+		def update_max_time(max_time_map, stop, dts):
+			if dts > max_time_map.get(stop, -u.inf):
+				max_time_map[stop] = dts
+				return True
+			return False
+
+		progress = self.progress_iter('pre-initial-set-rev', len(timetable.trips))
+		counts = progress.counts
+		for n, trip_u in enumerate(timetable.trips):
+			if n >= progress.n_next:
+				progress.send( n, 'transfer-set-size={:,} processed-trips={:,}, discarded'
+					' u-turns={:,} subopt={:,}', len(transfers), n, counts['uturns'], counts['worse'] )
+			max_time_dep, max_time_ch, line_u = dict(), dict(), lines.line_for_trip(trip_u)
+
+			for j in range(len(trip_u)-1): # last stop of the trip is skipped
+				ts_q = trip_u[j]
+
+				reachable_stops = list()
+				update_max_time(max_time_dep, ts_q.stop, ts_q.dts_dep)
+				for stop_p, fp in timetable.footpaths.from_stops_to(ts_q.stop):
+					fp_delta = fp.get_shortest(dts_dst=ts_q.dts_dep)
+					if fp_delta is None: continue
+					dts_p = ts_q.dts_dep - fp_delta
+					update_max_time(max_time_dep, stop_p, dts_p)
+					update_max_time(max_time_ch, stop_p, dts_p)
+					reachable_stops.append((stop_p, fp_delta, dts_p))
+
+				for stop_p, transfer_fp_delta, dts_p in reachable_stops:
+					for i, line in lines.lines_with_stop(stop_p):
+						if i == 0: continue # transfers from first stop make no sense
+						trip_t = line.latest_trip(i, dts_p)
+						if not trip_t: continue # all trips for L(p) arrive after dts_p
+						ts_p = trip_t[i]
+
+						if not (
+							line != line_u
+							or trip_u.compare(trip_t) is t.public.SolutionStatus.non_dominated
+							or j < i ): continue
+
+						# U-turn transfers
+						ts_t, ts_u = trip_t[i-1], trip_u[j+1]
+						if ts_t.stop == ts_u.stop:
+							delta = timetable.footpaths.time_delta(
+								ts_t.stop, ts_u.stop, dts_src=ts_t.dts_arr, dts_dst=ts_u.dts_dep )
+							if delta is not None and ts_t.dts_arr + delta <= ts_u.dts_dep:
+								counts['uturns'] += 1
+								continue
+
+						# No-improvement transfers
+						keep = False
+						for k in range(i-1, -1, -1):
+							ts = trip_t[k]
+							keep = keep | update_max_time(max_time_dep, ts.stop, ts.dts_dep)
+							for stop, fp in timetable.footpaths.from_stops_to(ts.stop):
+								fp_delta = fp.get_shortest(dts_dst=ts.dts_dep)
+								if fp_delta is None: continue
+								dts = ts.dts_dep - fp_delta
+								keep = keep | update_max_time(max_time_dep, stop, dts)
+								keep = keep | update_max_time(max_time_ch, stop, dts)
+						if not keep:
+							counts['worse'] += 1
+							continue
+
+						transfers.add(t.base.Transfer(ts_p, ts_q, transfer_fp_delta))
+
+		counts.update(transfers=len(transfers))
+		progress.finish()
+		return transfers
+
+
+	def _stop_clusters(self, cluster_count):
+		'''Returns array of cluster numbers for stops (in stop_idx order),
+			grouped into at most cluster_count cells of lon/lat grid (growing cell size to fit).
+			Stops without coordinates (e.g. in test graphs) are put into one separate cluster.'''
+		stops = self.stop_idx.stops
+		if cluster_count >= len(stops): return array.array('I', range(len(stops)))
+		coords = list( (float(stop.lon), float(stop.lat))
+			if stop.lon is not None and stop.lat is not None else None for stop in stops )
+		coords_set = list(filter(None, coords))
+		if not coords_set: return array.array('I', [0]) * len(stops)
+		span = max( max(map(op.itemgetter(n), coords_set))
+			- min(map(op.itemgetter(n), coords_set)) for n in range(2) )
+		cell, max_cells = max(span, 1e-6) / math.sqrt(cluster_count), cluster_count - (None in coords)
+		while True:
+			cells = dict()
+			for c in coords_set: cells.setdefault((math.floor(c[0] / cell), math.floor(c[1] / cell)), len(cells))
+			if len(cells) <= max(1, max_cells): break
+			cell *= 1.2
+		return array.array('I', (
+			cells[math.floor(c[0] / cell), math.floor(c[1] / cell)] if c else len(cells) for c in coords ))
+
+	def _lower_bounds_match(self, lower_bounds, cluster_count):
+		'Check if LowerBounds table (e.g. loaded from graph) is for current stops and cluster_count.'
+		if not lower_bounds or lower_bounds.stop_count != len(self.stop_idx): return False
+		stop_clusters = self._stop_clusters(cluster_count)
+		return lower_bounds.stop_clusters == stop_clusters\
+			and lower_bounds.cluster_count == len(set(stop_clusters))
+
+	@timer
+	def build_lower_bounds(self, cluster_count):
+		'''Build LowerBounds table of min travel time from each stop to each of cluster_count
+				stop clusters, via reverse Dijkstra search from each cluster over min trip hop times
+				between consecutive line stops and min footpath times, ignoring any waiting times.'''
+		timetable, lines, transfers = self.graph
+		stop_idx = self.stop_idx
+		stop_clusters = self._stop_clusters(cluster_count)
+
+		edges_rev = defaultdict(dict) # {stop_b: {stop_a: dt_min}} in stop numbers
+		def edge_add(stop_a, stop_b, dt):
+			a, b = stop_idx[stop_a], stop_idx[stop_b]
+			if a != b and dt < edges_rev[b].get(a, u.inf): edges_rev[b][a] = dt
+		for line in lines:
+			for i in range(len(line[0]) - 1):
+				edge_add( line[0][i].stop, line[0][i+1].stop,
+					min(trip[i+1].dts_arr - trip[i].dts_dep for trip in line) )
+		for stop_a, stop_b, fp in timetable.footpaths:
+			if len(fp): edge_add(stop_a, stop_b, fp.delta_tuples[0][0])
+
+		cluster_stops = defaultdict(list)
+		for n, k in enumerate(stop_clusters): cluster_stops[k].append(n)
+		table, progress = array.array('f'), self.progress_iter('lower-bounds', len(cluster_stops))
+		for k in range(len(cluster_stops)):
+			if k >= progress.n_next: progress.send(k, 'clusters={:,}', k)
+			bounds = [u.inf] * len(stop_idx)
+			queue = list((0, n) for n in cluster_stops[k])
+			while queue:
+				dt, b = heapq.heappop(queue)
+				if dt >= bounds[b]: continue
+				bounds[b] = dt
+				for a, dt_ab in edges_rev.get(b, dict()).items():
+					if dt + dt_ab < bounds[a]: heapq.heappush(queue, (dt + dt_ab, a))
+			table.extend(math.floor(dt) if dt is not u.inf else dt for dt in bounds)
+		return t.base.LowerBounds(stop_clusters, table)
 
 	@timer
-	def query_earliest_arrival(self, stop_src, stop_dst, dts_src):
+	def query_earliest_arrival( self, stop_src, stop_dst, dts_src, dts_arr_max=None,
+			max_duration=None, max_transfers=None, budget=None, stats=None, compact=False ):
 		'''Algorithm 4: Earliest arrival query.
 			Actually a bicriteria query that finds
-				min-transfer journeys as well, just called that in the paper.'''
+				min-transfer journeys as well, just called that in the paper.
+			Optional bounds - latest arrival time, max travel time and number of transfers - are
+				used to prune the search from the start, and only journeys within these are returned.
+			QueryBudget can be passed to stop the search early, with JourneySet.partial=True result.
+			QueryStats object can be passed to collect search counters and timings.
+			compact=True returns JourneySet of CompactJourneys, see jtrips_to_journeys().'''
 		# XXX: special case of profile-query, should be merged into that
+		results, = self._query_earliest_arrival( stop_src, [stop_dst], dts_src,
+			dts_arr_max=dts_arr_max, max_duration=max_duration,
+			max_transfers=max_transfers, budget=budget, stats=stats )
+		return self._query_journeys( self.graph.timetable.footpaths,
+			stop_src, stop_dst, dts_src, results, budget, stats, compact )
+
+	def _query_journeys( self, footpaths, stop_src,
+			stop_dst, dts_src, results, budget, stats, compact=False ):
+		'Same as jtrips_to_journeys(), but with updating QueryStats, if passed.'
+		if stats: ts0, stats.queries, stats.results = time.monotonic(), stats.queries + 1, stats.results + len(results)
+		journeys = self.jtrips_to_journeys( footpaths,
+			stop_src, stop_dst, dts_src, results, budget=budget, compact=compact )
+		if stats:
+			stats.time_add('journeys', ts0)
+			stats.journeys += len(journeys)
+		return journeys
+
+	@timer
+	def query_earliest_arrival_multi(self, stops_src, stops_dst, dts_src, budget=None):
+		'''Earliest-arrival query from any of stops_src to any of stops_dst in one search,
+				where these are lists of (stop, time_delta) tuples with access/egress (e.g. walking)
+				times from origin to each source stop and from each destination stop to final destination.
+			Resulting journeys start/end with footpaths from/to virtual "<source>"/"<destination>" stops.
+			See also stops_near() method to get such lists for lon/lat points.'''
+		stop_src, stop_dst, footpaths = self._multi_stop_footpaths(stops_src, stops_dst)
+		results, = self._query_earliest_arrival(stop_src, [stop_dst], dts_src, footpaths, budget=budget)
+		return self.jtrips_to_journeys(footpaths, stop_src, stop_dst, dts_src, results, budget=budget)
+
+	def _query_earliest_arrival( self, stop_src, stops_dst, dts_src, footpaths=None,
+			dts_arr_max=None, max_duration=None, max_transfers=None,
+			budget=None, stats=None, src_seeds=None, dst_indexes=None ):
+		'''Earliest-arrival search from stop_src to any number of stops_dst,
+				returning list of QueryResultParetoSet for each of these, in the same order.
+			Trips are pruned by the latest of per-destination t_min values,
+				so that one search is shared between all destinations.
+			src_seeds/dst_indexes can be passed to use instead of
+				src_seed_index()/dst_trips_index() lookups, e.g. when reused in batches.'''
 		timetable, lines, transfers = self.graph
 
-		TripSegment = namedtuple('TripSeg', 'trip stopidx_a stopidx_b journey')
-		results = t.pareto.QueryResultParetoSet()
-		R, Q = dict(), dict()
+		results = list(t.pareto.QueryResultParetoSet() for stop_dst in stops_dst)
+		t_bound = dts_bound(dts_arr_max, None if max_duration is None else dts_src + max_duration)
+		if t_bound <= dts_src: return results
+		if stats: ts_phase = time.monotonic()
+		R = self.query_workspace().reset()
+		span = self.tracer.start('ea.seed')
+		Q = R.queue
 
-		def enqueue(trip, i, n, jtrips, _ss=t.public.SolutionStatus):
+		def enqueue(trip, i, n, jtrips):
 			i_max = len(trip) - 1 # for the purposes of "infinity" here
-			if i >= R.get(trip, i_max): return
-			Q.setdefault(n, list()).append(
-				TripSegment(trip, i, R.get(trip, i_max), jtrips.copy()) )
-			for trip_u in lines.line_for_trip(trip)\
-					.trips_by_relation(trip, _ss.non_dominated, _ss.equal):
-				R[trip_u] = min(i, R.get(trip_u, i_max))
-
-		# Trips-to-destintaion index is used here instead of lines-to-destintaion,
-		#  because footpath time deltas are tied to each trip stop times, and can't be
-		#  generalized to lines with multiple of arrival-times for stop, as it is in the algo.
-		trips_to_dst = dict() # {trip: (i, fp_delta)}
-		for stop_q, fp in timetable.footpaths.from_stops_to(stop_dst):
-			if stop_q == stop_dst: fp = None
-			for i, line in lines.lines_with_stop(stop_q):
-				for trip in line:
-					fp_delta = 0 if fp is None else fp.get_shortest(dts_src=trip[i].dts_arr)
-					if fp_delta is None: continue
-					trips_to_dst[trip] = i, fp_delta
+			i_label = R.label(0, trip, i_max)
+			if i >= i_label:
+				if stats: stats.labels_rejected += 1
+				return
+			if stats: stats.segments_enqueued += 1
+			Q.setdefault(n, list()).append(TripSegment(trip, i, i_label, jtrips.copy()))
+			for trip_u in lines.line_for_trip(trip).trips_from(trip):
+				R.label_min(0, trip_u, i)
+
+		dst_checks = list(enumerate(dst_indexes or ( # [(k, {trip: (i, fp_delta)})]
+			self.dst_trips_index(stop_dst, footpaths) for stop_dst in stops_dst )))
+		dst_bounds = self.dst_lower_bounds(stops_dst) if footpaths is None else None
+		dst_stop_ks = defaultdict(list) # {stop_dst: [k, ...]}
+		for k, stop_dst in enumerate(stops_dst): dst_stop_ks[stop_dst].append(k)
 
 		# Queue initial set of trips (reachable from stop_src) to examine
-		for stop_q, fp in timetable.footpaths.to_stops_from(stop_src):
-			fp_delta = fp.get_shortest(dts_src=dts_src) if stop_q != stop_src else 0
+		if src_seeds is None: src_seeds = self.src_seed_index(stop_src, footpaths)
+		for stop_q, fp, stop_lines in src_seeds:
+			fp_delta = fp.get_shortest(dts_src=dts_src) if fp is not None else 0
 			if fp_delta is None: continue
 			dts_q, jtrips = dts_src + fp_delta, list()
-			if stop_q == stop_dst:
-				results.add(t.base.QueryResult(dts_q, 0, jtrips))
-				continue # can't be beaten on time or transfers - can only be extended
-			for i, line in lines.lines_with_stop(stop_q):
+			if dts_q >= t_bound: continue
+			if stop_q in dst_stop_ks:
+				for k in dst_stop_ks[stop_q]: results[k].add(t.base.QueryResult(dts_q, 0, jtrips))
+				if len(dst_stop_ks) == 1:
+					continue # can't be beaten on time or transfers - can only be extended
+			for i, line in stop_lines:
 				trip = line.earliest_trip(i, dts_q)
-				if trip: enqueue(trip, i, 0, jtrips)
+				if trip and trip[i].dts_dep < t_bound: enqueue(trip, i, 0, jtrips)
+		if stats:
+			stats.seeds += len(Q.get(0, list()))
+			ts_phase = stats.time_add('seed', ts_phase)
+		self.tracer.finish(span)
+		span = self.tracer.start('ea.scan')
 
 		# Main loop
-		t_min, n = u.inf, 0
-		while Q:
+		t_min_dst, t_min, n = [t_bound] * len(stops_dst), t_bound, 0
+		while Q and (max_transfers is None or n < max_transfers):
+			if budget and budget.check(): break
+			if stats: stats.rounds += 1
 			for trip, b, e, jtrips in Q.pop(n):
+				if budget and budget.tick(): break
+				if stats: stats.segments += 1
 				jtrips = jtrips + [trip]
 
 				# Check if trip reaches stop_dst (or its footpath-vicinity) directly
-				if trip in trips_to_dst:
+				for k, trips_to_dst in dst_checks:
+					if trip not in trips_to_dst: continue
 					i_dst, fp_delta = trips_to_dst[trip]
 					if b < i_dst: # can't reach previous stops, and b->b trips make no sense
 						dts_dst = trip[i_dst].dts_arr + fp_delta
-						if dts_dst < t_min:
-							t_min = dts_dst
-							results.add(t.base.QueryResult(dts_dst, n, jtrips))
+						if dts_dst < t_min_dst[k]:
+							t_min_dst[k] = dts_dst
+							t_min = max(t_min_dst)
+							results[k].add(t.base.QueryResult(dts_dst, n, jtrips))
 
 				for i in range(b+1, e+1): # b < i <= e
 					if trip[i].dts_arr >= t_min: break # after +1 transfer, it's guaranteed to be dominated
+					if dst_bounds and trip[i].dts_arr + dst_bounds[trip[i].stop.id] >= t_min: continue
 					for transfer in transfers.from_trip_stop(trip[i]):
-						if transfer.ts_to.dts_arr >= t_min: continue
-						enqueue(transfer.ts_to.trip, transfer.ts_to.stopidx, n+1, jtrips)
+						if stats: stats.transfers_scanned += 1
+						ts = transfer.ts_to
+						if ts.dts_arr >= t_min: continue
+						if dst_bounds and ts.dts_arr + dst_bounds[ts.stop.id] >= t_min: continue
+						enqueue(ts.trip, ts.stopidx, n+1, jtrips)
 
 			n += 1
 
-		return self.jtrips_to_journeys(
-			timetable.footpaths, stop_src, stop_dst, dts_src, results )
+		if stats: stats.time_add('scan', ts_phase)
+		self.tracer.finish(span)
+		return results
+
+
+	@timer
+	def query_latest_departure(self, stop_src, stop_dst, dts_arr_max, budget=None, compact=False):
+		'''Latest-departure ("arrive by") query - mirror image of earliest-arrival one,
+				scanning trips backwards in time from stop_dst, via reverse transfer set.
+			Returns journeys with pareto-optimal latest departure time and transfer count,
+				all arriving to stop_dst no later than dts_arr_max.
+			Same as departure time in earliest-arrival journeys, arrival time is not optimized,
+				and is the one of latest trips that make it to stop_dst by dts_arr_max.
+			compact=True returns CompactJourneys, same as in query_earliest_arrival().'''
+		timetable, lines, transfers = self.graph
+		footpaths, transfers_rev = timetable.footpaths, self.graph.transfers_rev
+
+		results = t.pareto.QueryResultLDParetoSet()
+		R = self.query_workspace().reset()
+		Q = R.queue
+
+		def enqueue(trip, i, n, jtrips):
+			# Labels here are latest alighting stopidx, and segments are from label to that
+			i_label = R.label(0, trip, 0)
+			if i <= i_label: return
+			Q.setdefault(n, list()).append(TripSegment(trip, i_label, i, jtrips.copy()))
+			for trip_u in lines.line_for_trip(trip).trips_until(trip):
+				R.label_max(0, trip_u, i)
+
+		# Trips-from-source index, same as trips-to-destination one, but
+		#  with all (stopidx, fp_delta) tuples for trip, as these have to be checked by departure time
+		trips_from_src = defaultdict(list) # {trip: [(i, fp_delta), ...]}
+		for stop_q, fp, stop_lines in self.src_seed_index(stop_src):
+			for i, line in stop_lines:
+				for trip in line:
+					fp_delta = 0 if fp is None else fp.get_shortest(dts_dst=trip[i].dts_dep)
+					if fp_delta is None: continue
+					trips_from_src[trip].append((i, fp_delta))
+
+		# Queue initial set of trips (reaching stop_dst) to examine
+		for stop_q, fp in footpaths.from_stops_to(stop_dst):
+			fp_delta = fp.get_shortest(dts_dst=dts_arr_max) if stop_q != stop_dst else 0
+			if fp_delta is None: continue
+			dts_q, jtrips = dts_arr_max - fp_delta, list()
+			if stop_q == stop_src:
+				results.add(t.base.QueryResult(dts_arr_max, 0, jtrips, dts_q))
+				continue # can't be beaten on time or transfers - can only be extended
+			for i, line in lines.lines_with_stop(stop_q):
+				trip = line.latest_trip(i, dts_q)
+				if trip: enqueue(trip, i, 0, jtrips)
+
+		# Main loop
+		t_max, n = -u.inf, 0
+		while Q:
+			if budget and budget.check(): break
+			for trip, b, e, jtrips in Q.pop(n):
+				if budget and budget.tick(): break
+				jtrips = [trip] + jtrips
+
+				# Check if trip can be boarded from stop_src (or its footpath-vicinity) directly
+				for i_src, fp_delta in trips_from_src.get(trip, list()):
+					if i_src >= e: continue # can't board at/after alighting stop
+					dts_src = trip[i_src].dts_dep - fp_delta
+					if dts_src > t_max:
+						t_max = dts_src
+						results.add(t.base.QueryResult(dts_arr_max, n, jtrips, dts_src))
+
+				for i in range(e-1, b-1, -1): # b <= i < e
+					if trip[i].dts_dep <= t_max: break # after +1 transfer, it's guaranteed to be dominated
+					for transfer in transfers_rev.to_trip_stop(trip[i]):
+						ts = transfer.ts_from
+						if ts.dts_dep <= t_max: continue
+						enqueue(ts.trip, ts.stopidx, n+1, jtrips)
+
+			n += 1
+
+		journeys = t.public.JourneySet()
+		for result in results: # each one has to start at its own departure time
+			for jn in self.jtrips_to_journeys( footpaths, stop_src, stop_dst,
+					result.dts_dep, [result], dts_arr_max=dts_arr_max, compact=compact ):
+				journeys.add(jn)
+		journeys.partial = bool(budget and budget.expired)
+		return journeys
 
 
 	@timer
-	def query_profile(self, stop_src, stop_dst, dts_edt=None, dts_ldt=None, max_transfers=15):
+	def query_profile( self, stop_src, stop_dst, dts_edt=None, dts_ldt=None, max_transfers=15,
+			dts_arr_max=None, max_duration=None, budget=None, stats=None, compact=False ):
 		'''Profile query, returning a list of pareto-optimal JourneySet results with Journeys
 				from stop_src to stop_dst, with departure at stop_src in a day-time (dts) interval
-				from dts_edt (earliest departure time) to dts_ldt (latest).'''
-		timetable, lines, transfers = self.graph
+				from dts_edt (earliest departure time) to dts_ldt (latest).
+			dts_arr_max and max_duration bounds can be used same as in query_earliest_arrival(),
+				with latter applied to each departure time separately.
+			QueryBudget can be passed to stop the search early, with JourneySet.partial=True result,
+				in which case it will have journeys for departure times that were processed until then.
+			QueryStats can be passed to collect counters, and compact=True
+				to get CompactJourneys, same as in query_earliest_arrival().'''
+		timetable = self.graph.timetable
 		if dts_edt is None: dts_edt = timetable.dts_parse('00:00')
 		if dts_ldt is None: dts_ldt = timetable.dts_parse('24:00')
+		results, = self._query_profile( stop_src, [stop_dst], dts_edt, dts_ldt, max_transfers,
+			dts_arr_max=dts_arr_max, max_duration=max_duration, budget=budget, stats=stats )
+		return self._query_journeys( timetable.footpaths,
+			stop_src, stop_dst, dts_edt, results, budget, stats, compact )
 
-		DepartureCriteriaCheck = namedtuple('DCCheck', 'trip stopidx dts_src journey')
-		TripSegment = namedtuple('TripSeg', 'trip stopidx_a stopidx_b journey')
+	@timer
+	def query_profile_multi( self, stops_src, stops_dst,
+			dts_edt=None, dts_ldt=None, max_transfers=15, budget=None ):
+		'''Profile query from any of stops_src to any of stops_dst in one search,
+			with (stop, time_delta) tuples in these, same as in query_earliest_arrival_multi().'''
+		timetable = self.graph.timetable
+		if dts_edt is None: dts_edt = timetable.dts_parse('00:00')
+		if dts_ldt is None: dts_ldt = timetable.dts_parse('24:00')
+		stop_src, stop_dst, footpaths = self._multi_stop_footpaths(stops_src, stops_dst)
+		results, = self._query_profile(
+			stop_src, [stop_dst], dts_edt, dts_ldt, max_transfers, footpaths, budget=budget )
+		return self.jtrips_to_journeys(
+			footpaths, stop_src, stop_dst, dts_edt, results, budget=budget )
 
-		results = t.pareto.QueryResultParetoSet()
-		R, Q = dict(), dict()
+	def _query_profile( self, stop_src, stops_dst, dts_edt, dts_ldt, max_transfers,
+			footpaths=None, dts_arr_max=None, max_duration=None,
+			budget=None, stats=None, src_seeds=None, dst_indexes=None ):
+		'''Profile search from stop_src to any number of stops_dst,
+			returning list of QueryResultParetoSet for each of these, same as _query_earliest_arrival.'''
+		timetable, lines, transfers = self.graph
+
+		results = list(t.pareto.QueryResultParetoSet() for stop_dst in stops_dst)
+		if stats: ts_phase = time.monotonic()
+		R = self.query_workspace().reset(max_transfers + 1)
+		span = self.tracer.start('profile.seed')
+		Q = R.queue
 
-		def enqueue(trip, i, n, jtrips, _ss=t.public.SolutionStatus):
+		def enqueue(trip, i, n, jtrips):
 			i_max = len(trip) - 1 # for the purposes of "infinity" here
 			# Labels here are set for "n, trip" instead of "trip", so that
 			#  they can be reused after n jumps back to 0 (see main loop below).
-			if i >= R.get((n, trip), i_max): return
-			Q.setdefault(n, list()).append(
-				TripSegment(trip, i, R.get((n, trip), i_max), jtrips.copy()) )
-			for trip_u in lines.line_for_trip(trip)\
-					.trips_by_relation(trip, _ss.non_dominated, _ss.equal):
-				i_min = min(i, R.get((n, trip_u), i_max))
-				for m in range(n, max_transfers): R[m, trip_u] = i_min
-
-		# Trips-to-destintaion index is used here instead of lines-to-destintaion,
-		#  because footpath time deltas are tied to each trip stop times, and can't be
-		#  generalized to lines with multiple of arrival-times for stop, as it is in the algo.
-		trips_to_dst = dict() # {trip: (i, fp_delta)}
-		for stop_q, fp in timetable.footpaths.from_stops_to(stop_dst):
-			if stop_q == stop_dst: fp = None
-			for i, line in lines.lines_with_stop(stop_q):
-				for trip in line:
-					fp_delta = 0 if fp is None else fp.get_shortest(dts_src=trip[i].dts_arr)
-					if fp_delta is None: continue
-					trips_to_dst[trip] = i, fp_delta
+			i_label = R.label(n, trip, i_max)
+			if i >= i_label:
+				if stats: stats.labels_rejected += 1
+				return
+			if stats: stats.segments_enqueued += 1
+			Q.setdefault(n, list()).append(TripSegment(trip, i, i_label, jtrips.copy()))
+			for trip_u in lines.line_for_trip(trip).trips_from(trip):
+				for m in range(n, max_transfers): R.label_min(m, trip_u, i)
+
+		dst_checks = list(enumerate(dst_indexes or ( # [(k, {trip: (i, fp_delta)})]
+			self.dst_trips_index(stop_dst, footpaths) for stop_dst in stops_dst )))
+		dst_bounds = self.dst_lower_bounds(stops_dst) if footpaths is None else None
 
 		# Same as with earliest-arrival, queue set of trips reachable from stop_src,
 		#  but instead of queuing all checks (one for each trip) with same departure time,
 		#  queue one DepartureCriteriaCheck for every departure time of each trip from
 		#  these reachable stops.
 		profile_queue = list()
-		for stop_q, fp in timetable.footpaths.to_stops_from(stop_src):
-			if stop_q == stop_src: fp = None
-			if stop_q == stop_dst:
+		if src_seeds is None: src_seeds = self.src_seed_index(stop_src, footpaths)
+		for stop_q, fp, stop_lines in src_seeds:
+			for k, stop_dst in enumerate(stops_dst):
+				if stop_q != stop_dst: continue
 				# Direct src-to-dst footpath can't be easily compared to
 				#  other results, as it has no fixed departure/arrival times,
 				#  hence added here as a special "exceptional" result.
-				results.add_exception(t.base.QueryResult(None, 0, list()))
-			for i, line in lines.lines_with_stop(stop_q):
+				results[k].add_exception(t.base.QueryResult(None, 0, list()))
+			for i, line in stop_lines:
 				for trip in line:
 					fp_delta = 0 if fp is None else\
 						fp.get_shortest(dts_src=dts_edt, dts_dst=trip[i].dts_dep)
 					if fp_delta is None: continue
 					dts_min, dts_max = trip[i].dts_arr - fp_delta, trip[i].dts_dep - fp_delta
 					if not (dts_edt <= dts_max and dts_ldt >= dts_min): continue
+					if trip[i].dts_dep >= dts_bound( dts_arr_max,
+						None if max_duration is None else min(dts_ldt, dts_max) + max_duration ): continue
 					profile_queue.append(DepartureCriteriaCheck(trip, i, min(dts_ldt, dts_max), list()))
 		# Latest departures are processed first because labels (R) are reused for the whole query,
 		#  and journeys with later-dep-time dominate earlier, so they are processed first and all
 		#  trips with earlier departure not improving on arrival time (not passing check in enqueue())
 		#  will be suboptimal anyway, hence skipped.
 		profile_queue.sort(key=op.attrgetter('dts_src'), reverse=True) # latest-to-earliest
-
-		t_min_idx = dict() # indexed by n, so that it can be reused, same as R.
+		if stats:
+			stats.seeds += len(profile_queue)
+			ts_phase = stats.time_add('seed', ts_phase)
+		self.tracer.finish(span)
+		span = self.tracer.start('profile.scan')
+
+		# Indexed by n, so that it can be reused, same as R, separate one for each of stops_dst.
+		t_min_idx = list(dict() for stop_dst in stops_dst)
 		for dts_src, checks in it.groupby(profile_queue, op.attrgetter('dts_src')):
 			# Each iteration of this loop is same as an earliest-arrival query,
 			#  with starting set of trips (with same departure time) pulled from profile_queue.
 			# Labels for trips (R) can be reused, cutting down amount of work for 2+ checks dramatically.
-			n = 0
+			if budget and budget.check(): break
+			n, t_bound = 0, dts_bound( dts_arr_max,
+				None if max_duration is None else dts_src + max_duration )
 			for trip, stopidx, dts_src, jtrips in checks: enqueue(trip, stopidx, n, jtrips)
 
 			while Q and n < max_transfers:
-				t_min = t_min_idx.get(n, u.inf)
+				if stats: stats.rounds += 1
+				t_min_dst = list(min(t_min_n.get(n, u.inf), t_bound) for t_min_n in t_min_idx)
+				t_min = max(t_min_dst)
 				for trip, b, e, jtrips in Q.pop(n):
+					if budget and budget.tick(): break
+					if stats: stats.segments += 1
 					jtrips = jtrips + [trip]
 
 					# Check if trip reaches stop_dst (or its footpath-vicinity) directly
-					if trip in trips_to_dst:
+					for k, trips_to_dst in dst_checks:
+						if trip not in trips_to_dst: continue
 						i_dst, fp_delta = trips_to_dst[trip]
 						if b < i_dst: # can't reach previous stops, and b->b trips make no sense
 							dts_dst = trip[i_dst].dts_arr + fp_delta
-							if dts_dst < t_min:
-								t_min_idx[n] = dts_dst
-								results.add(t.base.QueryResult(dts_dst, n, jtrips, dts_src))
+							if dts_dst < t_min_dst[k]:
+								t_min_idx[k][n] = dts_dst
+								results[k].add(t.base.QueryResult(dts_dst, n, jtrips, dts_src))
 
 					# Check if trip can lead to nondominated journeys, and queue trips reachable from it
 					for i in range(b+1, e+1): # b < i <= e
 						if trip[i].dts_arr >= t_min: break # after +1 transfer, it's guaranteed to be dominated
+						if dst_bounds and trip[i].dts_arr + dst_bounds[trip[i].stop.id] >= t_min: continue
 						for transfer in transfers.from_trip_stop(trip[i]):
-							if transfer.ts_to.dts_arr >= t_min: continue
-							enqueue(transfer.ts_to.trip, transfer.ts_to.stopidx, n+1, jtrips)
+							if stats: stats.transfers_scanned += 1
+							ts = transfer.ts_to
+							if ts.dts_arr >= t_min: continue
+							if dst_bounds and ts.dts_arr + dst_bounds[ts.stop.id] >= t_min: continue
+							enqueue(ts.trip, ts.stopidx, n+1, jtrips)
 
 				n += 1
+				if budget and budget.expired: break
 			Q.clear() # to flush n > max_transfers leftovers there
 
-		return self.jtrips_to_journeys(
-			timetable.footpaths, stop_src, stop_dst, dts_edt, results )
+		if stats: stats.time_add('scan', ts_phase)
+		self.tracer.finish(span)
+		return results
 
 
+	@timer
+	def query_one_to_all(self, stop_src, dts_src, max_transfers=15):
+		'''Earliest-arrival query from stop_src to all stops, returning StopArrivals
+				with best arrival time (and transfer count for it) for every stop.
+			No journeys are constructed or tracked here, unlike in other queries.'''
+		return self._query_one_to_all(stop_src, dts_src, max_transfers)
+
+	def _query_one_to_all(self, stop_src, dts_src, max_transfers):
+		timetable, lines, transfers = self.graph
+		stop_idx, footpaths = self.stop_idx, timetable.footpaths
+		dts_arr = array.array('d', [u.inf]) * len(stop_idx)
+		n_arr = array.array('i', [-1]) * len(stop_idx)
+
+		R = self.query_workspace().reset()
+		Q = R.queue
+
+		def enqueue(trip, i, n):
+			i_max = len(trip) - 1 # for the purposes of "infinity" here
+			i_label = R.label(0, trip, i_max)
+			if i >= i_label: return
+			Q.setdefault(n, list()).append(TripSegment(trip, i, i_label, None))
+			for trip_u in lines.line_for_trip(trip).trips_from(trip):
+				R.label_min(0, trip_u, i)
+
+		def update_arrival(stop, dts, n):
+			k = stop_idx[stop]
+			if dts < dts_arr[k]: dts_arr[k], n_arr[k] = dts, n
+
+		update_arrival(stop_src, dts_src, 0)
+		for stop_q, fp, stop_lines in self.src_seed_index(stop_src):
+			fp_delta = fp.get_shortest(dts_src=dts_src) if fp is not None else 0
+			if fp_delta is None: continue
+			dts_q = dts_src + fp_delta
+			update_arrival(stop_q, dts_q, 0)
+			for i, line in stop_lines:
+				trip = line.earliest_trip(i, dts_q)
+				if trip: enqueue(trip, i, 0)
+
+		n = 0
+		while Q and n < max_transfers:
+			for trip, b, e, jtrips in Q.pop(n):
+				for i in range(b+1, e+1): # b < i <= e
+					ts = trip[i]
+					update_arrival(ts.stop, ts.dts_arr, n)
+					for stop_q, fp in footpaths.to_stops_from(ts.stop):
+						if stop_q == ts.stop: continue
+						fp_delta = fp.get_shortest(dts_src=ts.dts_arr)
+						if fp_delta is not None: update_arrival(stop_q, ts.dts_arr + fp_delta, n)
+					for transfer in transfers.from_trip_stop(ts):
+						enqueue(transfer.ts_to.trip, transfer.ts_to.stopidx, n+1)
+			n += 1
+
+		return t.public.StopArrivals(stop_idx, dts_arr, n_arr)
+
+
+	@timer
+	def query_one_to_all_window(self, stop_src, dts_edt, dts_ldt, step=60, max_transfers=15):
+		'''Earliest-arrival times from stop_src to all stops for departures sampled
+				every "step" seconds from dts_edt to dts_ldt (inclusive), as StopArrivalsWindow,
+				with numpy arrays of sampled departure times and arrival times for these at each stop.
+			Same as running query_one_to_all() for each sample, but done in one
+				latest-to-earliest sweep over departures, same as in query_profile(), reusing
+				trip labels and stop arrival times from later departures for earlier ones.'''
+		import numpy as np
+		timetable, lines, transfers = self.graph
+		stop_idx, footpaths = self.stop_idx, timetable.footpaths
+		dts_samples = np.arange(dts_edt, dts_ldt + 1, step, dtype=np.float64)
+		res = np.empty((len(dts_samples), len(stop_idx)), dtype=np.float64)
+		dts_arr = array.array('d', [u.inf]) * len(stop_idx)
+		dts_arr_np = np.frombuffer(dts_arr, dtype=np.float64)
+		if not len(dts_samples): return t.public.StopArrivalsWindow(stop_idx, dts_samples, res)
+
+		R = self.query_workspace().reset(max_transfers + 1)
+		Q = R.queue
+
+		def enqueue(trip, i, n):
+			i_max = len(trip) - 1 # for the purposes of "infinity" here
+			i_label = R.label(n, trip, i_max)
+			if i >= i_label: return
+			Q.setdefault(n, list()).append(TripSegment(trip, i, i_label, None))
+			for trip_u in lines.line_for_trip(trip).trips_from(trip):
+				for m in range(n, max_transfers): R.label_min(m, trip_u, i)
+
+		def update_arrival(stop, dts):
+			k = stop_idx[stop]
+			if dts < dts_arr[k]: dts_arr[k] = dts
+
+		# Departures after last sample are all queued as one group, with only earliest trips
+		#  from each line, same as in earliest-arrival query, as it'd dominate all later ones.
+		# Earlier departures are grouped by time and processed latest-to-earliest, as in profile query.
+		dts_last, profile_queue = float(dts_samples[-1]), list()
+		for stop_q, fp, stop_lines in self.src_seed_index(stop_src):
+			fp_delta_last = 0 if fp is None else fp.get_shortest(dts_src=dts_last)
+			for i, line in stop_lines:
+				if fp_delta_last is not None:
+					trip = line.earliest_trip(i, dts_last + fp_delta_last)
+					if trip: profile_queue.append(DepartureCriteriaCheck(trip, i, dts_last, None))
+				for trip in line:
+					fp_delta = 0 if fp is None else\
+						fp.get_shortest(dts_src=dts_edt, dts_dst=trip[i].dts_dep)
+					if fp_delta is None: continue
+					dts_max = trip[i].dts_dep - fp_delta
+					if dts_edt <= dts_max < dts_last:
+						profile_queue.append(DepartureCriteriaCheck(trip, i, dts_max, None))
+		profile_queue.sort(key=op.attrgetter('dts_src'), reverse=True) # latest-to-earliest
+		seed_walks = list( (stop_idx[stop_q], fp)
+			for stop_q, fp, stop_lines in self.src_seed_index(stop_src) if fp is not None )
+
+		checks_iter = it.groupby(profile_queue, op.attrgetter('dts_src'))
+		dts_src, checks = next(checks_iter, (None, None))
+		for k_sample in range(len(dts_samples)-1, -1, -1):
+			dts_sample = float(dts_samples[k_sample])
+
+			while dts_src is not None and dts_src >= dts_sample:
+				n = 0
+				for trip, stopidx, dts, jtrips in checks: enqueue(trip, stopidx, n)
+				while Q and n < max_transfers:
+					for trip, b, e, jtrips in Q.pop(n):
+						for i in range(b+1, e+1): # b < i <= e
+							ts = trip[i]
+							update_arrival(ts.stop, ts.dts_arr)
+							for stop_q, fp in footpaths.to_stops_from(ts.stop):
+								if stop_q == ts.stop: continue
+								fp_delta = fp.get_shortest(dts_src=ts.dts_arr)
+								if fp_delta is not None: update_arrival(stop_q, ts.dts_arr + fp_delta)
+							for transfer in transfers.from_trip_stop(ts):
+								enqueue(transfer.ts_to.trip, transfer.ts_to.stopidx, n+1)
+					n += 1
+				Q.clear() # to flush n > max_transfers leftovers there
+				dts_src, checks = next(checks_iter, (None, None))
+
+			# Footpath-only arrivals depend on sample time, so are not stored in dts_arr
+			row = res[k_sample]
+			row[:] = dts_arr_np
+			row[stop_idx[stop_src]] = min(row[stop_idx[stop_src]], dts_sample)
+			for k, fp in seed_walks:
+				fp_delta = fp.get_shortest(dts_src=dts_sample)
+				if fp_delta is not None: row[k] = min(row[k], dts_sample + fp_delta)
+
+		return t.public.StopArrivalsWindow(stop_idx, dts_samples, res)
+
+
+	@timer
+	def query_matrix(self, stops_src, stops_dst, dts_src, path=None, workers=None, max_transfers=15):
+		'''Travel-time matrix from each of stops_src to each of stops_dst,
+				returned as numpy float32 array with [src, dst] shape, or [dts, src, dst]
+				if dts_src is a sequence of departure times (e.g. list, range or numpy array),
+				i.e. anything that is not a single number or string.
+			Values are arrival minus departure times, u.inf for unreachable stops.
+			Runs one query_one_to_all() for each origin and departure time,
+				spread between specified number of forked worker processes (default - cpu count),
+				or in this process only if workers=1 or fork is not supported by platform.
+			If path is specified, result is written to .npy file there incrementally,
+				and returned as numpy.memmap of it, without keeping whole matrix in memory.'''
+		import numpy as np
+		global _query_matrix_state
+		stops_src, stops_dst = list(stops_src), list(stops_dst)
+		dts_multi = not isinstance(dts_src, (numbers.Number, str))
+		dts_list = list(dts_src) if dts_multi else [dts_src]
+		shape = len(dts_list), len(stops_src), len(stops_dst)
+
+		if path: res = np.lib.format.open_memmap(str(path), mode='w+', dtype=np.float32, shape=shape)
+		else: res = np.empty(shape, dtype=np.float32)
+		tasks = list(it.product(range(len(dts_list)), range(len(stops_src))))
+		dst_idx = np.array(list(self.stop_idx[stop] for stop in stops_dst), dtype=np.intp)
+
+		if workers is None: workers = os.cpu_count() or 1
+		if 'fork' not in multiprocessing.get_all_start_methods(): workers = 1
+		workers, pool = min(workers, len(tasks)), None
+		_query_matrix_state = self, stops_src, dts_list, dst_idx, max_transfers
+		try:
+			if workers > 1: # worker pids get engine and query state via fork
+				pool = multiprocessing.get_context('fork').Pool(workers)
+				rows = pool.imap_unordered(_query_matrix_row, tasks, chunksize=4)
+			else: rows = map(_query_matrix_row, tasks)
+			for k_dts, k_src, row in rows: res[k_dts, k_src] = row
+		finally:
+			_query_matrix_state = None
+			if pool:
+				pool.terminate()
+				pool.join()
+
+		if path: res.flush()
+		return res if dts_multi else res[0]
+
+
+	@timer
+	def query_earliest_arrival_batch(self, queries, budget=None, stats=None):
+		'''Run earliest-arrival queries for a list of (stop_src, stop_dst, dts_src) tuples,
+				yielding (n, JourneySet) for each one, where n is the index of query in that list.
+			Queries with same source and departure time are run as one search for
+				all their destinations (see _query_earliest_arrival), and source seeds and
+				trips-to-destination indexes are shared between all searches that use them,
+				see _query_batch_groups() for details.
+			Results are yielded in the order of these groups, not in the original one.
+			budget and stats are same as in query_earliest_arrival(), but for the whole batch.'''
+		footpaths = self.graph.timetable.footpaths
+		for stop_src, (dts_src,), dst_ns, indexes in self._query_batch_groups(queries, 1):
+			stops_dst = list(dst_ns)
+			for stop_dst, results in zip(stops_dst, self._query_earliest_arrival(
+					stop_src, stops_dst, dts_src, budget=budget, stats=stats, **indexes )):
+				journeys = self._query_journeys(
+					footpaths, stop_src, stop_dst, dts_src, results, budget, stats )
+				for n in dst_ns[stop_dst]: yield n, journeys
+
+	@timer
+	def query_profile_batch(self, queries, max_transfers=15, budget=None, stats=None):
+		'''Same as query_earliest_arrival_batch(), but for profile queries,
+				with (stop_src, stop_dst, dts_edt[, dts_ldt]) query tuples.
+			Queries are grouped by same source and departure time interval.'''
+		timetable = self.graph.timetable
+		for stop_src, (dts_edt, dts_ldt), dst_ns, indexes in self._query_batch_groups(queries, 2):
+			if dts_edt is None: dts_edt = timetable.dts_parse('00:00')
+			if dts_ldt is None: dts_ldt = timetable.dts_parse('24:00')
+			stops_dst = list(dst_ns)
+			for stop_dst, results in zip(stops_dst, self._query_profile(
+					stop_src, stops_dst, dts_edt, dts_ldt, max_transfers,
+					budget=budget, stats=stats, **indexes )):
+				journeys = self._query_journeys(
+					timetable.footpaths, stop_src, stop_dst, dts_edt, results, budget, stats )
+				for n in dst_ns[stop_dst]: yield n, journeys
+
+	def _query_batch_groups(self, queries, n_params):
+		'''Group (stop_src, stop_dst, *params) query tuples, padding params with None to n_params,
+				yielding (stop_src, params, {stop_dst: [n, ...]}, indexes) tuple for each group,
+				where indexes is a dict of src_seeds/dst_indexes keywords for query searches.
+			Query indexes are listed for each destination, as same query can be repeated.
+			Groups are ordered by stop_src, so that its seeds are only looked-up once, and
+				trips-to-destination indexes are kept until the last group that needs these,
+				so that each one is only built (or fetched from cache) once for the whole batch.'''
+		groups = OrderedDict() # {stop_src: {params: {stop_dst: [n, ...]}}}
+		for n, (stop_src, stop_dst, *params) in enumerate(queries):
+			params = tuple(params) + (None,) * (n_params - len(params))
+			groups.setdefault(stop_src, OrderedDict()).setdefault(params, OrderedDict())\
+				.setdefault(stop_dst, list()).append(n)
+		dst_refs = Counter( stop_dst for src_groups in groups.values()
+			for dst_ns in src_groups.values() for stop_dst in dst_ns )
+		dst_indexes = dict() # {stop_dst: {trip: (i, fp_delta)}}
+		for stop_src, src_groups in groups.items():
+			src_seeds = self.src_seed_index(stop_src)
+			for params, dst_ns in src_groups.items():
+				for stop_dst in dst_ns:
+					if stop_dst not in dst_indexes: dst_indexes[stop_dst] = self.dst_trips_index(stop_dst)
+				yield stop_src, params, dst_ns, dict( src_seeds=src_seeds,
+					dst_indexes=list(dst_indexes[stop_dst] for stop_dst in dst_ns) )
+				for stop_dst in dst_ns:
+					dst_refs[stop_dst] -= 1
+					if not dst_refs[stop_dst]: del dst_indexes[stop_dst]
+
 	def query_profile_all_to_all(self, max_transfers=15):
 		'Run all-to-all profile query, yielding (stop_src, stop_labels) tuples.'
 		# To avoid duplicating paper-1 algos' weird naming/types here:
@@ -412,13 +1327,12 @@ class TBRoutingEngine:
 		stop_labels = dict() # {stop: ts_list (all TripStops on the way from stop_src to stop)}
 		trip_tails_checked = dict() # {trip: earliest_checked_stopidx}
 
-		def enqueue(trip, i, ts_list, _ss=t.public.SolutionStatus):
+		def enqueue(trip, i, ts_list):
 			'Ensures that each TripStop is only ever processed once via trip_tails_checked index.'
 			n, i_max = len(ts_list), len(trip) - 1
 			if i >= trip_tails_checked.get((n, trip), i_max): return
 			queue.append(TripSegment(trip, i, trip_tails_checked.get((n, trip), i_max), ts_list.copy()))
-			for trip_u in lines.line_for_trip(trip)\
-					.trips_by_relation(trip, _ss.non_dominated, _ss.equal):
+			for trip_u in lines.line_for_trip(trip).trips_from(trip):
 				i_min = min(i, trip_tails_checked.get((n, trip_u), i_max))
 				for m in range(n, max_transfers+1): trip_tails_checked[m, trip_u] = i_min
 
@@ -473,16 +1387,16 @@ class TBRoutingEngine:
 		subtree_stats = Counter()
 
 		progress = self.progress_iter('transfer-patterns', len(timetable.stops))
-		for stop_src, stop_labels in self.query_profile_all_to_all(**query_kws):
-			means = subtree_stats['count']
-			if means == 0: means = [0, 0, 0]
-			else: means = list(int(subtree_stats[k] / means) for k in ['nodes', 'depth', 'dst'])
-			progress.send([
-				'tree-nodes={:,} (unique={:,}),'
-					' subtree means: nodes={:,} depth={:,} breadth/dst-count={:,}',
-				sum(tree.stats.total.values()), len(tree.stats.total) ] + means)
-
-			subtree, subtree_depth = tree[stop_src], list()
+		for n, (stop_src, stop_labels) in enumerate(self.query_profile_all_to_all(**query_kws)):
+			if n >= progress.n_next:
+				means = subtree_stats['count']
+				if means == 0: means = [0, 0, 0]
+				else: means = list(int(subtree_stats[k] / means) for k in ['nodes', 'depth', 'dst'])
+				progress.send( n, 'tree-nodes={:,} (unique={:,}),'
+						' subtree means: nodes={:,} depth={:,} breadth/dst-count={:,}',
+					sum(tree.stats.total.values()), len(tree.stats.total), *means )
+
+			subtree, subtree_depth = tree.subtree(stop_src), list()
 			node_src = subtree.node(stop_src, t='src')
 			for stop_dst, sl_set in stop_labels.items():
 				node_dst = subtree.node(stop_dst)
@@ -497,6 +1411,8 @@ class TBRoutingEngine:
 					subtree_depth.append(depth)
 			subtree_stats.update(dict( count=1, dst=len(stop_labels),
 				depth=u.max(subtree_depth, 0), nodes=tree.stats.prefix[stop_src] ))
+		progress.counts.update(subtree_stats)
+		progress.finish()
 
 		self.log.debug(
 			'Search-tree stats: nodes={0.nodes:,} (unique={0.nodes_unique:,},'
@@ -506,7 +1422,8 @@ class TBRoutingEngine:
 
 	def build_tp_engine(self, tp_tree=None, **tree_opts):
 		if not tp_tree: tp_tree = self.build_tp_tree(**tree_opts)
-		return TBTPRoutingEngine(self.graph, tp_tree, self.conf, timer_func=self.timer_wrapper)
+		return TBTPRoutingEngine( self.graph, tp_tree,
+			self.conf, timer_func=self.timer_wrapper, tracer=self.tracer or None )
 
 
 
@@ -514,9 +1431,12 @@ class TBTPRoutingEngine:
 
 	graph = tree = None
 
-	def __init__(self, graph, tp_tree, conf=None, timer_func=None):
+	def __init__(self, graph, tp_tree, conf=None, timer_func=None, tracer=None):
 		self.conf, self.log = conf or EngineConf(), u.get_logger('tb.tp')
 		self.graph, self.tree = graph, tp_tree
+		if not tracer and isinstance(timer_func, trace.Tracer): tracer = timer_func
+		self.tracer = tracer or trace.null_tracer
+		if not timer_func: timer_func = tracer
 		self.timer_wrapper = timer_func if timer_func else lambda f,*a,**k: f(*a,**k)
 		self.jtrips_to_journeys = ft.partial(self.timer_wrapper, jtrips_to_journeys)
 
@@ -550,10 +1470,17 @@ class TBTPRoutingEngine:
 		return query_tree if qt_stats.nodes > 0 else None
 
 	@timer
-	def query_profile(self, stop_src, stop_dst, dts_edt, dts_ldt, query_tree=..., max_transfers=15):
+	def query_profile( self, stop_src, stop_dst, dts_edt, dts_ldt,
+			query_tree=..., max_transfers=15, stats=None ):
+		'''Profile query on query tree built from TP tree, same as TBRoutingEngine.query_profile().
+			Optional QueryStats object can be passed, where query tree nodes are counted as
+				segments, trip labels for these as segments_enqueued, and dominated ones as labels_rejected.
+			There are no per-transfer-count rounds in this search, so these are not counted.'''
 		timetable, lines, transfers = self.graph
+		if stats: ts_phase = time.monotonic()
 		if query_tree is ...: query_tree = self.build_query_tree(stop_src, stop_dst)
 		if not query_tree: return list()
+		span = self.tracer.start('tp.seed')
 
 		NodeLabel = namedtuple('NodeLabel', 'dts_start ts n journey')
 		NodeLabelCheck = namedtuple('NodeLabelChk', 'node label')
@@ -581,10 +1508,16 @@ class TBTPRoutingEngine:
 				if not (dts_edt <= dts_max and dts_ldt >= dts_min): continue
 				prio_queue.push(NodeLabelCheck(
 					node, NodeLabel(min(dts_ldt, dts_max), ts, 0, [trip]) ))
+		if stats:
+			stats.seeds += len(prio_queue)
+			ts_phase = stats.time_add('seed', ts_phase)
+		self.tracer.finish(span)
+		span = self.tracer.start('tp.scan')
 
 		# Main loop
 		while prio_queue:
 			node_src, label_src = prio_queue.pop()
+			if stats: stats.segments += 1
 
 			for node in node_src.edges_to:
 				if node.value != stop_dst:
@@ -608,15 +1541,117 @@ class TBTPRoutingEngine:
 						for transfer in transfers.from_trip_stop(ts)
 						if transfer.ts_to.stopidx == ls_stopidx
 							and lines.line_for_trip(transfer.ts_to.trip) == ls_line )
+					if stats: stats.transfers_scanned += len(node_transfers)
 					if node_transfers:
 						transfer = min(node_transfers, key=op.attrgetter('ts_to.dts_arr'))
 						node_label = NodeLabel( label_src.dts_start,
 							transfer.ts_to, label_src.n+1, label_src.journey + [transfer.ts_to.trip] )
 					else: node_label = None # only possible for other trips of node_src
 
-				if node_label and node_labels[node].add(node_label):
+				if not node_label: continue
+				if node_labels[node].add(node_label):
+					if stats: stats.segments_enqueued += 1
 					prio_queue.push(NodeLabelCheck(node, node_label))
+				elif stats: stats.labels_rejected += 1
 
 		for label in node_labels[query_tree[stop_dst]]:
 			results.add(t.base.QueryResult(label.ts.dts_arr, label.n, label.journey, label.dts_start))
-		return self.jtrips_to_journeys(timetable.footpaths, stop_src, stop_dst, dts_edt, results)
+		self.tracer.finish(span)
+		if stats:
+			ts0 = stats.time_add('scan', ts_phase)
+			stats.queries, stats.results = stats.queries + 1, stats.results + len(results)
+		journeys = self.jtrips_to_journeys(timetable.footpaths, stop_src, stop_dst, dts_edt, results)
+		if stats:
+			stats.time_add('journeys', ts0)
+			stats.journeys += len(journeys)
+		return journeys
+
+
+class QueryResultCache:
+	'''LRU cache of query results in front of TBRoutingEngine or TBTPRoutingEngine,
+			with query_* methods same as in these, and all other attributes proxied to router.
+		Profile query windows are extended to start at the beginning of bucket-seconds
+			time bucket, and cached results for the same window end and other parameters are
+			then used for any query starting later than that, filtered by departure time.
+			Narrowing window end can't be done in same way, as journeys departing after it can
+			dominate ones before it, so it's always part of the key, same as exact time
+			for earliest-arrival and latest-departure queries.
+		All entries are dropped when router graph (or TP tree) gets replaced,
+			or its version attribute gets bumped after any changes to it.
+		Partial results (see QueryBudget) are never cached.
+		Thread-safe, with version checks and stats updated under a lock,
+			but same query can be run concurrently by multiple threads on a cache miss.'''
+
+	def __init__(self, router, size=1024, bucket=15*60):
+		self.router, self.bucket = router, bucket
+		self.cache, self.cache_version = u.LRUCache(size), None
+		self.stats = Counter() # hits, misses, invalidations
+		self.lock = threading.Lock()
+
+	def __getattr__(self, k): return getattr(self.router, k)
+
+	def _check_version(self):
+		graph, tree = self.router.graph, getattr(self.router, 'tree', None)
+		with self.lock:
+			if self.cache_version:
+				graph_chk, version_chk, tree_chk = self.cache_version
+				if graph is graph_chk and graph.version == version_chk and tree is tree_chk: return
+				self.stats['invalidations'] += 1
+			self.cache.clear()
+			self.cache_version = graph, graph.version, tree
+
+	def _stat(self, k):
+		with self.lock: self.stats[k] += 1
+
+	def _cache_key(self, *key, query_kws):
+		key += tuple(sorted((k, v) for k, v in query_kws.items() if k not in ['budget', 'stats']))
+		try: hash(key)
+		except TypeError: return # e.g. unhashable query_tree, can't be cached
+		self._check_version()
+		return key
+
+	def _query(self, query_func, key, *query_args, **query_kws):
+		journeys = self.cache.get(key) if key else None
+		if journeys is None:
+			self._stat('misses')
+			journeys = query_func(*query_args, **query_kws)
+			if not isinstance(journeys, t.public.JourneySet): # e.g. empty list from TP engine
+				journeys = t.public.JourneySet(set(journeys))
+			if key and not journeys.partial: self.cache.set(key, journeys)
+		else: self._stat('hits')
+		return t.public.JourneySet(set(journeys), journeys.partial)
+
+	def query_earliest_arrival(self, stop_src, stop_dst, dts_src, **query_kws):
+		key = self._cache_key('ea', stop_src, stop_dst, dts_src, query_kws=query_kws)
+		return self._query( self.router.query_earliest_arrival,
+			key, stop_src, stop_dst, dts_src, **query_kws )
+
+	def query_latest_departure(self, stop_src, stop_dst, dts_arr_max, **query_kws):
+		key = self._cache_key('ld', stop_src, stop_dst, dts_arr_max, query_kws=query_kws)
+		return self._query( self.router.query_latest_departure,
+			key, stop_src, stop_dst, dts_arr_max, **query_kws )
+
+	def query_profile(self, stop_src, stop_dst, dts_edt=None, dts_ldt=None, **query_kws):
+		timetable = self.router.graph.timetable # same defaults as in router, to share entries
+		if dts_edt is None: dts_edt = timetable.dts_parse('00:00')
+		if dts_ldt is None: dts_ldt = timetable.dts_parse('24:00')
+		key = self._cache_key('profile', stop_src, stop_dst, dts_ldt, query_kws=query_kws)
+		if not key: return self.router.query_profile(stop_src, stop_dst, dts_edt, dts_ldt, **query_kws)
+		entry = self.cache.get(key)
+		if entry and entry[0] <= dts_edt: self._stat('hits')
+		else:
+			self._stat('misses')
+			dts_start = min(dts_edt, dts_edt // self.bucket * self.bucket) if self.bucket else dts_edt
+			journeys = self.router.query_profile(stop_src, stop_dst, dts_start, dts_ldt, **query_kws)
+			if not isinstance(journeys, t.public.JourneySet): journeys = t.public.JourneySet(set(journeys))
+			if journeys.partial: return journeys
+			entry = dts_start, journeys
+			self.cache.set(key, entry)
+		dts_start, journeys = entry
+		if dts_start == dts_edt: return t.public.JourneySet(set(journeys))
+		journeys_filtered = t.public.JourneySet()
+		for jn in journeys:
+			if not jn.trip_count: jn = type(jn)(dts_edt, list(jn.segments)) # footpath-only
+			elif jn.dts_dep < dts_edt: continue
+			journeys_filtered.add(jn)
+		return journeys_filtered
@@ -1,11 +1,11 @@
 import itertools as it, operator as op, functools as ft
 from collections import namedtuple, defaultdict, OrderedDict
-import os, sys, re, csv, math, datetime, enum
+import os, sys, re, csv, datetime, enum
 
 try: import pytz
 except ImportError: pytz = None
 
-from . import utils as u, types as t
+from . import utils as u, types as t, trace
 
 
 log = u.get_logger('gtfs')
@@ -195,22 +195,20 @@ def calculate_trip_dts(dt_min, dt, offset_arr, offset_dep):
 	assert offset_arr and offset_dep
 	return tuple(offset_to_dts(dt_min, dt, o) for o in [offset_arr, offset_dep])
 
-def footpath_dt(stop_a, stop_b, delta_base, speed_kmh, math=math):
+def footpath_dt(stop_a, stop_b, delta_base, speed_kmh):
 	'''Calculate footpath time-delta (dt) between two stops,
 		based on their lon/lat distance (using Haversine Formula) and walking-speed constant.'''
 	# Alternative: use UTM coordinates and KDTree (e.g. scipy) or spatial dbs
-	lon1, lat1, lon2, lat2 = (
-		math.radians(float(v)) for v in
-		[stop_a.lon, stop_a.lat, stop_b.lon, stop_b.lat] )
-	km = 6367 * 2 * math.asin(math.sqrt(
-		math.sin((lat2 - lat1)/2)**2 +
-		math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1)/2)**2 ))
+	km = u.haversine_km(stop_a.lon, stop_a.lat, stop_b.lon, stop_b.lat)
 	return delta_base + km / speed_kmh
 
 
-def parse_timetable(gtfs_dir, conf):
-	'Parse Timetable from GTFS data directory.'
+def parse_timetable(gtfs_dir, conf, tracer=None):
+	'''Parse Timetable from GTFS data directory.
+		Optional trace.Tracer can be passed to record timing spans for each parsing step.'''
 	# Stops/footpaths that don't belong to trips are discarded here
+	tracer = tracer or trace.null_tracer
+	span = tracer.start('gtfs.calendar')
 
 	### Calculate processing timespan / calendar and map of services operating there
 	if conf.parse_start_date:
@@ -226,8 +224,10 @@ def parse_timetable(gtfs_dir, conf):
 		timespan_info = get_timespan_info( svc_calendar, svc_exceptions,
 			conf.parse_start_date, conf.parse_days, conf.parse_days_pre, conf.gtfs_timezone )
 	else: timespan_info = t.public.TimespanInfo()
+	tracer.finish(span)
 
 	### Stops (incl. grouping by station)
+	span = tracer.start('gtfs.stops')
 	stop_dict, stop_sets = dict(), dict() # {id: stop}, {id: station_stops}
 	for s in iter_gtfs_tuples(gtfs_dir, 'stops'):
 		stop = t.public.Stop(s.stop_id, s.stop_name, float(s.stop_lon), float(s.stop_lat))
@@ -243,8 +243,10 @@ def parse_timetable(gtfs_dir, conf):
 	stop_dict, stop_sets = (
 		dict((k, stop) for k, (k_set, stop) in stop_dict.items()),
 		dict((k, stop_sets[k_set]) for k, (k_set, stop) in stop_dict.items()) )
+	tracer.finish(span)
 
 	### Trips
+	span = tracer.start('gtfs.trips')
 	trip_stops = defaultdict(list)
 	for s in iter_gtfs_tuples(gtfs_dir, 'stop_times'): trip_stops[s.trip_id].append(s)
 
@@ -266,8 +268,10 @@ def parse_timetable(gtfs_dir, conf):
 				stop = stops.add(stop_dict[ts.stop_id])
 				trip.add(t.public.TripStop(trip, stopidx, stop, dts_arr, dts_dep))
 			if trip: trips.add(trip)
+	tracer.finish(span)
 
 	### Footpaths
+	span = tracer.start('gtfs.footpaths')
 	footpaths, fp_samestop_count, fp_synth = t.public.Footpaths(), 0, False
 	with footpaths.populate() as fp_add:
 		get_stop_set = lambda stop_id: list(filter(stops.get, stop_sets.get(stop_id, list())))
@@ -326,5 +330,6 @@ def parse_timetable(gtfs_dir, conf):
 					if footpaths.connected(stop, stop): continue
 					fp_add(stop, stop, conf.delta_ch)
 					fp_samestop_count += 1
+	tracer.finish(span)
 
 	return t.public.Timetable(stops, footpaths, trips, timespan_info)
@@ -0,0 +1,85 @@
+'Memory usage breakdown for Timetable, Graph and TPTree structures.'
+
+import itertools as it, operator as op, functools as ft
+from collections import namedtuple, OrderedDict
+import os, sys, gc, types
+
+
+# Objects shared by everything (classes, functions, modules) are not part of any structure
+deep_sizeof_skip_types = type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType
+
+def deep_sizeof(roots, seen=None, skip=frozenset()):
+	'''Returns (object_count, size_bytes) for all objects reachable from roots (via gc.get_referents),
+			excluding ones with id() in seen set, which is updated with all walked objects.
+		skip set can have id() values of objects that should not be walked into,
+			e.g. ones that belong to other structures, which will then be counted there.'''
+	if seen is None: seen = set()
+	count = size = 0
+	queue = list(roots)
+	while queue:
+		obj = queue.pop()
+		k = id(obj)
+		if k in seen or isinstance(obj, deep_sizeof_skip_types): continue
+		seen.add(k)
+		count, size = count + 1, size + sys.getsizeof(obj)
+		queue.extend(o for o in gc.get_referents(obj) if id(o) not in skip)
+	return count, size
+
+
+MemoryStats = namedtuple('MemoryStats', 'name objects bytes units unit bytes_per_unit')
+
+def memory_stats(timetable, graph=None, tp_tree=None):
+	'''Returns list of MemoryStats tuples with object counts and deep sizes (in bytes) for
+			timetable (stops, trips, footpaths), graph (lines, transfer sets, lower bounds) and TP tree,
+			along with average size per unit for each one (e.g. per stop event or per transfer).
+		Each object is only counted once, in the first structure it is reachable from,
+			with Stop, Trip and TripStop objects only counted in stops/trips structures.'''
+	stop_ids = set(map(id, timetable.stops))
+	trip_ids = set(map(id, timetable.trips))
+	trip_ids.update(id(ts) for trip in timetable.trips for ts in trip)
+	entity_ids, seen, stats = stop_ids | trip_ids, set(), list()
+
+	def stats_add(name, root, units, unit, skip=entity_ids):
+		if root is None: return
+		objects, size = deep_sizeof([root], seen, skip)
+		stats.append(MemoryStats(name, objects, size, units, unit, size / units if units else None))
+
+	stats_add('stops', timetable.stops, len(timetable.stops), 'stop', trip_ids)
+	stats_add( 'trips', timetable.trips,
+		sum(map(len, timetable.trips)), 'stop-event', stop_ids )
+	stats_add('footpaths', timetable.footpaths, len(timetable.footpaths), 'footpath')
+	if graph:
+		stats_add('lines', graph.lines, len(graph.lines), 'line')
+		stats_add('transfers', graph.transfers, len(graph.transfers), 'transfer')
+		if graph.transfers_rev:
+			stats_add('transfers-rev', graph.transfers_rev, len(graph.transfers_rev), 'transfer')
+		if graph.lower_bounds:
+			stats_add( 'lower-bounds', graph.lower_bounds,
+				graph.lower_bounds.cluster_count, 'cluster' )
+	if tp_tree: stats_add('tp-tree', tp_tree, tp_tree.stat_counts().nodes, 'tp-node')
+	return stats
+
+def process_memory(pid=None):
+	'''Returns OrderedDict of rss, pss, shared and private memory of process (in MiB)
+			from linux /proc/<pid>/smaps_rollup, or None if it is not available.
+		pss (proportional set size) splits shared pages between processes that use them,
+			so is the most meaningful value to sum for forked processes sharing same data.'''
+	try:
+		with open('/proc/{}/smaps_rollup'.format(pid or os.getpid())) as src:
+			kbs = dict((k, int(v.split()[0])) for k, sep, v in (
+				line.partition(':') for line in src ) if v.strip().endswith('kB'))
+	except OSError: return
+	return OrderedDict((k, round(sum(kbs.get(n, 0) for n in names) / 2**10, 1)) for k, names in [
+		('rss', ['Rss']), ('pss', ['Pss']), ('shared', ['Shared_Clean', 'Shared_Dirty']),
+		('private', ['Private_Clean', 'Private_Dirty']) ])
+
+def memory_stats_print(stats, file=sys.stdout):
+	'Print table of MemoryStats tuples, as returned by memory_stats().'
+	p = ft.partial(print, file=file)
+	p('{:<14} {:>12} {:>14} {:>12} {:>20}'.format(
+		'structure', 'objects', 'bytes', 'units', 'bytes/unit' ))
+	for s in stats:
+		p('{0.name:<14} {0.objects:>12,d} {0.bytes:>14,d} {0.units:>12,d} {1:>20}'.format(
+			s, '{:,.1f} /{}'.format(s.bytes_per_unit, s.unit) if s.bytes_per_unit is not None else '-' ))
+	p('{:<14} {:>12,d} {:>14,d}'.format( 'total',
+		sum(map(op.attrgetter('objects'), stats)), sum(map(op.attrgetter('bytes'), stats)) ))
@@ -0,0 +1,275 @@
+'''Long-running query server with a warm graph, answering queries over HTTP/JSON.
+	Listens on TCP and/or unix socket, running searches in a pool of worker
+		processes (forked after graph is loaded), so that event loop is never blocked by them.'''
+
+import itertools as it, operator as op, functools as ft
+from collections import OrderedDict, Counter
+from urllib.parse import urlsplit, parse_qsl
+import os, gc, time, json, signal, asyncio, threading, multiprocessing, concurrent.futures
+
+from . import utils as u, types as t, engine, memory
+
+
+@u.attr_struct(vals_to_attrs=True)
+class ServerConf:
+	host = '127.0.0.1'
+	port = 8080 # None or 0 to disable tcp listener
+	unix_socket = None # path to unix socket to listen on
+	workers = None # number of query processes, None - cpu count, 0 - use threads in main process
+	pack_graph = True # use PackedTransferSet and gc.freeze() to share transfers with forked workers
+	max_request_size = 2**20
+	max_transfers = 15 # default for profile queries
+	query_timeout = None # QueryBudget timeout for each query, in seconds
+	cache_size = 0 # max number of results to keep in engine.QueryResultCache in each worker, 0 - disabled
+	cache_bucket = 15 * 60 # time bucket size (seconds) for profile queries in cache
+
+
+class QueryError(Exception): pass
+
+def journeys_dicts(journeys, timetable):
+	'Returns list of JSON-serializable dicts for JourneySet, ordered by departure/arrival time.'
+	fmt, jns = timetable.dts_format, list()
+	for jn in sorted(journeys, key=op.attrgetter('dts_dep', 'dts_arr', 'dts_start', 'id')):
+		segs = list()
+		for seg in jn.segments:
+			if isinstance(seg, t.public.JourneyTrip):
+				segs.append(OrderedDict([ ('trip', seg.ts_from.trip.id),
+					('line', seg.ts_from.trip.line_id_hint), ('from', seg.ts_from.stop.id),
+					('to', seg.ts_to.stop.id), ('dep', fmt(seg.ts_from.dts_dep)), ('arr', fmt(seg.ts_to.dts_arr)) ]))
+			elif isinstance(seg, t.public.JourneyFp):
+				segs.append(OrderedDict([ ('footpath', seg.delta),
+					('from', seg.stop_from.id), ('to', seg.stop_to.id) ]))
+		jns.append(OrderedDict([ ('dep', fmt(jn.dts_dep)), ('arr', fmt(jn.dts_arr)),
+			('duration', jn.dts_arr - jn.dts_dep), ('trips', jn.trip_count), ('segments', segs) ]))
+	return jns
+
+def journeys_compact(journeys, timetable):
+	'''Returns JourneySet.compact() lists, with times in seconds from the start of the timetable day.
+		run_query() uses compact=True queries with it, to build these directly from query results.'''
+	return journeys.compact(timetable.timespan.dts_start)
+
+journey_formats = dict(json=journeys_dicts, compact=journeys_compact)
+
+def run_query(router, params, conf, journeys_func=journeys_dicts):
+	'''Run query for params dict and return JSON-serializable result dict, with
+			"search_time" in it being the time spent in the search itself, excluding any overhead.
+		params keys: type (ea, ld or profile), src, dst, dts, dts_end (profile only),
+			max_transfers (profile only), timeout. Same as WorkloadQuery fields, where these match.
+			Optional "format" key can be "json" or "compact" (see journey_formats) to override journeys_func.
+		conf can be any object with max_transfers and query_timeout defaults, e.g. ServerConf.
+		journeys_func(journeys, timetable) is used to convert resulting JourneySet to JSON.
+		Raises QueryError for any invalid parameters.'''
+	timetable = router.graph.timetable
+	try:
+		qt = params.get('type', 'ea')
+		if params.get('format'):
+			try: journeys_func = journey_formats[params['format']]
+			except KeyError: raise QueryError('Unknown journey format: {!r}'.format(params['format']))
+		src, dst = (timetable.stops[str(params[k])] for k in ['src', 'dst'])
+		dts = timetable.dts_parse(str(params['dts']))
+		dts_end = params.get('dts_end')
+		dts_end = timetable.dts_parse(str(dts_end)) if dts_end else None
+		max_transfers = int(params.get('max_transfers') or conf.max_transfers)
+		timeout = params.get('timeout') or conf.query_timeout
+		budget = engine.QueryBudget(float(timeout)) if timeout else None
+	except KeyError as err: raise QueryError('Missing parameter or unknown stop: {}'.format(err))
+	except ValueError as err: raise QueryError('Invalid parameter value: {}'.format(err))
+	query_kws = dict(budget=budget, compact=journeys_func is journeys_compact)
+	ts0 = time.monotonic()
+	if qt == 'ea': journeys = router.query_earliest_arrival(src, dst, dts, **query_kws)
+	elif qt == 'ld': journeys = router.query_latest_departure(src, dst, dts, **query_kws)
+	elif qt == 'profile':
+		journeys = router.query_profile( src, dst, dts,
+			dts_end, max_transfers=max_transfers, **query_kws )
+	else: raise QueryError('Unknown query type: {!r}'.format(qt))
+	search_time = time.monotonic() - ts0
+	return OrderedDict([ ('type', qt), ('search_time', search_time),
+		('partial', journeys.partial), ('journeys', journeys_func(journeys, timetable)) ])
+
+def prepare_fork(router):
+	'''Prepare router for forking processes that will share transfer sets in memory.
+		Only transfer sets are converted to array-based PackedTransferSets (unless loaded as such),
+			which have no per-transfer python objects, so their memory pages stay shared.
+		All objects are also moved to gc permanent generation, so that gc passes in forked
+			processes don't write to them, but python objects in timetable and lines
+			(stops, trips, trip stop times) still get their pages copied in each process
+			when accessed there, due to refcount updates.'''
+	router.graph.pack()
+	gc.collect()
+	if hasattr(gc, 'freeze'): gc.freeze() # python 3.7+
+
+
+_worker_state = None # (router, conf) tuple, inherited by forked worker processes
+
+def _worker_init():
+	# Shutdown is handled by the main process, which gets same SIGINT from terminal
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _worker_run_query(params):
+	'Returns (result, error) tuple, to avoid passing exceptions between processes.'
+	router, conf = _worker_state
+	try: return run_query(router, params, conf), None
+	except QueryError as err: return None, str(err)
+
+
+class QueryServer:
+
+	http_status = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+		500: 'Internal Server Error'}
+
+	def __init__(self, router, conf=None):
+		self.router, self.conf = router, conf or ServerConf()
+		if self.conf.cache_size:
+			self.router = engine.QueryResultCache(router, self.conf.cache_size, self.conf.cache_bucket)
+		self.log, self.stats, self.pool = u.get_logger('tb.server'), Counter(), None
+		self.ts_start, self.loop, self.stop_event = time.monotonic(), None, None
+		self.conns = dict() # {writer: handler task} for open connections
+
+	def start_pool(self):
+		'''Fork worker processes with a copy of router. Must be done before starting event loop.
+			With conf.pack_graph, prepare_fork() is used to share graph memory between workers.'''
+		global _worker_state
+		_worker_state = self.router, self.conf
+		workers = self.conf.workers
+		if workers == 0: self.pool = concurrent.futures.ThreadPoolExecutor(4)
+		else:
+			if workers is None: workers = os.cpu_count() or 1
+			if self.conf.pack_graph: prepare_fork(self.router)
+			self.pool = concurrent.futures.ProcessPoolExecutor(
+				workers, mp_context=multiprocessing.get_context('fork'), initializer=_worker_init )
+			# Start all workers right away, instead of forking these from event loop on demand
+			for f in list(self.pool.submit(time.sleep, 0) for n in range(workers)): f.result()
+		self.log.debug('Started query worker pool: {}', self.pool)
+
+	def status(self):
+		timetable, lines, transfers = self.router.graph
+		return OrderedDict([ ('status', 'ok'), ('uptime', time.monotonic() - self.ts_start),
+			('stops', len(timetable.stops)), ('trips', len(timetable.trips)),
+			('transfers', len(transfers)), ('workers', self.conf.workers),
+			('memory', self.memory()), ('stats', dict(self.stats)),
+			('cache', dict(self.router.stats) # not available from worker processes
+				if self.conf.workers == 0 and self.conf.cache_size else None) ])
+
+	def memory(self):
+		'Returns {pid: memory.process_memory()} for this process and all forked workers, if available.'
+		pids = [os.getpid()] + sorted(p.pid for p in multiprocessing.active_children())
+		return OrderedDict((pid, memory.process_memory(pid)) for pid in pids)
+
+	async def query(self, params):
+		self.stats['queries'] += 1
+		ts0 = time.monotonic()
+		res, err = await asyncio.get_event_loop().run_in_executor(self.pool, _worker_run_query, params)
+		if err:
+			self.stats['errors'] += 1
+			return 400, dict(error=err)
+		self.stats['search_time'] += res['search_time']
+		self.log.debug( 'Query {} {}->{}: search={:.3f}s total={:.3f}s journeys={}',
+			res['type'], params.get('src'), params.get('dst'),
+			res['search_time'], time.monotonic() - ts0, len(res['journeys']) )
+		return 200, res
+
+	async def dispatch(self, method, path, body):
+		url = urlsplit(path)
+		if url.path == '/status': return 200, self.status()
+		if url.path != '/query': return 404, dict(error='Not found: {}'.format(url.path))
+		if method == 'GET': params = dict(parse_qsl(url.query))
+		elif method == 'POST':
+			try: params = json.loads(body.decode())
+			except ValueError as err: return 400, dict(error='Invalid JSON: {}'.format(err))
+			if not isinstance(params, dict): return 400, dict(error='Query must be a JSON object')
+		else: return 405, dict(error='Method not allowed: {}'.format(method))
+		return await self.query(params)
+
+	async def read_request(self, reader):
+		'Returns (method, path, headers, body) tuple or None on closed connection.'
+		line = await reader.readline()
+		if not line: return
+		try: method, path, proto = line.decode('latin-1').split()
+		except ValueError: raise QueryError('Malformed HTTP request line')
+		headers = dict()
+		while True:
+			line = await reader.readline()
+			if not line.strip(): break
+			k, sep, v = line.decode('latin-1').partition(':')
+			headers[k.strip().lower()] = v.strip()
+		try: body_len = int(headers.get('content-length') or 0)
+		except ValueError: raise QueryError('Invalid Content-Length header')
+		if body_len > self.conf.max_request_size: raise QueryError('Request is too large')
+		body = await reader.readexactly(body_len) if body_len else b''
+		if proto == 'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive':
+			headers['connection'] = 'close'
+		return method, path, headers, body
+
+	def write_response(self, writer, status, data, keep_alive=True):
+		body = json.dumps(data).encode()
+		writer.write('\r\n'.join([ 'HTTP/1.1 {} {}'.format(status, self.http_status[status]),
+			'Content-Type: application/json', 'Content-Length: {}'.format(len(body)),
+			'Connection: {}'.format('keep-alive' if keep_alive else 'close'), '', '' ]).encode() + body)
+
+	async def handle(self, reader, writer):
+		self.conns[writer] = asyncio.current_task()
+		try:
+			while True:
+				try: req = await self.read_request(reader)
+				except QueryError as err:
+					self.write_response(writer, 400, dict(error=str(err)), keep_alive=False)
+					break
+				if not req: break
+				method, path, headers, body = req
+				try: status, data = await self.dispatch(method, path, body)
+				except Exception as err:
+					self.log.exception('Failed to process request: {} {}', method, path)
+					status, data = 500, dict(error='{}: {}'.format(err.__class__.__name__, err))
+				keep_alive = headers.get('connection', '').lower() != 'close'
+				self.write_response(writer, status, data, keep_alive)
+				await writer.drain()
+				if not keep_alive: break
+		except (ConnectionError, asyncio.IncompleteReadError): pass
+		finally:
+			writer.close()
+			self.conns.pop(writer, None)
+
+	async def serve(self, ready_callback=None):
+		'''Listen on configured tcp/unix sockets until stop() call,
+				SIGINT/SIGTERM (when ran in main thread) or cancelled.
+			ready_callback(server, asyncio_servers) is called when listening sockets are ready.'''
+		servers, conf = list(), self.conf
+		if conf.port:
+			servers.append(await asyncio.start_server(self.handle, conf.host, conf.port))
+		if conf.unix_socket:
+			servers.append(await asyncio.start_unix_server(self.handle, conf.unix_socket))
+		if not servers: raise ValueError('Neither tcp port nor unix socket path are specified')
+		for server in servers:
+			for sock in server.sockets: self.log.info('Listening on: {}', sock.getsockname())
+		self.loop, self.stop_event = asyncio.get_event_loop(), asyncio.Event()
+		signals = list()
+		if threading.current_thread() is threading.main_thread():
+			signals = signal.SIGINT, signal.SIGTERM
+		for sig in signals: self.loop.add_signal_handler(sig, self.stop_event.set)
+		if ready_callback: ready_callback(self, servers)
+		try: await self.stop_event.wait()
+		finally:
+			for sig in signals: self.loop.remove_signal_handler(sig)
+			for server in servers: server.close()
+			# Idle keep-alive connections are closed, so that their handlers exit on EOF
+			tasks = list(self.conns.values())
+			for writer in list(self.conns): writer.close()
+			if tasks: await asyncio.wait(tasks, timeout=10)
+			for server in servers: await server.wait_closed()
+			if conf.unix_socket:
+				try: os.unlink(conf.unix_socket)
+				except OSError: pass
+
+	def stop(self):
+		'Stop serve() loop, can be called from any thread.'
+		self.loop.call_soon_threadsafe(self.stop_event.set)
+
+	def run(self, ready_callback=None):
+		if not self.pool: self.start_pool()
+		try: asyncio.run(self.serve(ready_callback))
+		finally: self.pool.shutdown()
+
+
+def serve(router, conf=None):
+	'Run QueryServer for router until SIGINT/SIGTERM.'
+	QueryServer(router, conf).run()
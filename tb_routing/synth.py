@@ -0,0 +1,221 @@
+'Synthetic transit network generation, e.g. for tests and benchmarks.'
+
+import itertools as it, operator as op, functools as ft
+from collections import defaultdict
+from pathlib import Path
+import math, random, csv
+
+from . import utils as u, types as t
+
+
+@u.attr_struct(vals_to_attrs=True)
+class SynthConf:
+	'''Parameters for generate_timetable(), with defaults for city-like
+		networks, i.e. distances in km and not json-dgc graph units.'''
+	layout = 'grid' # "grid", "radial" (rings/spokes) or "random" (random geometric graph)
+	stop_count = 1000
+	stop_spacing_km = 0.4 # distance between neighbor stops
+	stop_neighbors = 4 # number of nearest stops to connect each one to in "random" layout
+	line_count = 100 # each line is generated with trips in both directions
+	line_stops = 8, 25 # min, max
+	center_lon_lat = 13.4, 52.5 # coordinates for center of the generated network
+
+	# All time values are in minutes
+	line_trip_max_count = 200
+	line_trip_interval = 5, 30, 5 # min, max, step
+	line_stop_linger = 0, 1, 1
+	line_kmh = 20, 40, 5
+	fp_kmh = 5
+	fp_dt_base = 2
+	fp_dt_max = 8
+	dt_ch = 2
+
+
+rand_int_align = lambda a,b,step,rng=random: rng.randint(a//step, b//step)*step
+
+def line_dts_start_end(rng=random):
+	'Returns (start, end) random day-time values for line service, e.g. 05:30-23:00.'
+	rand_int = rng.randint
+	if rng.random() < 0.7:
+		line_dts_start, line_dts_end = rand_int(0, 10), rand_int(18, 24)
+	elif rng.random() < 0.5:
+		line_dts_start = rand_int(5, 17)
+		line_dts_end = rand_int(line_dts_start, 23)
+		while line_dts_end - line_dts_start < 2:
+			line_dts_start = rand_int(5, line_dts_end)
+	else:
+		line_dts_start, line_dts_end = rand_int(12, 18), rand_int(20, 24)
+	line_dts_start = 3600 * line_dts_start + rand_int_align(0, 55, 5, rng)*60
+	line_dts_end = 3600 * line_dts_end
+	return line_dts_start, line_dts_end
+
+
+dist_km = lambda points, a, b: math.hypot(points[a][0] - points[b][0], points[a][1] - points[b][1])
+
+
+class GridIndex:
+	'Grid buckets for (x, y) points in km, for neighbor lookups.'
+
+	def __init__(self, points, cell_km):
+		self.points, self.cell_km, self.cells = points, cell_km, defaultdict(list)
+		for n, (x, y) in enumerate(points): self.cells[self.cell(x, y)].append(n)
+
+	def cell(self, x, y): return math.floor(x / self.cell_km), math.floor(y / self.cell_km)
+
+	def near(self, n, radius_km):
+		'Yields (km, m) for all points m within radius_km of point n.'
+		(x, y), r = self.points[n], math.ceil(radius_km / self.cell_km)
+		cx, cy = self.cell(x, y)
+		for ox, oy in it.product(range(-r, r+1), repeat=2):
+			for m in self.cells.get((cx + ox, cy + oy), list()):
+				km = dist_km(self.points, n, m)
+				if km <= radius_km and m != n: yield km, m
+
+
+def stop_layout(conf, rng):
+	'''Returns (points, neighbors) tuple for conf.layout, where points is a list
+		of (x, y) stop coordinates in km, and neighbors is a list of sets of connected stop numbers.'''
+	s, count = conf.stop_spacing_km, conf.stop_count
+	points, neighbors = list(), list(set() for n in range(count))
+	jitter = lambda: rng.uniform(-s/4, s/4)
+
+	if conf.layout == 'grid':
+		side = math.ceil(count**0.5)
+		for n in range(count):
+			points.append(((n % side) * s + jitter(), (n // side) * s + jitter()))
+			if n % side: neighbors[n].add(n - 1)
+			if n >= side: neighbors[n].add(n - side)
+
+	elif conf.layout == 'radial':
+		# Ring k has 6*k stops, each connected to ones next to it and nearest stop on ring k-1
+		points.append((0, 0))
+		ring_prev, k = [0], 1
+		while len(points) < count:
+			ring = list(range(len(points), min(count, len(points) + 6*k)))
+			offset = rng.uniform(0, 2 * math.pi)
+			for n in ring:
+				a = offset + 2 * math.pi * (n - ring[0]) / (6*k)
+				points.append((k * s * math.cos(a) + jitter(), k * s * math.sin(a) + jitter()))
+			for n in ring:
+				if n != ring[0]: neighbors[n].add(n - 1)
+				neighbors[n].add(min(ring_prev, key=ft.partial(dist_km, points, n)))
+			if len(ring) == 6*k and len(ring) > 2: neighbors[ring[0]].add(ring[-1])
+			ring_prev, k = ring, k + 1
+
+	elif conf.layout == 'random':
+		side = s * count**0.5
+		points.extend((rng.uniform(0, side), rng.uniform(0, side)) for n in range(count))
+		grid = GridIndex(points, s)
+		for n in range(count):
+			for radius in it.count(1):
+				near = sorted(grid.near(n, radius * s))
+				if len(near) >= conf.stop_neighbors or len(near) == count - 1: break
+			neighbors[n].update(map(op.itemgetter(1), near[:conf.stop_neighbors]))
+
+	else: raise ValueError('Unknown synthetic network layout: {!r}'.format(conf.layout))
+
+	for n, ns in enumerate(neighbors): # make connections symmetric
+		for m in ns: neighbors[m].add(n)
+	return points, neighbors
+
+
+def line_paths(conf, rng, points, neighbors):
+	'''Yields lists of stop numbers for each line, picked by greedy walks from
+			a random stop towards random target ones, so that lines overlap on major paths.
+		In "radial" layout, first target for every line is the center stop.'''
+	for line_n in range(conf.line_count):
+		length = rng.randint(*conf.line_stops)
+		path = [rng.randrange(len(points))]
+		visited, target = set(path), 0 if conf.layout == 'radial' else None
+		while len(path) < length:
+			if target is None or target == path[-1]: target = rng.randrange(len(points))
+			ns = sorted(neighbors[path[-1]].difference(visited))
+			if not ns: break
+			path.append(min(ns, key=lambda n: (dist_km(points, n, target), rng.random())))
+			visited.add(path[-1])
+		if len(path) >= 2: yield path
+
+
+def generate_timetable(conf=None, seed=None):
+	'''Generate synthetic Timetable for SynthConf parameters, deterministic for the same seed.
+		Trips of each line share the same stop-to-stop times,
+			so that there are no overtaking trips and nothing has to be re-generated.'''
+	if not conf: conf = SynthConf()
+	rng, types = random.Random(seed), t.public
+	points, neighbors = stop_layout(conf, rng)
+
+	lon0, lat0 = conf.center_lon_lat
+	km_lat, km_lon = 1 / 111.2, 1 / (111.2 * math.cos(math.radians(lat0)))
+	stops, stop_list = types.Stops(), list(
+		types.Stop('S{}'.format(n), 'Stop {}'.format(n), lon0 + x * km_lon, lat0 + y * km_lat)
+		for n, (x, y) in enumerate(points) )
+
+	trips, stops_used = types.Trips(), set()
+	for line_n, path in enumerate(line_paths(conf, rng, points, neighbors)):
+		line_dts_start, line_dts_end = line_dts_start_end(rng)
+		line_dts_interval = rand_int_align(*conf.line_trip_interval, rng=rng)*60
+		line_kmh = rand_int_align(*conf.line_kmh, rng=rng)
+		lingers = list(rand_int_align(*conf.line_stop_linger, rng=rng)*60 for n in path)
+		for line_dir, path_dir in ('a', path), ('b', path[::-1]):
+			offsets, dts = list(), 0 # (dts_arr, dts_dep) offsets from trip start
+			for n, (stop_n, linger) in enumerate(zip(path_dir, lingers)):
+				if n: dts += max(60, math.ceil(
+					dist_km(points, path_dir[n-1], stop_n) / line_kmh * 60 ) * 60)
+				offsets.append((dts, dts + linger))
+				dts += linger
+			for trip_seq in range(conf.line_trip_max_count):
+				trip_dts_start = line_dts_start + line_dts_interval * trip_seq
+				if trip_dts_start > line_dts_end: break
+				trip = types.Trip(line_id_hint='L{}{}'.format(line_n, line_dir))
+				for stopidx, (stop_n, (dts_arr, dts_dep)) in enumerate(zip(path_dir, offsets)):
+					stop = stops.add(stop_list[stop_n])
+					trip.add(types.TripStop( trip, stopidx,
+						stop, trip_dts_start + dts_arr, trip_dts_start + dts_dep ))
+				trips.add(trip)
+			stops_used.update(path_dir)
+
+	footpaths, fp_km_max = types.Footpaths(), (conf.fp_dt_max - conf.fp_dt_base) / 60 * conf.fp_kmh
+	grid = GridIndex(points, max(fp_km_max, conf.stop_spacing_km / 4))
+	with footpaths.populate() as fp_add:
+		for n in sorted(stops_used):
+			fp_add(stop_list[n], stop_list[n], conf.dt_ch*60)
+			for km, m in grid.near(n, fp_km_max):
+				if m not in stops_used: continue
+				fp_add( stop_list[n], stop_list[m],
+					round(conf.fp_dt_base*60 + km / conf.fp_kmh * 3600) )
+
+	return types.Timetable(stops, footpaths, trips)
+
+
+def write_gtfs(timetable, path, service_dates=('20000101', '20991231')):
+	'''Write Timetable as a GTFS directory, which can then be parsed by gtfs.parse_timetable().
+		All trips are written under one service, running on all days within service_dates,
+			and footpaths are stored in transfers.txt with min_transfer_time values.'''
+	path = Path(path)
+	path.mkdir(parents=True, exist_ok=True)
+	def gtfs_file(name, fields, rows):
+		with u.safe_replacement(path / '{}.txt'.format(name), newline='') as dst:
+			dst_csv = csv.writer(dst)
+			dst_csv.writerow(fields)
+			dst_csv.writerows(rows)
+
+	routes = dict()
+	for trip in timetable.trips:
+		routes.setdefault(trip.line_id_hint or 'R{}'.format(trip.id), list()).append(trip)
+
+	gtfs_file( 'agency', 'agency_id agency_name agency_url agency_timezone'.split(),
+		[['synth', 'Synthetic Transit', 'http://localhost/', 'UTC']] )
+	gtfs_file( 'calendar', 'service_id monday tuesday wednesday thursday'
+		' friday saturday sunday start_date end_date'.split(), [['all'] + [1]*7 + list(service_dates)] )
+	gtfs_file( 'stops', 'stop_id stop_name stop_lat stop_lon parent_station'.split(),
+		(['{}'.format(stop.id), stop.name, stop.lat, stop.lon, ''] for stop in timetable.stops) )
+	gtfs_file( 'routes', 'route_id agency_id route_short_name route_type'.split(),
+		([route_id, 'synth', route_id, 3] for route_id in routes) )
+	gtfs_file( 'trips', 'route_id service_id trip_id'.split(),
+		([route_id, 'all', trip.id] for route_id, route_trips in routes.items() for trip in route_trips) )
+	gtfs_file( 'stop_times', 'trip_id arrival_time departure_time stop_id stop_sequence'.split(),
+		( [trip.id, u.dts_format_hms(ts.dts_arr), u.dts_format_hms(ts.dts_dep), ts.stop.id, ts.stopidx + 1]
+			for trip in timetable.trips for ts in trip ) )
+	gtfs_file( 'transfers', 'from_stop_id to_stop_id transfer_type min_transfer_time'.split(),
+		( [stop_a.id, stop_b.id, 2, int(fp.get_shortest())]
+			for stop_a, stop_b, fp in timetable.footpaths ) )
@@ -0,0 +1,205 @@
+import itertools as it, operator as op, functools as ft
+from collections import defaultdict, Counter, OrderedDict
+from pathlib import Path
+import os, time, math, json, threading, contextlib
+
+from . import utils as u
+
+
+def timer_name_for_func(func):
+	'Returns "module.qualname" name for function or functools.partial, as used by timer_func wrappers.'
+	func_base = func if not isinstance(func, ft.partial) else func.func
+	return '.'.join([func_base.__module__.strip('__'), func_base.__qualname__])
+
+
+class Histogram:
+	'''Aggregated stats for span durations (in seconds), with log2-scale buckets
+		(from bucket_min upwards) for approximate percentiles, so that it can be used over any number of runs.'''
+
+	bucket_min = 1e-6
+
+	def __init__(self):
+		self.count, self.total, self.min, self.max = 0, 0.0, u.inf, 0.0
+		self.buckets = Counter() # {k: count}, for durations up to bucket_min * 2**k
+
+	def add(self, td):
+		self.count, self.total = self.count + 1, self.total + td
+		if td < self.min: self.min = td
+		if td > self.max: self.max = td
+		self.buckets[max(0, math.ceil(math.log2(td / self.bucket_min))) if td > 0 else 0] += 1
+
+	def percentile(self, p):
+		'Returns upper bound of bucket with p-th percentile value, or None if there were no values.'
+		if not self.count: return
+		n_min, n = self.count * p / 100, 0
+		for k in sorted(self.buckets):
+			n += self.buckets[k]
+			if n >= n_min: return min(self.max, max(self.min, self.bucket_min * 2**k))
+		return self.max
+
+	def as_dict(self):
+		return OrderedDict([
+			('count', self.count), ('total', self.total),
+			('mean', self.count and self.total / self.count),
+			('min', self.min if self.count else None), ('max', self.max),
+			('p50', self.percentile(50)), ('p90', self.percentile(90)), ('p99', self.percentile(99)) ])
+
+
+class Span:
+	__slots__ = 'id parent name tid ts td attrs'.split()
+
+	def __init__(self, id, parent, name, ts, attrs):
+		self.id, self.parent, self.name, self.ts, self.attrs = id, parent, name, ts, attrs
+		self.tid, self.td = threading.get_ident(), None
+
+	def __repr__(self):
+		return '<Span {} [{}] {:.6f}s>'.format(self.name, self.id, self.td or 0)
+
+
+class Tracer:
+	'''Collects nested timing spans from engine queries, precalculation and timetable parsing,
+			aggregated into per-name Histograms, and optionally stored for JSON/Chrome trace export.
+		Nesting is tracked per-thread, so same Tracer can be used from any number of threads.
+		Can also be used as timer_func for engines/init_gtfs_router, recording each call as a span.'''
+
+	def __init__(self, log=None, keep_spans=True, max_spans=2**20):
+		'''log - logger to report timer_func-wrapped calls to, same as calc_timer does.
+			keep_spans - store finished spans for export, not just histograms.
+			max_spans - limit on number of stored spans, with any extra ones only in histograms.'''
+		self.log, self.keep_spans, self.max_spans = log, keep_spans, max_spans
+		self.spans, self.hist, self.ts0 = list(), defaultdict(Histogram), time.monotonic()
+		self._local, self._lock, self._ids = threading.local(), threading.Lock(), it.count(1)
+
+	def _stack(self):
+		try: return self._local.stack
+		except AttributeError: stack = self._local.stack = list()
+		return stack
+
+	def start(self, name, **attrs):
+		'Start and return new span, nested in the current one for this thread, if any.'
+		stack = self._stack()
+		span = Span(next(self._ids), stack[-1].id if stack else None, name, time.monotonic(), attrs)
+		stack.append(span)
+		return span
+
+	def finish(self, span):
+		'Finish span (and any unfinished ones nested in it), returning its duration.'
+		span.td = time.monotonic() - span.ts
+		stack = self._stack()
+		while stack and stack.pop() is not span: pass
+		with self._lock:
+			self.hist[span.name].add(span.td)
+			if self.keep_spans and len(self.spans) < self.max_spans: self.spans.append(span)
+		return span.td
+
+	@contextlib.contextmanager
+	def span(self, name, **attrs):
+		span = self.start(name, **attrs)
+		try: yield span
+		finally: self.finish(span)
+
+	def __call__(self, func, *args, timer_name=None, **kws):
+		'timer_func-compatible call wrapper, see calc_timer.'
+		if not timer_name: timer_name = timer_name_for_func(func)
+		if self.log: self.log.debug('[{}] Starting...', timer_name)
+		with self.span(timer_name) as span: data = func(*args, **kws)
+		if self.log: self.log.debug('[{}] Finished in: {:.1f}s', timer_name, span.td)
+		return data
+
+	def clear(self):
+		with self._lock: self.spans, self.hist = list(), defaultdict(Histogram)
+
+	def stats(self):
+		'Returns {span_name: histogram_dict} for all spans recorded so far.'
+		with self._lock: hist = sorted(self.hist.items())
+		return OrderedDict((name, h.as_dict()) for name, h in hist)
+
+	def dump_json(self, dst):
+		'Write aggregated stats and stored spans to dst file object as JSON.'
+		spans = list( OrderedDict([ ('id', s.id), ('parent', s.parent), ('name', s.name),
+			('tid', s.tid), ('ts', s.ts - self.ts0), ('td', s.td), ('attrs', s.attrs) ]) for s in self.spans )
+		json.dump(OrderedDict([('stats', self.stats()), ('spans', spans)]), dst, indent=1, default=str)
+
+	def dump_chrome_trace(self, dst):
+		'Write stored spans to dst file object in Chrome trace-event format (chrome://tracing, perfetto).'
+		pid, events = os.getpid(), list()
+		for s in self.spans:
+			events.append(dict( name=s.name, ph='X', pid=pid, tid=s.tid,
+				ts=(s.ts - self.ts0) * 1e6, dur=s.td * 1e6, args=s.attrs ))
+		json.dump(dict(traceEvents=events, displayTimeUnit='ms'), dst, default=str)
+
+
+class NullSpan:
+	td = None
+	def __enter__(self): return self
+	def __exit__(self, *err): pass
+
+class NullTracer:
+	'No-op Tracer with the same interface, used when no tracer is passed.'
+	_span = NullSpan()
+	def __bool__(self): return False
+	def start(self, name, **attrs): return self._span
+	def finish(self, span): pass
+	def span(self, name, **attrs): return self._span
+	def __call__(self, func, *args, timer_name=None, **kws): return func(*args, **kws)
+
+null_tracer = NullTracer()
+
+
+class PhaseProfiler:
+	'''timer_func wrapper to capture cProfile stats (.pstats files) and optionally
+			tracemalloc top-allocations snapshot (.malloc.txt) for each major calculation phase.
+		Phases are matched by last component of timer name (see phases and phase_prefixes),
+			and only outermost phase is profiled, if these are nested or ran from multiple threads.
+		Files are named as "<n>.<phase>.<ext>" in path_dir, with n incremented for each phase run.'''
+
+	phases = { 'parse_timetable', 'timetable_load', 'timetable_lines',
+		'precalc_transfer_set', 'precalc_transfer_set_rev', 'build_lower_bounds', 'build_tp_tree' }
+	phase_prefixes = 'query_',
+
+	def __init__(self, path_dir, malloc_top=None, malloc_frames=1, timer_func=None):
+		'''malloc_top - number of top allocation sites to store per phase, None/0 to disable.
+			timer_func - wrapper to pass all calls through, e.g. calc_timer or Tracer.'''
+		self.path_dir, self.malloc_top, self.malloc_frames = Path(path_dir), malloc_top, malloc_frames
+		self.timer_func, self.log = timer_func, u.get_logger('tb.profile')
+		self._lock, self._active, self._n = threading.Lock(), False, it.count(1)
+		self.path_dir.mkdir(parents=True, exist_ok=True)
+
+	def is_phase(self, name):
+		name = name.rsplit('.', 1)[-1]
+		return name in self.phases or name.startswith(self.phase_prefixes)
+
+	def _call(self, func, args, kws, timer_name):
+		if not self.timer_func: return func(*args, **kws)
+		if timer_name: kws = dict(kws, timer_name=timer_name)
+		return self.timer_func(func, *args, **kws)
+
+	def __call__(self, func, *args, timer_name=None, **kws):
+		name = timer_name or timer_name_for_func(func)
+		if not self.is_phase(name): return self._call(func, args, kws, timer_name)
+		with self._lock:
+			if self._active: return self._call(func, args, kws, timer_name)
+			self._active, n = True, next(self._n)
+		import cProfile, tracemalloc
+		path = self.path_dir / '{:03d}.{}'.format(n, name.rsplit('.', 1)[-1])
+		malloc_start = self.malloc_top and not tracemalloc.is_tracing()
+		if malloc_start: tracemalloc.start(self.malloc_frames)
+		prof = cProfile.Profile()
+		try:
+			prof.enable()
+			try: data = self._call(func, args, kws, timer_name)
+			finally: prof.disable()
+		finally:
+			try:
+				prof.dump_stats(str(path) + '.pstats')
+				if self.malloc_top:
+					snapshot, (mem, mem_peak) = tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()
+					snapshot = snapshot.filter_traces(list( # allocations by profiling itself
+						tracemalloc.Filter(False, mod.__file__) for mod in [cProfile, tracemalloc] ))
+					if malloc_start: tracemalloc.stop()
+					with open(str(path) + '.malloc.txt', 'w') as dst:
+						dst.write('traced-memory: current={:,}B peak={:,}B\n'.format(mem, mem_peak))
+						for stat in snapshot.statistics('lineno')[:self.malloc_top]: dst.write('{}\n'.format(stat))
+				self.log.debug('[{}] Profiling data stored: {}.*', name, path)
+			finally: self._active = False
+		return data
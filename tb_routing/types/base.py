@@ -22,9 +22,12 @@ def struct_dumps(chunk_fmt, chunks, chunk_count=None):
 	assert n == chunk_count-1 and buff_n == buff_len-chunk_t.size
 	return buff
 
-def struct_load_iter(chunk_fmt, stream):
+def struct_load_iter(chunk_fmt, stream, optional=False):
+	'If optional=True, missing data at the end of stream (e.g. in older dumps) is same as no chunks.'
 	header_t = struct.Struct(struct_dump_header_fmt)
-	chunk_count, = header_t.unpack(stream.read(header_t.size))
+	header = stream.read(header_t.size)
+	if not header and optional: return
+	chunk_count, = header_t.unpack(header)
 	chunk_t = struct.Struct(chunk_fmt)
 	chunk_buff_len = chunk_t.size * chunk_count
 	chunk_buff = stream.read(chunk_buff_len)
@@ -66,11 +69,16 @@ class Line:
 	def add(self, *trips):
 		self.set_idx.extend(trips)
 		self.set_idx.sort(key=lambda trip: sum(map(op.attrgetter('dts_arr'), trip)))
+		self._trip_pos_cache = None
 
 	def earliest_trip(self, stopidx, dts=0):
 		for trip in self:
 			if trip[stopidx].dts_dep >= dts: return trip
 
+	def latest_trip(self, stopidx, dts):
+		for trip in reversed(self.set_idx):
+			if trip[stopidx].dts_arr <= dts: return trip
+
 	def trips_by_relation(self, trip, *rel_set):
 		'''Return trips from line with specified SolutionStatus relation(s) *from* trip.
 			E.g. func(t, non_dominated) will return u where t ≺ u.'''
@@ -78,6 +86,32 @@ class Line:
 			rel = trip.compare(line_trip)
 			if rel in rel_set: yield line_trip
 
+	_trip_pos_cache = None
+	def _trip_pos(self, trip):
+		'Returns (first, last) indexes of trips with same arrival times as specified one.'
+		if not self._trip_pos_cache:
+			# Only stored when complete, as other threads can use it at any point
+			trip_pos, groups = dict(), list()
+			for line_trip in self.set_idx:
+				dts = list(map(op.attrgetter('dts_arr'), line_trip))
+				if not groups or groups[-1][0] != dts: groups.append((dts, list()))
+				groups[-1][1].append(line_trip)
+			n = 0
+			for dts, trips in groups:
+				for line_trip in trips: trip_pos[line_trip] = n, n + len(trips) - 1
+				n += len(trips)
+			self._trip_pos_cache = trip_pos
+		return self._trip_pos_cache[trip]
+
+	def trips_from(self, trip):
+		'''Same as trips_by_relation(trip, non_dominated, equal), but returns a list slice,
+			without any comparisons, as trips are strictly ordered on the line.'''
+		return self.set_idx[self._trip_pos(trip)[0]:]
+
+	def trips_until(self, trip):
+		'Same as trips_from(), but for trips_by_relation(trip, dominated, equal).'
+		return self.set_idx[:self._trip_pos(trip)[1]+1]
+
 	def __getitem__(self, k): return self.set_idx[k]
 	def __hash__(self): return hash(self.id)
 	def __eq__(self, line): return u.same_type_and_id(self, line)
@@ -154,6 +188,18 @@ class Lines:
 	def __len__(self): return len(set(map(id, self.idx_trip.values())))
 
 
+class StopIndex:
+	'Dense numbering for timetable stops, used for per-stop arrays in query results and tables.'
+
+	def __init__(self, stops):
+		self.stops = list(stops)
+		self.idx = dict((stop.id, n) for n, stop in enumerate(self.stops))
+
+	def __getitem__(self, stop): return self.idx[stop.id]
+	def __len__(self): return len(self.stops)
+	def __iter__(self): return iter(self.stops)
+
+
 @u.attr_struct
 class Transfer:
 	ts_from = u.attr_init()
@@ -165,7 +211,10 @@ class Transfer:
 
 class TransferSet:
 
-	def __init__(self): self.set_idx, self.set_idx_keys = dict(), dict()
+	def __init__(self, index_to=False):
+		'index_to enables reverse index by ts_to, for to_trip_stop() lookups in backward searches.'
+		self.set_idx, self.set_idx_keys = dict(), dict()
+		self.set_idx_to = dict() if index_to else None
 
 	def add(self, transfer):
 		# Second mapping is used purely for more efficient O(1) removals
@@ -175,11 +224,18 @@ class TransferSet:
 		k2 = len(self.set_idx[k1])
 		self.set_idx[k1][k2] = transfer
 		self.set_idx_keys[transfer.id] = k1, k2
+		if self.set_idx_to is not None:
+			k1 = transfer.ts_to.trip.id, transfer.ts_to.stopidx
+			self.set_idx_to.setdefault(k1, dict())[transfer.id] = transfer
 
 	def from_trip_stop(self, ts):
 		k1 = ts.trip.id, ts.stopidx
 		return self.set_idx.get(k1, dict()).values()
 
+	def to_trip_stop(self, ts):
+		k1 = ts.trip.id, ts.stopidx
+		return self.set_idx_to.get(k1, dict()).values()
+
 	_dump_fmt = '>IBIBfI'
 
 	def dump(self, stream):
@@ -190,9 +246,9 @@ class TransferSet:
 		stream.write(struct_dumps(self._dump_fmt, chunk_iter, len(self)))
 
 	@classmethod
-	def load(cls, stream, timetable):
-		self = cls()
-		for transfer_tuple in struct_load_iter(cls._dump_fmt, stream):
+	def load(cls, stream, timetable, index_to=False, optional=False):
+		self = cls(index_to)
+		for transfer_tuple in struct_load_iter(cls._dump_fmt, stream, optional):
 			ts_from = timetable.trips[transfer_tuple[0]][transfer_tuple[1]]
 			ts_to = timetable.trips[transfer_tuple[2]][transfer_tuple[3]]
 			self.add(Transfer(ts_from, ts_to, transfer_tuple[4], transfer_tuple[5]))
@@ -203,27 +259,188 @@ class TransferSet:
 		return bool(self.set_idx.get(k1, dict()).get(k2))
 	def __delitem__(self, transfer):
 		k1, k2 = self.set_idx_keys.pop(transfer.id)
-		del self.set_idx[k1][k2]
+		transfer = self.set_idx[k1].pop(k2)
 		if not self.set_idx[k1]: del self.set_idx[k1]
+		if self.set_idx_to is not None:
+			k1 = transfer.ts_to.trip.id, transfer.ts_to.stopidx
+			del self.set_idx_to[k1][transfer.id]
+			if not self.set_idx_to[k1]: del self.set_idx_to[k1]
 	def __len__(self): return len(self.set_idx_keys)
 	def __iter__(self):
 		for k1, k2 in self.set_idx_keys.values(): yield self.set_idx[k1][k2]
 
 
-@u.attr_struct
+# Lightweight read-only Transfer, created on access from PackedTransferSet arrays
+TransferView = namedtuple('TransferView', 'ts_from ts_to dt id')
+
+class PackedTransferSet:
+	'''Read-only TransferSet with all transfers stored in flat typed arrays,
+			grouped by ts_from (trip, stopidx) numbers via offset table (CSR layout),
+			and TransferView tuples only created on access.
+		With index_to, order_to/offsets_to arrays are also built for ts_to lookups,
+			same as set_idx_to in TransferSet.
+		Consists of a handful of python objects instead of several per transfer, so that
+			refcount/gc updates never touch memory pages of array data, and these stay
+			shared between processes forked after loading it (see server.ServerConf.workers).'''
+
+	_t_idx, _t_stopidx, _t_dt = 'I', 'H', 'f'
+
+	def __init__(self, timetable, transfer_tuples, index_to=False):
+		'''transfer_tuples - iterable of (trip_id_from,
+			stopidx_from, trip_id_to, stopidx_to, dt, id), same as in TransferSet dumps.'''
+		self.trips, ts_count = timetable.trips, 0
+		self.ts_base = array.array(self._t_idx, [0]) * (max(
+			(trip.id for trip in timetable.trips), default=-1 ) + 1)
+		for trip in sorted(timetable.trips, key=op.attrgetter('id')):
+			self.ts_base[trip.id], ts_count = ts_count, ts_count + len(trip)
+
+		ts_key = lambda trip_id, stopidx: self.ts_base[trip_id] + stopidx
+		transfers = sorted(transfer_tuples, key=lambda tt: ts_key(*tt[:2]))
+		self.trip_from, self.stopidx_from, self.trip_to, self.stopidx_to, self.dt, self.ids = (
+			array.array(t, (tt[n] for tt in transfers)) for n, t in enumerate([ self._t_idx,
+				self._t_stopidx, self._t_idx, self._t_stopidx, self._t_dt, self._t_idx ]) )
+		del transfers
+		self.offsets_from = self._offsets(
+			it.starmap(ts_key, zip(self.trip_from, self.stopidx_from)), ts_count )
+		self.order_to = self.offsets_to = None
+		if index_to: # transfer numbers ordered by ts_to, with offsets into that
+			keys_to = list(it.starmap(ts_key, zip(self.trip_to, self.stopidx_to)))
+			self.order_to = array.array(self._t_idx, sorted(range(len(keys_to)), key=keys_to.__getitem__))
+			self.offsets_to = self._offsets(keys_to, ts_count)
+
+	def _offsets(self, keys_sorted, key_count):
+		'Returns offsets array, with items for key k being at [offsets[k]:offsets[k+1]].'
+		offsets = array.array(self._t_idx, [0]) * (key_count + 1)
+		for k in keys_sorted: offsets[k+1] += 1
+		for k in range(key_count): offsets[k+1] += offsets[k]
+		return offsets
+
+	def _transfer(self, m):
+		return TransferView( self.trips[self.trip_from[m]][self.stopidx_from[m]],
+			self.trips[self.trip_to[m]][self.stopidx_to[m]], self.dt[m], self.ids[m] )
+
+	def from_trip_stop(self, ts):
+		# Same as _transfer() calls, but inlined, as it's used in the innermost query loops
+		k = self.ts_base[ts.trip.id] + ts.stopidx
+		trips, trip_to, stopidx_to, dt, ids = (
+			self.trips.set_idx, self.trip_to, self.stopidx_to, self.dt, self.ids )
+		return list( TransferView(ts, trips[trip_to[m]].stops[stopidx_to[m]], dt[m], ids[m])
+			for m in range(self.offsets_from[k], self.offsets_from[k+1]) )
+
+	def to_trip_stop(self, ts):
+		k = self.ts_base[ts.trip.id] + ts.stopidx
+		trips, trip_from, stopidx_from, dt, ids = (
+			self.trips.set_idx, self.trip_from, self.stopidx_from, self.dt, self.ids )
+		return list( TransferView(trips[trip_from[m]].stops[stopidx_from[m]], ts, dt[m], ids[m])
+			for m in self.order_to[self.offsets_to[k]:self.offsets_to[k+1]] )
+
+	@classmethod
+	def from_set(cls, transfers, timetable):
+		return cls(timetable, (
+			( transfer.ts_from.trip.id, transfer.ts_from.stopidx,
+				transfer.ts_to.trip.id, transfer.ts_to.stopidx, transfer.dt, transfer.id )
+			for transfer in transfers ), index_to=transfers.set_idx_to is not None)
+
+	_dump_fmt, dump = TransferSet._dump_fmt, TransferSet.dump
+
+	@classmethod
+	def load(cls, stream, timetable, index_to=False, optional=False):
+		return cls(timetable, struct_load_iter(TransferSet._dump_fmt, stream, optional), index_to)
+
+	def __contains__(self, transfer):
+		return any(transfer.id == t.id for t in self.from_trip_stop(transfer.ts_from))
+	def __len__(self): return len(self.ids)
+	def __iter__(self): return map(self._transfer, range(len(self.ids)))
+
+
+class LowerBounds:
+	'''Table of lower bounds on travel time from each stop to each cluster of stops,
+			with stops numbered as in StopIndex, and stop_clusters array of cluster number for each.
+		Table is a flat array with [cluster, stop] layout, with values rounded down to seconds,
+			so that they can be stored as floats compactly without ever being over the actual bound.'''
+
+	_dump_prefix, _dump_t_clusters, _dump_t_table = '>II', 'I', 'f'
+
+	def __init__(self, stop_clusters, table):
+		self.stop_clusters, self.table = stop_clusters, table
+		self.stop_count = len(stop_clusters)
+		self.cluster_count = len(table) // self.stop_count if self.stop_count else 0
+
+	def row(self, cluster):
+		'Lower bounds from all stops (by number) to specified cluster.'
+		return self.table[cluster * self.stop_count:(cluster + 1) * self.stop_count]
+
+	def for_stops(self, stop_nums):
+		'Lower bounds from all stops (by number) to nearest of the specified ones.'
+		clusters = sorted(set(self.stop_clusters[n] for n in stop_nums))
+		bounds = self.row(clusters[0])
+		for k in clusters[1:]: bounds = array.array(self._dump_t_table, map(min, bounds, self.row(k)))
+		return bounds
+
+	def dump(self, stream):
+		stream.write(struct.pack(self._dump_prefix, self.stop_count, self.cluster_count))
+		self.stop_clusters.tofile(stream)
+		self.table.tofile(stream)
+
+	@classmethod
+	def load(cls, stream):
+		prefix_t = struct.Struct(cls._dump_prefix)
+		prefix = stream.read(prefix_t.size)
+		if not prefix: return # optional, not present in older dumps
+		stop_count, cluster_count = prefix_t.unpack(prefix)
+		stop_clusters, table = array.array(cls._dump_t_clusters), array.array(cls._dump_t_table)
+		with u.supress_warnings():
+			stop_clusters.fromfile(stream, stop_count)
+			table.fromfile(stream, stop_count * cluster_count)
+		if not stop_count: return # empty placeholder, see Graph.dump()
+		return cls(stop_clusters, table)
+
+
+@u.attr_struct(slots=False)
 class Graph:
 	keys = 'timetable lines transfers'
+	lower_bounds = None # optional LowerBounds table, not part of (timetable, lines, transfers) tuple
+	transfers_rev = None # TransferSet indexed by ts_to for backward searches, same as lower_bounds
+	version = 0 # should be bumped on any changes, to invalidate e.g. engine.QueryResultCache
+
 	def __iter__(self): return iter(u.attr.astuple(self, recurse=False))
 
+	def freeze(self):
+		'''Pre-build all lazily-calculated caches in timetable and lines,
+				so that graph is never modified by queries, which can then run from any number of threads.
+			Does not make anything immutable or add any locking - graph should not be changed
+				while queries are running, and version should be bumped after any changes to it.'''
+		self.timetable.freeze()
+		for line in self.lines: line.id, line._trip_pos(line[0])
+		return self
+
+	def pack(self):
+		'''Replace TransferSets (forward and reverse ones) with read-only
+			PackedTransferSets, to share these between forked processes.'''
+		if not isinstance(self.transfers, PackedTransferSet):
+			self.transfers = PackedTransferSet.from_set(self.transfers, self.timetable)
+		if self.transfers_rev and not isinstance(self.transfers_rev, PackedTransferSet):
+			self.transfers_rev = PackedTransferSet.from_set(self.transfers_rev, self.timetable)
+		return self
+
 	def dump(self, stream):
 		self.lines.dump(stream)
 		self.transfers.dump(stream)
+		# Optional parts are at the end, with lower_bounds always
+		#  written (as empty placeholder, if missing), so that older dumps can still be loaded.
+		(self.lower_bounds or LowerBounds(array.array('I'), array.array('f'))).dump(stream)
+		if self.transfers_rev: self.transfers_rev.dump(stream)
 
 	@classmethod
-	def load(cls, stream, timetable):
+	def load(cls, stream, timetable, packed=False):
+		transfers_cls = TransferSet if not packed else PackedTransferSet
 		lines = Lines.load(stream, timetable)
-		transfers = TransferSet.load(stream, timetable)
-		return cls(timetable, lines, transfers)
+		transfers = transfers_cls.load(stream, timetable)
+		self = cls(timetable, lines, transfers)
+		self.lower_bounds = LowerBounds.load(stream)
+		transfers_rev = transfers_cls.load(stream, timetable, index_to=True, optional=True)
+		if len(transfers_rev): self.transfers_rev = transfers_rev
+		return self
 
 
 @u.attr_struct
@@ -84,3 +84,6 @@ class ParetoSet:
 
 # Special-case ParetoSet used for common QueryResult values
 QueryResultParetoSet = ft.partial(ParetoSet, 'dts_arr n dts_dep')
+
+# Same for latest-departure queries, where dts_dep is maximized instead of minimizing dts_arr
+QueryResultLDParetoSet = ft.partial(ParetoSet, lambda result: (-result.dts_dep, result.n))
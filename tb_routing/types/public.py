@@ -1,6 +1,6 @@
 import itertools as it, operator as op, functools as ft
 from collections import namedtuple, defaultdict
-import enum, datetime, contextlib
+import enum, datetime, contextlib, math, struct
 
 from .. import utils as u
 
@@ -32,9 +32,58 @@ class Stop:
 		if self.id == self.name: return '<Stop {}>'.format(self.id)
 		return '<Stop {} [{}]>'.format(self.name, self.id)
 
+class StopsGridIndex:
+	'''Simple spatial index for stops with lon/lat coordinates,
+		grouping them into grid cells of cell_deg size (in degrees) for nearest-stop lookups.'''
+
+	def __init__(self, stops, cell_deg=0.01):
+		self.cell_deg, self.cells = cell_deg, defaultdict(list)
+		for stop in stops:
+			if stop.lon is None or stop.lat is None: continue
+			self.cells[self.cell(stop.lon, stop.lat)].append(stop)
+		self.cell_bounds = tuple(
+			(min(map(op.itemgetter(n), self.cells)), max(map(op.itemgetter(n), self.cells)))
+			for n in range(2) ) if self.cells else ((0, 0), (0, 0))
+
+	def cell(self, lon, lat):
+		return int(math.floor(float(lon) / self.cell_deg)), int(math.floor(float(lat) / self.cell_deg))
+
+	def _ring(self, cx, cy, r):
+		if not r: return [(cx, cy)]
+		return list(it.chain(
+			((x, y) for x in range(cx-r, cx+r+1) for y in [cy-r, cy+r]),
+			((x, y) for x in [cx-r, cx+r] for y in range(cy-r+1, cy+r)) ))
+
+	def nearest(self, lon, lat, radius_km=None, n=None):
+		'''Return list of (km, stop) tuples for stops nearest to lon/lat point, sorted by distance,
+			limited to ones within radius_km and/or up to n nearest ones (if specified).'''
+		cx, cy = self.cell(lon, lat)
+		(x_min, x_max), (y_min, y_max) = self.cell_bounds
+		r_max = max(cx - x_min, x_max - cx, cy - y_min, y_max - cy, 0)
+		# Any stop outside of r-th ring of cells is at least that far from the point
+		cell_km = self.cell_deg * 111.2 * math.cos(math.radians(min(abs(float(lat)) + self.cell_deg, 89)))
+		found = list()
+		for r in range(r_max + 1):
+			for k in self._ring(cx, cy, r):
+				for stop in self.cells.get(k, list()):
+					km = u.haversine_km(lon, lat, stop.lon, stop.lat)
+					if radius_km is None or km <= radius_km: found.append((km, stop))
+			if radius_km is not None and r * cell_km >= radius_km: break
+			if n is not None and sum(1 for km, stop in found if km <= r * cell_km) >= n: break
+		found.sort(key=op.itemgetter(0))
+		return found[:n] if n is not None else found
+
 class Stops:
+
+	_spatial_cache = None
+
 	def __init__(self): self.set_idx = dict()
 
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state.pop('_spatial_cache', None)
+		return state
+
 	def add(self, stop):
 		if stop.id in self.set_idx: stop = self.set_idx[stop.id]
 		else: self.set_idx[stop.id] = stop
@@ -45,6 +94,15 @@ class Stops:
 		if stop not in self.set_idx: return
 		return self.set_idx[stop]
 
+	def nearest(self, lon, lat, radius_km=None, n=None):
+		'''Return list of (km, stop) tuples for stops nearest to lon/lat point, sorted by distance.
+			Uses StopsGridIndex, built on first call and not stored with pickled stops.'''
+		return self.spatial_index().nearest(lon, lat, radius_km=radius_km, n=n)
+
+	def spatial_index(self):
+		if not self._spatial_cache: self._spatial_cache = StopsGridIndex(self)
+		return self._spatial_cache
+
 	def __getitem__(self, stop_id): return self.set_idx[stop_id]
 	def __len__(self): return len(self.set_idx)
 	def __iter__(self): return iter(self.set_idx.values())
@@ -111,7 +169,7 @@ class Footpaths:
 		self.fp0 = Footpath()
 
 	def __getstate__(self):
-		state = self.__dict__
+		state = self.__dict__.copy()
 		state.pop('_stats_cache', None)
 		return state
 
@@ -192,6 +250,28 @@ class Footpaths:
 			for k2, fp in list(k1_fps.items()): yield k1, k2, fp
 	def __len__(self): return self._stats().conn_count
 
+class FootpathsOverlay(Footpaths):
+	'''Footpaths added on top of other (e.g. timetable) ones, without modifying these,
+		for access/egress walks between virtual query source/destination stops and timetable stops.'''
+
+	def __init__(self, footpaths):
+		super(FootpathsOverlay, self).__init__()
+		self.base = footpaths
+
+	def get(self, stop_from, stop_to):
+		try: return self.set_idx_to[stop_from][stop_to]
+		except KeyError: return self.base.get(stop_from, stop_to)
+
+	def to_stops_from(self, stop, **fp_constraints):
+		return it.chain(
+			self.base.to_stops_from(stop, **fp_constraints),
+			super(FootpathsOverlay, self).to_stops_from(stop, **fp_constraints) )
+
+	def from_stops_to(self, stop, **fp_constraints):
+		return it.chain(
+			self.base.from_stops_to(stop, **fp_constraints),
+			super(FootpathsOverlay, self).from_stops_to(stop, **fp_constraints) )
+
 
 @u.attr_struct(repr=False)
 class TripStop:
@@ -294,6 +374,11 @@ class Timetable:
 	def dts_format(self, dts):
 		return u.dts_format(dts - self.timespan.dts_start)
 
+	def freeze(self):
+		'Pre-build all lazily-calculated caches, so that these are never updated from queries.'
+		self.timespan.dts_start, self.stops.spatial_index(), self.footpaths.stat_mean_delta()
+		return self
+
 
 
 ### TBRoutingEngine query result
@@ -310,21 +395,26 @@ class Journey:
 		'StatsCache', 'id dts_arr dts_dep trip_count fp_count' )
 	_stats_cache = None
 
+	def _stats_segments(self):
+		'Yields (hash_val, dts_dep, dts_arr) for trip segments and (hash_val, None, delta) for footpaths.'
+		for seg in self.segments:
+			if isinstance(seg, JourneyTrip): yield seg.ts_from.trip, seg.ts_from.dts_dep, seg.ts_to.dts_arr
+			elif isinstance(seg, JourneyFp): yield seg, None, seg.delta
+
 	def _stats(self):
 		if not self._stats_cache:
 			dts_arr = trip_count = fp_count = 0
 			dts_dep, dts_dep_fp, hash_vals = None, 0, list()
-			for seg in self.segments:
-				if isinstance(seg, JourneyTrip):
+			for hash_val, dts_seg_dep, dts_seg_arr in self._stats_segments():
+				hash_vals.append(hash_val)
+				if dts_seg_dep is not None:
 					trip_count += 1
-					dts_arr = seg.ts_to.dts_arr
-					hash_vals.append(seg.ts_from.trip)
-					if dts_dep is None: dts_dep = seg.ts_from.dts_dep - dts_dep_fp
-				elif isinstance(seg, JourneyFp):
+					dts_arr = dts_seg_arr
+					if dts_dep is None: dts_dep = dts_seg_dep - dts_dep_fp
+				else:
 					fp_count += 1
-					dts_arr = dts_arr + seg.delta
-					hash_vals.append(seg)
-					if dts_dep is None: dts_dep_fp += seg.delta
+					dts_arr = dts_arr + dts_seg_arr
+					if dts_dep is None: dts_dep_fp += dts_seg_arr
 			if dts_dep is None: # no trips, only footpaths
 				dts_dep, dts_arr = self.dts_start, self.dts_start + dts_arr
 			self._stats_cache = self._stats_cache_t(
@@ -334,7 +424,7 @@ class Journey:
 	def copy(self):
 		attrs = u.attr.asdict(self)
 		attrs['segments'] = self.segments.copy()
-		return Journey(**attrs)
+		return type(self)(**attrs)
 
 	def append_trip(self, *jtrip_args, **jtrip_kws):
 		self.segments.append(JourneyTrip(*jtrip_args, **jtrip_kws))
@@ -411,18 +501,202 @@ class Journey:
 				p('    to: {0.name}{stop_id}', seg.stop_to, stop_id=stop_id_ext(seg.stop_to))
 
 
+@u.attr_struct(slots=False, repr=False, cmp=False)
+class CompactJourney(Journey):
+	'''Journey with segments stored as JourneySet.compact() legs with ids and absolute times,
+			built directly from query results in engine, without any per-segment objects.
+		Has same id and stats as Journey, and journey() can be used to get latter from it.'''
+
+	def _stats_segments(self):
+		for leg in self.segments:
+			if leg[0] is None: yield tuple(leg[1:]), None, leg[3] # same hash as JourneyFp
+			else: yield leg[0], leg[5], leg[6] # same hash as Trip
+
+	def append_trip(self, ts_from, ts_to):
+		self.segments.append([ ts_from.trip.id, ts_from.stopidx, ts_to.stopidx,
+			ts_from.stop.id, ts_to.stop.id, ts_from.dts_dep, ts_to.dts_arr ])
+		self._stats_cache = None
+		return self
+
+	def append_fp(self, stop_from, stop_to, dt):
+		if not (stop_from == stop_to or dt == 0):
+			self.segments.append([None, stop_from.id, stop_to.id, dt])
+			self._stats_cache = None
+		return self
+
+	@classmethod
+	def from_journey(cls, journey):
+		jn = cls(journey.dts_start)
+		for seg in journey.segments:
+			if isinstance(seg, JourneyTrip): jn.append_trip(*seg)
+			else: jn.append_fp(*seg)
+		return jn
+
+	def journey(self, stops=None, trips=None):
+		'''Returns Journey with Stop/Trip objects only having ids, stopidx and times set,
+			which is enough for pretty_print() and same journey id as this one.
+			stops/trips dicts can be passed to reuse these objects between journeys.'''
+		stops, trips = u.init_if_none(stops, dict), u.init_if_none(trips, dict)
+		stop = lambda k: stops[k] if k in stops else stops.setdefault(k, Stop(k, k, None, None))
+		trip = lambda k: trips[k] if k in trips else trips.setdefault(k, Trip(id=k))
+		jn = Journey(self.dts_start)
+		for leg in self.segments:
+			if leg[0] is None:
+				jn.append_fp(stop(leg[1]), stop(leg[2]), leg[3])
+				continue
+			trip_id, stopidx_from, stopidx_to, stop_from, stop_to, dts_dep, dts_arr = leg
+			jn.append_trip(
+				TripStop(trip(trip_id), stopidx_from, stop(stop_from), dts_dep, dts_dep),
+				TripStop(trip(trip_id), stopidx_to, stop(stop_to), dts_arr, dts_arr) )
+		return jn
+
+	def __repr__(self): return repr(self.journey())
+	def pretty_print(self, *args, **kws): return self.journey().pretty_print(*args, **kws)
+
+
 @u.attr_struct
 class JourneySet:
 	journeys = u.attr_init(set)
+	partial = u.attr_init(False) # set for queries stopped early by QueryBudget
+
 
 	def add(self, journey): self.journeys.add(journey)
 
 	def __len__(self): return len(self.journeys)
 	def __iter__(self): return iter(self.journeys)
 
+	def compact(self, dts_base=0):
+		'''Returns list of compact JSON-serializable lists for journeys, ordered by departure/arrival,
+				with trips/stops as ids and times as integer seconds relative to dts_base
+				(e.g. timetable.timespan.dts_start for time of the timetable day).
+			Each journey is [dts_dep, dts_arr, transfers, legs], where each leg is either trip
+				[trip_id, stopidx_from, stopidx_to, stop_id_from, stop_id_to, dts_dep, dts_arr]
+				or footpath [None, stop_id_from, stop_id_to, dt].
+			CompactJourney legs (e.g. from queries with compact=True) are used as-is,
+				and other journeys are converted to these first.'''
+		jns = list()
+		for jn in sorted(self.journeys, key=op.attrgetter('dts_dep', 'dts_arr', 'dts_start', 'id')):
+			if not isinstance(jn, CompactJourney): jn = CompactJourney.from_journey(jn)
+			legs = list(
+				[None, leg[1], leg[2], round(leg[3])] if leg[0] is None
+				else leg[:5] + [round(leg[5] - dts_base), round(leg[6] - dts_base)]
+				for leg in jn.segments )
+			jns.append([ round(jn.dts_dep - dts_base),
+				round(jn.dts_arr - dts_base), max(0, jn.trip_count - 1), legs ])
+		return jns
+
+	@classmethod
+	def from_compact(cls, journeys, dts_base=0, partial=False):
+		'''Build JourneySet of CompactJourneys from compact() lists without timetable,
+			for display or comparison, with same journey ids as in original set.'''
+		jset = cls(partial=partial)
+		for dts_dep, dts_arr, transfers, legs in journeys:
+			jset.add(CompactJourney(dts_base + dts_dep, list(
+				leg if leg[0] is None else leg[:5] + [dts_base + leg[5], dts_base + leg[6]]
+				for leg in legs )))
+		return jset
+
+	_dump_prefix, _dump_str_len = '>?I', '>H' # partial, journey_count
+	_dump_ids = '>I?' # id count, whether all ids are integers
+	_dump_jn = '>iiH' # dts_dep, dts_arr, leg_count
+	_dump_leg = '>IHHIIii' # trip_n, stopidx_from, stopidx_to, stop_from_n, stop_to_n, dts_dep, dts_arr
+	_dump_fp = 2**32-1 # trip_n for footpath legs, with dt in place of dts_dep
+
+	def dump(self, stream, dts_base=0):
+		'''Write compact() journeys to binary stream, with stop and trip ids as
+				tables of utf-8 strings, and journeys/legs as fixed-size structs with indexes in these.
+			Ids are loaded back as integers if all ids in their table were integers, strings otherwise.'''
+		stop_idx, trip_idx, buff = dict(), dict(), list()
+		id_n = lambda idx, k: idx.setdefault(k, len(idx))
+		jn_t, leg_t = struct.Struct(self._dump_jn), struct.Struct(self._dump_leg)
+		for dts_dep, dts_arr, transfers, legs in self.compact(dts_base):
+			buff.append(jn_t.pack(dts_dep, dts_arr, len(legs)))
+			for leg in legs:
+				if leg[0] is None: leg = [self._dump_fp, 0, 0] + leg[1:] + [0]
+				else: leg = [id_n(trip_idx, leg[0])] + leg[1:]
+				trip_n, stopidx_from, stopidx_to, stop_from, stop_to, dts_dep, dts_arr = leg
+				buff.append(leg_t.pack( trip_n, stopidx_from, stopidx_to,
+					id_n(stop_idx, stop_from), id_n(stop_idx, stop_to), dts_dep, dts_arr ))
+		stream.write(struct.pack(self._dump_prefix, self.partial, len(self.journeys)))
+		for idx in stop_idx, trip_idx:
+			ids = sorted(idx, key=idx.get)
+			stream.write(struct.pack(self._dump_ids, len(ids), all(isinstance(k, int) for k in ids)))
+			for k in ids:
+				k = str(k).encode()
+				stream.write(struct.pack(self._dump_str_len, len(k)) + k)
+		stream.write(b''.join(buff))
+
+	@classmethod
+	def load(cls, stream, dts_base=0):
+		'Load JourneySet written by dump() to binary stream, same as from_compact() does.'
+		prefix_t, ids_t, str_len_t = map(struct.Struct, [cls._dump_prefix, cls._dump_ids, cls._dump_str_len])
+		jn_t, leg_t = struct.Struct(cls._dump_jn), struct.Struct(cls._dump_leg)
+		partial, jn_count = prefix_t.unpack(stream.read(prefix_t.size))
+		stop_ids, trip_ids, jns = list(), list(), list()
+		for ids in stop_ids, trip_ids:
+			id_count, ids_int = ids_t.unpack(stream.read(ids_t.size))
+			for n in range(id_count):
+				k_len, = str_len_t.unpack(stream.read(str_len_t.size))
+				k = stream.read(k_len).decode()
+				ids.append(int(k) if ids_int else k)
+		for n in range(jn_count):
+			dts_dep, dts_arr, leg_count = jn_t.unpack(stream.read(jn_t.size))
+			legs = list()
+			for trip_n, stopidx_from, stopidx_to, stop_from, stop_to, dts_leg_dep, dts_leg_arr\
+					in leg_t.iter_unpack(stream.read(leg_t.size * leg_count)):
+				stop_from, stop_to = stop_ids[stop_from], stop_ids[stop_to]
+				if trip_n == cls._dump_fp: legs.append([None, stop_from, stop_to, dts_leg_dep])
+				else: legs.append([ trip_ids[trip_n], stopidx_from,
+					stopidx_to, stop_from, stop_to, dts_leg_dep, dts_leg_arr ])
+			jns.append([dts_dep, dts_arr, max(0, sum(1 for leg in legs if leg[0] is not None) - 1), legs])
+		return cls.from_compact(jns, dts_base, partial)
+
 	def pretty_print(self, dts_format_func=None, indent=0, **print_kws):
-		print(' '*indent + 'Journey set ({}):'.format(len(self.journeys)))
+		print(' '*indent + 'Journey set ({}{}):'.format(
+			len(self.journeys), ', partial' if self.partial else '' ))
 		for journey in sorted( self.journeys,
 				key=op.attrgetter('dts_dep', 'dts_arr', 'dts_start', 'id') ):
 			print()
 			journey.pretty_print(dts_format_func=dts_format_func, indent=indent+2, **print_kws)
+
+
+@u.attr_struct
+class StopArrivals:
+	'''Compact one-to-all query result - best arrival time and transfer count
+			for every stop, in arrays indexed by stop number (see types.base.StopIndex).
+		Unreachable stops have u.inf arrival time and -1 transfer count,
+			while ones reachable by footpaths only (incl. source stop itself) have 0 transfers.'''
+	stop_idx = u.attr_init()
+	dts_arr = u.attr_init()
+	n = u.attr_init()
+
+	def get(self, stop):
+		'Return (dts_arr, n) tuple for specified stop.'
+		k = self.stop_idx[stop]
+		return self.dts_arr[k], self.n[k]
+
+	def __len__(self): return sum(1 for n in self.n if n >= 0)
+	def __iter__(self):
+		'Iterate over (stop, dts_arr, n) tuples for all reachable stops.'
+		for stop, dts_arr, n in zip(self.stop_idx, self.dts_arr, self.n):
+			if n >= 0: yield stop, dts_arr, n
+
+
+@u.attr_struct
+class StopArrivalsWindow:
+	'''Window-sampled one-to-all query result - numpy arrays of sampled departure times (dts_src)
+			and earliest arrival times (dts_arr, with [dts_src, stop] shape) for each of these,
+			with stops indexed by stop number (see types.base.StopIndex), u.inf for unreachable ones.'''
+	stop_idx = u.attr_init()
+	dts_src = u.attr_init()
+	dts_arr = u.attr_init()
+
+	def travel_times(self, stop):
+		'Return numpy array of travel times to stop for each sampled departure time.'
+		return self.dts_arr[:, self.stop_idx[stop]] - self.dts_src
+
+	def travel_time_percentiles(self, stop, percentiles=(0, 50, 100)):
+		'''Return list of nearest-rank travel time percentiles to stop over all sampled departures,
+			e.g. [min, median, max] for default (0, 50, 100) values, u.inf if not always reachable.'''
+		tts = sorted(self.travel_times(stop).tolist())
+		return list(tts[round(p / 100 * (len(tts) - 1))] for p in percentiles)
@@ -93,6 +93,11 @@ class TPTree:
 		if not isinstance(k, TPNodeID): k = TPNodeID.for_k_type(self.prefix, k)
 		return k
 
+	def subtree(self, k):
+		'Returns subtree for prefix of the main tree, creating it if missing, to add nodes there.'
+		assert not self.prefix, 'Only makes sense for main tree'
+		return TPTree(self.tree.setdefault(k, dict()), self.stats, k)
+
 	def get_all(self, k, t=None):
 		assert self.prefix, 'Only makes sense for subtrees'
 		return self.tree[self._node_id_for_k(k, t)].values()
@@ -101,8 +106,10 @@ class TPTree:
 		'''Returns subtree for prefix of the main tree, or unique node for
 				specified node/node-id/k (using both id and seed from node objects!).
 			If no unique element can be returned, TPTreeLookupError will be raised.
-			get_all() can be used to fetch duplicate nodes for the same k, or with special t.'''
-		if not self.prefix: return TPTree(self.tree.setdefault(k, dict()), self.stats, k)
+			get_all() can be used to fetch duplicate nodes for the same k, or with special t.
+			Never modifies the tree, so can be used from any number of threads,
+				and subtree() method should be used instead to get one for adding nodes.'''
+		if not self.prefix: return TPTree(self.tree.get(k, dict()), self.stats, k)
 		node_dict = self.tree[self._node_id_for_k(k)]
 		if isinstance(k, TPNode): return node_dict[k.seed]
 		if len(node_dict) != 1:
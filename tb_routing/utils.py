@@ -1,7 +1,7 @@
 import itertools as it, operator as op, functools as ft
 from pathlib import Path
-from collections import UserList
-import os, sys, logging, datetime, base64
+from collections import UserList, OrderedDict
+import os, sys, logging, datetime, base64, math, threading
 import contextlib, tempfile, stat, warnings
 
 import attr
@@ -106,6 +106,40 @@ def supress_warnings():
 
 inf = float('inf')
 
+
+class LRUCache:
+	'''Simple size-bounded mapping, discarding least-recently-used items on overflow.
+		Thread-safe, as item lookup and reordering/eviction are done under a lock.'''
+
+	def __init__(self, size): self.size, self.items, self.lock = size, OrderedDict(), threading.Lock()
+
+	def get(self, k, default=None):
+		with self.lock:
+			try: v = self.items[k]
+			except KeyError: return default
+			self.items.move_to_end(k)
+			return v
+
+	def set(self, k, v):
+		with self.lock:
+			self.items[k] = v
+			self.items.move_to_end(k)
+			while len(self.items) > self.size: self.items.popitem(last=False)
+
+	def clear(self):
+		with self.lock: self.items.clear()
+	def __contains__(self, k):
+		with self.lock: return k in self.items
+	def __len__(self):
+		with self.lock: return len(self.items)
+
+def haversine_km(lon1, lat1, lon2, lat2, math=math):
+	'Great-circle distance in km between two lon/lat points (in degrees), using Haversine Formula.'
+	lon1, lat1, lon2, lat2 = (math.radians(float(v)) for v in [lon1, lat1, lon2, lat2])
+	return 6367 * 2 * math.asin(math.sqrt(
+		math.sin((lat2 - lat1)/2)**2 +
+		math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1)/2)**2 ))
+
 def max(iterable, default=..., _max=max, **kws):
 	try: return _max(iterable, **kws)
 	except ValueError:
@@ -170,3 +204,8 @@ def dts_format(dts):
 	dts = str(datetime.time(dts // 3600, (dts % 3600) // 60, dts % 60, dts % 1))
 	if dts_days: dts = '{}+{}'.format(dts_days, dts)
 	return dts
+
+def dts_format_hms(dts):
+	'Format day-time seconds as HH:MM:SS, where hours can be >24 for next-day times, as in GTFS.'
+	dts = int(dts)
+	return '{:02d}:{:02d}:{:02d}'.format(dts // 3600, dts % 3600 // 60, dts % 60)
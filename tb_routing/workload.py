@@ -0,0 +1,181 @@
+'Query workloads - generation, loading/saving as CSV and replay with latency stats.'
+
+import itertools as it, operator as op, functools as ft
+from collections import namedtuple, defaultdict, Counter, OrderedDict
+import os, time, math, random, csv, json, threading, multiprocessing
+
+from . import utils as u
+
+
+# All values are strings as stored in CSV files - stop ids and day-time values (e.g. 08:15),
+#  with dts_end only used for "profile" queries as the latest departure time.
+# Query types: ea (earliest arrival), ld (latest departure by dts), profile (dts to dts_end).
+WorkloadQuery = namedtuple('WorkloadQuery', 'type src dst dts dts_end')
+query_types = 'ea', 'ld', 'profile'
+
+@u.attr_struct(vals_to_attrs=True)
+class WorkloadConf:
+	mix = dict(ea=0.6, profile=0.3, ld=0.1) # relative frequencies of query types
+	dts_jitter = 30 * 60 # max random offset before picked trip departures for query times
+	dts_step = 5 * 60 # query times are rounded to that
+	profile_window = 2 * 3600
+	ld_window = 1 * 3600, 3 * 3600 # min/max offsets for arrival times in ld queries
+
+
+def generate_workload(timetable, count, seed=None, conf=None):
+	'''Generate list of count WorkloadQuery tuples for timetable, same for same seed.
+		To resemble real-world query mix, source/destination stops are picked with probability
+			proportional to number of trips serving these, and query times are picked near
+			random trip departures, i.e. following timetable service levels throughout the day.'''
+	if not conf: conf = WorkloadConf()
+	rng, trips = random.Random(seed), list(timetable.trips)
+	stop_trips = Counter(ts.stop for trip in trips for ts in trip)
+	stops = sorted(stop_trips, key=op.attrgetter('id'))
+	stop_weights = list(it.accumulate(stop_trips[stop] for stop in stops))
+	types, type_weights = zip(*sorted(conf.mix.items()))
+	dts_format = lambda dts: u.dts_format_hms(max(0, dts - timetable.timespan.dts_start))
+
+	queries = list()
+	for n in range(count):
+		qt, = rng.choices(types, weights=type_weights)
+		src, dst = rng.choices(stops, cum_weights=stop_weights, k=2)
+		while src == dst and len(stops) > 1: dst, = rng.choices(stops, cum_weights=stop_weights)
+		dts = rng.choice(trips)[0].dts_dep - rng.randint(0, conf.dts_jitter)
+		dts = dts // conf.dts_step * conf.dts_step
+		dts_end = ''
+		if qt == 'profile': dts_end = dts_format(dts + conf.profile_window)
+		elif qt == 'ld': dts += rng.randrange(*conf.ld_window, step=conf.dts_step)
+		queries.append(WorkloadQuery(qt, src.id, dst.id, dts_format(dts), dts_end))
+	return queries
+
+def load_workload(path):
+	'Load list of WorkloadQuery tuples from CSV file with header, ignoring any extra columns.'
+	with open(str(path), newline='') as src:
+		queries = list()
+		for row in csv.DictReader(src):
+			query = WorkloadQuery(*(row.get(k) or '' for k in WorkloadQuery._fields))
+			if query.type not in query_types:
+				raise ValueError('Unknown query type in workload file {}: {!r}'.format(path, query.type))
+			queries.append(query)
+		return queries
+
+def save_workload(queries, path):
+	with u.safe_replacement(path, newline='') as dst:
+		dst_csv = csv.writer(dst)
+		dst_csv.writerow(WorkloadQuery._fields)
+		dst_csv.writerows(queries)
+
+
+def engine_query_func(router, max_transfers=15):
+	'''Returns func(query) -> result_count to run WorkloadQuery on TBRoutingEngine in this process.
+		Raises KeyError for unknown stop ids.'''
+	timetable = router.graph.timetable
+	def run_query(query):
+		src, dst = timetable.stops[query.src], timetable.stops[query.dst]
+		dts = timetable.dts_parse(query.dts)
+		if query.type == 'ea': journeys = router.query_earliest_arrival(src, dst, dts)
+		elif query.type == 'ld': journeys = router.query_latest_departure(src, dst, dts)
+		elif query.type == 'profile':
+			journeys = router.query_profile( src, dst,
+				dts, timetable.dts_parse(query.dts_end), max_transfers=max_transfers )
+		else: raise ValueError(query.type)
+		return len(journeys)
+	return run_query
+
+
+def server_query_func(url, max_transfers=15, timeout=60):
+	'''Returns func(query) -> result_count to run WorkloadQuery on query server (tb_routing.server),
+			with url being either http://host:port or unix:/path/to/socket.
+		Keeps one persistent connection per thread. Raises RuntimeError for non-200 responses.'''
+	import http.client, socket
+	class UnixHTTPConnection(http.client.HTTPConnection):
+		def connect(self):
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.sock.settimeout(self.timeout)
+			self.sock.connect(url[5:])
+	if url.startswith('unix:'): conn_func = lambda: UnixHTTPConnection('localhost', timeout=timeout)
+	else:
+		from urllib.parse import urlsplit
+		url_parts = urlsplit(url if '//' in url else '//' + url)
+		conn_func = lambda: http.client.HTTPConnection(
+			url_parts.hostname, url_parts.port or 80, timeout=timeout )
+	state = threading.local()
+	def run_query(query):
+		conn = getattr(state, 'conn', None)
+		if not conn: conn = state.conn = conn_func()
+		params = query._asdict()
+		if query.type == 'profile': params['max_transfers'] = max_transfers
+		try:
+			conn.request( 'POST', '/query', json.dumps(params).encode(),
+				{'Content-Type': 'application/json'} )
+			res = conn.getresponse()
+			data = json.loads(res.read().decode())
+		except (OSError, http.client.HTTPException):
+			conn.close()
+			state.conn = None
+			raise
+		if res.status != 200: raise RuntimeError('{} {}: {}'.format(res.status, res.reason, data.get('error')))
+		return len(data['journeys'])
+	return run_query
+
+
+QueryReplayResult = namedtuple('QueryReplayResult', 'type latency results error')
+
+def _replay_query(query_func, query):
+	ts0 = time.monotonic()
+	try: results, error = query_func(query), None
+	except Exception as err: results, error = 0, '{}: {}'.format(err.__class__.__name__, err)
+	return QueryReplayResult(query.type, time.monotonic() - ts0, results, error)
+
+_replay_query_func = None # for forked worker processes
+
+def _replay_query_forked(query): return _replay_query(_replay_query_func, query)
+
+def replay(query_func, queries, concurrency=1, processes=False):
+	'''Run all queries via query_func with specified concurrency,
+			returning (results, wall_time) tuple, with list of QueryReplayResult tuples in same order.
+		Threads are used by default, which is realistic for I/O-bound query_func (e.g. remote server),
+			while processes=True runs queries in forked subprocesses for in-process engine parallelism.'''
+	ts0 = time.monotonic()
+	if concurrency <= 1: results = list(_replay_query(query_func, q) for q in queries)
+	elif not processes:
+		from concurrent.futures import ThreadPoolExecutor
+		with ThreadPoolExecutor(concurrency) as pool:
+			results = list(pool.map(ft.partial(_replay_query, query_func), queries))
+	else:
+		global _replay_query_func
+		_replay_query_func = query_func
+		try:
+			with multiprocessing.get_context('fork').Pool(concurrency) as pool:
+				results = pool.map(_replay_query_forked, queries, chunksize=1)
+		finally: _replay_query_func = None
+	return results, time.monotonic() - ts0
+
+
+def percentile(values_sorted, p):
+	'Returns p-th percentile from sorted list of values, using nearest-rank method.'
+	if not values_sorted: return
+	return values_sorted[max(0, math.ceil(len(values_sorted) * p / 100) - 1)]
+
+def replay_report(results, wall_time):
+	'''Returns JSON-serializable summary dict for replay() results, with
+		query count, queries/s, latency percentiles and result/error counts, in total and per query type.'''
+	def stats(results):
+		latencies = sorted(res.latency for res in results)
+		errors = Counter(res.error for res in results if res.error)
+		return OrderedDict([
+			('count', len(results)), ('errors', sum(errors.values())),
+			('results', sum(res.results for res in results)),
+			('results_mean', sum(res.results for res in results) / len(results) if results else 0),
+			('latency', OrderedDict(
+				[('mean', sum(latencies) / len(latencies) if latencies else None)]
+				+ list(('p{}'.format(p), percentile(latencies, p)) for p in [50, 95, 99])
+				+ [('max', latencies[-1] if latencies else None)] )),
+			('error_types', OrderedDict(errors.most_common(10))) ])
+	by_type = defaultdict(list)
+	for res in results: by_type[res.type].append(res)
+	report = stats(results)
+	report['wall_time'] = wall_time
+	report['qps'] = len(results) / wall_time if wall_time > 0 else None
+	report['types'] = OrderedDict((qt, stats(by_type[qt])) for qt in query_types if qt in by_type)
+	return report
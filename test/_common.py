@@ -2,7 +2,7 @@ import itertools as it, operator as op, functools as ft
 from collections import ChainMap, Mapping, OrderedDict, defaultdict
 from pathlib import Path
 from pprint import pprint
-import os, sys, unittest, types, datetime, re, math
+import os, sys, unittest, types, datetime, re, math, io
 import tempfile, warnings, shutil, zipfile
 
 import yaml # PyYAML module is required for tests
@@ -105,6 +105,13 @@ def struct_from_val(val, cls, as_tuple=False):
 	else: raise ValueError(val)
 	return val if not as_tuple else tb.u.attr.astuple(val)
 
+def router_from_graph(timetable, graph, conf=None, **engine_kws):
+	'Build new TBRoutingEngine from in-memory dump of specified graph.'
+	graph_dump = io.BytesIO()
+	graph.dump(graph_dump)
+	graph_dump.seek(0)
+	return tb.engine.TBRoutingEngine(timetable, conf, cached_graph=graph_dump, **engine_kws)
+
 @tb.u.attr_struct
 class JourneyStats: keys = 'start end'
 
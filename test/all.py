@@ -2,13 +2,14 @@ import unittest
 
 from . import gtfs_shizuoka
 from . import simple
+from . import synth
 
 
 # XXX: because unittest in pypy3/3.3 doesn't have subTest ctx yet
 
 def load_tests(loader=None, tests=None, pattern=None):
 	if not tests: tests = unittest.TestSuite()
-	for mod in gtfs_shizuoka, simple:
+	for mod in gtfs_shizuoka, simple, synth:
 		tests.addTests(mod.load_tests(loader, tests, pattern))
 	return tests
 
@@ -1,7 +1,7 @@
 import itertools as it, operator as op, functools as ft
 from pathlib import Path
 from pprint import pprint
-import os, sys, unittest
+import os, sys, random, unittest
 
 from . import _common as c
 
@@ -45,6 +45,281 @@ class GTFS_Shizuoka_20161013(unittest.TestCase):
 	def test_journeys_J22209730_J22209790(self):
 		self._test_journeys_base('J22209730-J22209790')
 
+	def test_query_batch(self):
+		stops = list(self.timetable.stops[k] for k in [
+			'J22209723_0', 'J2220952426_0', 'J22209843_0', 'J222093345_0', 'J22209730_0' ])
+		queries = list( (a, b, self.timetable.dts_parse(dts))
+			for a, b in it.permutations(stops, 2) for dts in ['06:00', '12:00'] )
+		stats = c.tb.engine.QueryStats()
+		journeys_batch = dict(self.router.query_earliest_arrival_batch(queries, stats=stats))
+		self.assertEqual(set(journeys_batch), set(range(len(queries))))
+		self.assertEqual(stats.queries, len(queries))
+		self.assertEqual(stats.journeys, sum(map(len, journeys_batch.values())))
+		for n, query in enumerate(queries):
+			journeys = self.router.query_earliest_arrival(*query)
+			self.assertEqual(
+				set(jn.id for jn in journeys), set(jn.id for jn in journeys_batch[n]) )
+		budget = c.tb.engine.QueryBudget(timeout=0)
+		for n, journeys in self.router.query_earliest_arrival_batch(queries, budget=budget):
+			self.assertTrue(journeys.partial)
+
+	def test_query_one_to_all(self):
+		stop_src, dts_src = self.timetable.stops['J22209723_0'], self.timetable.dts_parse('06:00')
+		arrivals = self.router.query_one_to_all(stop_src, dts_src)
+		self.assertEqual(arrivals.get(stop_src), (dts_src, 0))
+		for stop_dst in list(self.timetable.stops)[::20]:
+			journeys = self.router.query_earliest_arrival(stop_src, stop_dst, dts_src)
+			dts_arr, n = arrivals.get(stop_dst)
+			self.assertEqual(bool(journeys), n >= 0)
+			# Journeys can only be same or worse, due to footpath choice when building them
+			for jn in journeys: self.assertLessEqual(dts_arr, jn.dts_arr)
+
+	def test_query_matrix(self):
+		try: import numpy as np
+		except ImportError: raise unittest.SkipTest('numpy module not available')
+		stops = list(self.timetable.stops)[::40]
+		dts_list = list(map(self.timetable.dts_parse, ['06:00', '12:00']))
+		matrix = self.router.query_matrix(stops, stops, dts_list, workers=2)
+		self.assertEqual(matrix.shape, (2, len(stops), len(stops)))
+		for (k_dts, dts_src), (k_src, stop_src) in it.product(enumerate(dts_list), enumerate(stops)):
+			arrivals = self.router.query_one_to_all(stop_src, dts_src)
+			for k_dst, stop_dst in enumerate(stops):
+				self.assertAlmostEqual(
+					matrix[k_dts, k_src, k_dst], arrivals.get(stop_dst)[0] - dts_src, places=1 )
+		matrix_np = self.router.query_matrix(stops, stops, np.array(dts_list), workers=1)
+		self.assertEqual(matrix_np.tolist(), matrix.tolist())
+		matrix_one = self.router.query_matrix(stops, stops, np.float64(dts_list[1]), workers=1)
+		self.assertEqual(matrix_one.tolist(), matrix[1].tolist())
+
+	def test_query_one_to_all_window(self):
+		try: import numpy as np
+		except ImportError: raise unittest.SkipTest('numpy module not available')
+		stop_src = self.timetable.stops['J22209843_0']
+		dts_edt, dts_ldt = map(self.timetable.dts_parse, ['07:00', '08:00'])
+		arrivals = self.router.query_one_to_all_window(stop_src, dts_edt, dts_ldt, step=300)
+		self.assertEqual(arrivals.dts_arr.shape, (13, len(self.timetable.stops)))
+		for dts_src, dts_arr in zip(arrivals.dts_src, arrivals.dts_arr):
+			arrivals_chk = self.router.query_one_to_all(stop_src, float(dts_src))
+			self.assertEqual(dts_arr.tolist(), arrivals_chk.dts_arr.tolist())
+		tt_min, tt_max = arrivals.travel_time_percentiles(
+			self.timetable.stops['J222093345_0'], [0, 100] )
+		self.assertLessEqual(tt_min, tt_max)
+
+	def test_query_multi(self):
+		stop_src, stop_dst = op.itemgetter('J22209723_0', 'J2220952426_0')(self.timetable.stops)
+		dts_src = self.timetable.dts_parse('06:00')
+		self.assertEqual(self.router.stops_near(stop_src.lon, stop_src.lat, n=1), [(stop_src, 0)])
+		journeys = self.router.query_earliest_arrival(stop_src, stop_dst, dts_src)
+		journeys_multi = self.router.query_earliest_arrival_multi(
+			[(stop_src, 0)], [(stop_dst, 0)], dts_src )
+		self.assertEqual(set(jn.id for jn in journeys), set(jn.id for jn in journeys_multi))
+
+		stops_src = self.router.stops_near(stop_src.lon, stop_src.lat, radius_km=0.5)
+		stops_dst = self.router.stops_near(stop_dst.lon, stop_dst.lat, radius_km=0.5)
+		self.assertGreater(len(stops_src), 1)
+		journeys_multi = self.router.query_earliest_arrival_multi(stops_src, stops_dst, dts_src)
+		self.assertTrue(journeys_multi)
+		for jn in journeys_multi:
+			seg_src, seg_dst = jn.segments[0], jn.segments[-1]
+			if isinstance(seg_src, c.tb.t.public.JourneyFp): self.assertEqual(seg_src.stop_from.id, '<source>')
+			if isinstance(seg_dst, c.tb.t.public.JourneyFp): self.assertEqual(seg_dst.stop_to.id, '<destination>')
+			for stop_a, delta_a in stops_src:
+				for stop_b, delta_b in stops_dst:
+					for jn_chk in self.router.query_earliest_arrival(stop_a, stop_b, dts_src + delta_a):
+						self.assertLessEqual(jn.dts_arr, jn_chk.dts_arr + delta_b + 1e-6)
+
+	def test_query_latest_departure(self):
+		def pareto_ld(journeys, dts_edt, dts_arr_max):
+			# Latest departure and min trips, arrival time is not optimized in latest-departure query
+			jns = set( (jn.dts_dep, jn.trip_count) for jn in journeys
+				if jn.trip_count and jn.dts_dep >= dts_edt and jn.dts_arr <= dts_arr_max )
+			return set(a for a in jns if not any(
+				b != a and b[0] >= a[0] and b[1] <= a[1] for b in jns ))
+
+		rng, footpaths = random.Random(1), self.timetable.footpaths
+		stops = sorted( (stop for stop in self.timetable.stops
+			if self.router.graph.lines.lines_with_stop(stop)), key=op.attrgetter('id') )
+		for n in range(30):
+			stop_src, stop_dst = rng.sample(stops, 2)
+			if footpaths.connected(stop_src, stop_dst): continue
+			dts_arr_max = self.timetable.dts_parse('{:02d}:{:02d}'.format(rng.randint(7, 19), rng.randint(0, 59)))
+			dts_edt = dts_arr_max - 4*3600
+			journeys = self.router.query_latest_departure(stop_src, stop_dst, dts_arr_max)
+			for jn in journeys: self.assertLessEqual(jn.dts_arr, dts_arr_max)
+			journeys_chk = self.router.query_profile(stop_src, stop_dst, dts_edt, dts_arr_max)
+			self.assertEqual( pareto_ld(journeys, dts_edt, dts_arr_max),
+				pareto_ld(journeys_chk, dts_edt, dts_arr_max), [stop_src, stop_dst, dts_arr_max] )
+			for jn in journeys: # no journey departing later with same/less trips should exist
+				self.assertFalse(any( jn_chk.trip_count <= jn.trip_count
+					for jn_chk in self.router.query_earliest_arrival( stop_src,
+						stop_dst, jn.dts_dep + 1, dts_arr_max=dts_arr_max ) ))
+
+	def test_query_bounds(self):
+		stop_src, stop_dst = op.itemgetter('J22209723_0', 'J2220952426_0')(self.timetable.stops)
+		dts_src, dts_edt, dts_ldt = map(self.timetable.dts_parse, ['06:00', '06:00', '10:00'])
+		journeys = self.router.query_earliest_arrival(stop_src, stop_dst, dts_src)
+		dts_arr = min(jn.dts_arr for jn in journeys)
+		for bounds, n in [
+				(dict(dts_arr_max=dts_arr), len(journeys)),
+				(dict(max_duration=dts_arr - dts_src), len(journeys)),
+				(dict(dts_arr_max=dts_arr - 1), 0), (dict(max_duration=600), 0) ]:
+			self.assertEqual(len(self.router.query_earliest_arrival(
+				stop_src, stop_dst, dts_src, **bounds )), n, bounds)
+
+		journeys = self.router.query_profile(stop_src, stop_dst, dts_edt, dts_ldt)
+		journeys_chk = self.router.query_profile(
+			stop_src, stop_dst, dts_edt, dts_ldt, max_duration=5400 )
+		self.assertEqual(
+			set(jn.id for jn in journeys_chk),
+			set(jn.id for jn in journeys if jn.dts_arr - jn.dts_dep <= 5400) )
+
+	def test_lower_bounds(self):
+		router = c.router_from_graph( self.timetable,
+			self.router.graph, c.tb.engine.EngineConf(lower_bounds_clusters=50) )
+		self.assertTrue(router.graph.lower_bounds)
+		graph = c.router_from_graph(self.timetable, router.graph).graph
+		self.assertEqual(graph.lower_bounds.table, router.graph.lower_bounds.table)
+
+		stops_dst = [next(iter(self.timetable.stops))]
+		for clusters, lb_used, lb_same in (None, False, True), (50, True, True), (20, True, False):
+			router_chk = c.router_from_graph( self.timetable,
+				router.graph, c.tb.engine.EngineConf(lower_bounds_clusters=clusters) )
+			self.assertEqual(bool(router_chk.dst_lower_bounds(stops_dst)), lb_used, clusters)
+			self.assertEqual( router_chk.graph.lower_bounds.table
+				== router.graph.lower_bounds.table, lb_same, clusters )
+
+		stops = list(self.timetable.stops[k] for k in [
+			'J22209723_0', 'J2220952426_0', 'J22209843_0', 'J222093345_0' ])
+		dts_src, dts_edt, dts_ldt = map(self.timetable.dts_parse, ['06:00', '06:00', '09:00'])
+		for stop_src, stop_dst in it.permutations(stops, 2):
+			for query, args in [
+					('query_earliest_arrival', [dts_src]), ('query_profile', [dts_edt, dts_ldt]) ]:
+				journeys = getattr(self.router, query)(stop_src, stop_dst, *args)
+				journeys_chk = getattr(router, query)(stop_src, stop_dst, *args)
+				self.assertEqual(set(jn.id for jn in journeys), set(jn.id for jn in journeys_chk))
+
+	def test_query_budget(self):
+		stop_src, stop_dst = op.itemgetter('J22209723_0', 'J2220952426_0')(self.timetable.stops)
+		dts_src, dts_edt, dts_ldt = map(self.timetable.dts_parse, ['06:00', '06:00', '10:00'])
+		journeys = self.router.query_profile(stop_src, stop_dst, dts_edt, dts_ldt)
+		journeys_chk = self.router.query_profile( stop_src,
+			stop_dst, dts_edt, dts_ldt, budget=c.tb.engine.QueryBudget(timeout=60) )
+		self.assertFalse(journeys_chk.partial)
+		self.assertEqual(set(jn.id for jn in journeys), set(jn.id for jn in journeys_chk))
+
+		budget = c.tb.engine.QueryBudget(check_interval=1)
+		budget.cancel()
+		for query, args in [
+				('query_earliest_arrival', [dts_src]),
+				('query_latest_departure', [dts_ldt]),
+				('query_profile', [dts_edt, dts_ldt]) ]:
+			journeys = getattr(self.router, query)(stop_src, stop_dst, *args, budget=budget)
+			self.assertTrue(journeys.partial, query)
+			self.assertEqual(len(journeys), 0, query)
+
+		budget = c.tb.engine.QueryBudget(timeout=0)
+		self.assertTrue(budget.check())
+		journeys = self.router.query_earliest_arrival(stop_src, stop_dst, dts_src, budget=budget)
+		self.assertTrue(journeys.partial)
+
+	def test_query_stats(self):
+		stop_src, stop_dst = op.itemgetter('J22209843_0', 'J222093345_0')(self.timetable.stops)
+		dts_src, dts_edt, dts_ldt = map(self.timetable.dts_parse, ['06:00', '06:00', '10:00'])
+		stats, stats_total = c.tb.engine.QueryStats(), c.tb.engine.QueryStats()
+		for query, args in [
+				('query_earliest_arrival', [dts_src]), ('query_profile', [dts_edt, dts_ldt]) ]:
+			journeys = getattr(self.router, query)(stop_src, stop_dst, *args)
+			journeys_chk = getattr(self.router, query)(stop_src, stop_dst, *args, stats=stats)
+			getattr(self.router, query)(stop_src, stop_dst, *args, stats=stats_total)
+			self.assertEqual(set(jn.id for jn in journeys), set(jn.id for jn in journeys_chk))
+			self.assertEqual(stats.queries, 1)
+			self.assertEqual(stats.journeys, len(journeys))
+			self.assertGreaterEqual(stats.results, stats.journeys)
+			for k in 'seeds rounds segments segments_enqueued transfers_scanned'.split():
+				self.assertGreater(getattr(stats, k), 0, k)
+			self.assertLessEqual(stats.segments, stats.segments_enqueued)
+			self.assertGreater(stats.time_scan, 0)
+			stats = c.tb.engine.QueryStats()
+		self.assertEqual(stats_total.queries, 2)
+		self.assertEqual(list(stats_total.as_dict())[:2], ['queries', 'seeds'])
+
+	def test_precalc_progress(self):
+		router = c.router_from_graph( self.timetable, self.router.graph,
+			c.tb.engine.EngineConf(log_progress_for={'test'}, log_progress_steps=4) )
+		for prefix, steps in ('test', 4), ('test-disabled', 0):
+			progress, sampled = router.progress_iter(prefix, 100), list()
+			for n in range(100):
+				if n >= progress.n_next:
+					sampled.append(n)
+					progress.send(n, 'n={}', n)
+				progress.counts['items'] += 1
+			self.assertEqual(sampled, list(range(0, 100, 25))[:steps])
+			self.assertEqual(progress.finish(), router.precalc_stats[prefix])
+			self.assertEqual(router.precalc_stats[prefix]['items'], 100)
+
+	def test_trace(self):
+		import io, json
+		tracer = c.tb.trace.Tracer()
+		router = c.router_from_graph(self.timetable, self.router.graph, tracer=tracer)
+		stop_src, stop_dst = op.itemgetter('J22209843_0', 'J222093345_0')(self.timetable.stops)
+		dts_src, dts_edt, dts_ldt = map(self.timetable.dts_parse, ['06:00', '06:00', '10:00'])
+		for n in range(3):
+			router.query_earliest_arrival(stop_src, stop_dst, dts_src)
+			router.query_profile(stop_src, stop_dst, dts_edt, dts_ldt)
+
+		stats = tracer.stats()
+		for k in 'ea.seed ea.scan profile.seed profile.scan'.split(): self.assertEqual(stats[k]['count'], 3, k)
+		self.assertEqual(stats['dst_trips_index']['count'], 1) # cached after that
+		spans = dict((span.id, span) for span in tracer.spans)
+		for span in tracer.spans:
+			if not span.name.endswith(('.seed', '.scan')): continue
+			self.assertTrue(spans[span.parent].name.endswith(
+				'.query_earliest_arrival' if span.name.startswith('ea.') else '.query_profile' ))
+			self.assertLessEqual(span.td, spans[span.parent].td)
+		for k, v in stats.items():
+			self.assertLessEqual(v['min'], v['p50'])
+			self.assertLessEqual(v['p99'], v['max'])
+
+		for dump in tracer.dump_json, tracer.dump_chrome_trace:
+			dst = io.StringIO()
+			dump(dst)
+			self.assertTrue(json.loads(dst.getvalue()))
+
+	def test_phase_profiler(self):
+		import tempfile, pstats
+		stop_src, stop_dst = op.itemgetter('J22209843_0', 'J222093345_0')(self.timetable.stops)
+		with tempfile.TemporaryDirectory(prefix='tb-test.') as tmp_dir:
+			router = c.router_from_graph( self.timetable, self.router.graph,
+				c.tb.engine.EngineConf(profile_dir=tmp_dir, trace_malloc=5) )
+			for n in range(2):
+				router.query_earliest_arrival(stop_src, stop_dst, self.timetable.dts_parse('06:00'))
+			tmp_dir = Path(tmp_dir)
+			self.assertEqual(sorted(p.name for p in tmp_dir.iterdir()), [
+				'001.query_earliest_arrival.malloc.txt', '001.query_earliest_arrival.pstats',
+				'002.query_earliest_arrival.malloc.txt', '002.query_earliest_arrival.pstats' ])
+			stats = pstats.Stats(str(tmp_dir / '001.query_earliest_arrival.pstats'))
+			self.assertIn( '_query_earliest_arrival',
+				set(func_name for path, line, func_name in stats.stats) )
+			with (tmp_dir / '001.query_earliest_arrival.malloc.txt').open() as src:
+				self.assertTrue(src.readline().startswith('traced-memory:'))
+
+	def test_memory_stats(self):
+		timetable, lines, transfers = graph = self.router.graph
+		stats = c.tb.memory.memory_stats(timetable, graph)
+		self.assertEqual( list(s.name for s in stats),
+			['stops', 'trips', 'footpaths', 'lines', 'transfers', 'transfers-rev'] )
+		stats = dict((s.name, s) for s in stats)
+		self.assertEqual(stats['trips'].units, sum(map(len, timetable.trips)))
+		self.assertEqual(stats['transfers'].units, len(transfers))
+		for s in stats.values():
+			self.assertTrue(s.bytes > 0 and s.objects > 0, s)
+			self.assertAlmostEqual(s.bytes_per_unit, s.bytes / s.units)
+		# Same objects must not be counted in multiple structures
+		objects, size = c.tb.memory.deep_sizeof([ timetable.stops,
+			timetable.trips, timetable.footpaths, lines, transfers, self.router.graph.transfers_rev ])
+		self.assertEqual(objects, sum(s.objects for s in stats.values()))
+		self.assertEqual(size, sum(s.bytes for s in stats.values()))
+
 
 def load_tests(loader, tests, pattern):
 	# XXX: because unittest in pypy3/3.3 doesn't have subTest ctx yet
@@ -0,0 +1,316 @@
+import itertools as it, operator as op, functools as ft
+from pathlib import Path
+import io, sys, json, pickle, unittest, tempfile, shutil, threading
+
+from . import _common as c
+
+
+class SynthTests(unittest.TestCase):
+
+	def conf(self, **kws):
+		conf = c.tb.synth.SynthConf()
+		conf.stop_count, conf.line_count, conf.line_stops, conf.line_trip_max_count = 60, 6, (5, 10), 10
+		for k, v in kws.items(): setattr(conf, k, v)
+		return conf
+
+	def tt_dump(self, timetable):
+		return sorted(list((ts.stop.id, ts.dts_arr, ts.dts_dep) for ts in trip) for trip in timetable.trips)
+
+	def test_deterministic(self):
+		for layout in 'grid', 'radial', 'random':
+			conf = self.conf(layout=layout)
+			tt1, tt2, tt3 = (c.tb.synth.generate_timetable(conf, seed) for seed in [1, 1, 2])
+			self.assertTrue(tt1.trips)
+			self.assertEqual(self.tt_dump(tt1), self.tt_dump(tt2))
+			self.assertNotEqual(self.tt_dump(tt1), self.tt_dump(tt3))
+			self.assertEqual(len(tt1.footpaths), len(tt2.footpaths))
+
+	def test_query(self):
+		timetable = c.tb.synth.generate_timetable(self.conf(layout='radial'), 'test')
+		router = c.tb.engine.TBRoutingEngine(timetable)
+		for trip in it.islice(timetable.trips, 0, None, 20):
+			journeys = router.query_earliest_arrival(trip[0].stop, trip[-1].stop, trip[0].dts_dep)
+			self.assertTrue(journeys)
+			self.assertLessEqual(min(jn.dts_arr for jn in journeys), trip[-1].dts_arr)
+
+	def test_gtfs_roundtrip(self):
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		path = Path(tempfile.mkdtemp(prefix='tb-synth.'))
+		try:
+			c.tb.synth.write_gtfs(timetable, path)
+			tt = c.tb.gtfs.parse_timetable(path, c.tb.gtfs.GTFSConf())
+		finally: shutil.rmtree(str(path))
+		for k in 'stops', 'trips', 'footpaths':
+			self.assertEqual(len(getattr(tt, k)), len(getattr(timetable, k)))
+		self.assertEqual(self.tt_dump(tt), self.tt_dump(timetable))
+
+	def test_workload_replay(self):
+		wl = c.tb.workload
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		router = c.tb.engine.TBRoutingEngine(timetable)
+		queries = wl.generate_workload(timetable, 40, 'test')
+		self.assertEqual(queries, wl.generate_workload(timetable, 40, 'test'))
+		self.assertEqual(set(q.type for q in queries), set(wl.query_types))
+
+		with tempfile.NamedTemporaryFile(prefix='tb-workload.', suffix='.csv') as tmp:
+			wl.save_workload(queries, tmp.name)
+			self.assertEqual(wl.load_workload(tmp.name), queries)
+
+		query_func = wl.engine_query_func(router)
+		results, wall_time = wl.replay(query_func, queries)
+		self.assertEqual(list(map(op.attrgetter('type'), results)), list(q.type for q in queries))
+		results_mt, wall_time = wl.replay(query_func, queries, concurrency=4)
+		self.assertEqual( list(map(op.attrgetter('results'), results)),
+			list(map(op.attrgetter('results'), results_mt)) )
+
+		queries.append(queries[0]._replace(src='no-such-stop'))
+		report = wl.replay_report(*wl.replay(query_func, queries))
+		self.assertEqual(report['count'], 41)
+		self.assertEqual(report['errors'], 1)
+		self.assertEqual(sum(r['count'] for r in report['types'].values()), 41)
+		self.assertTrue(report['results'] > 0)
+		lat = report['latency']
+		self.assertTrue(0 < lat['p50'] <= lat['p95'] <= lat['p99'] <= lat['max'])
+
+	def test_packed_transfers(self):
+		wl = c.tb.workload
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		router = c.tb.engine.TBRoutingEngine(timetable)
+		conf = c.tb.engine.EngineConf()
+		conf.packed_transfers = True
+		with tempfile.TemporaryFile() as tmp:
+			router.graph.dump(tmp)
+			tmp.seek(0)
+			router_packed = c.tb.engine.TBRoutingEngine(timetable, conf, cached_graph=tmp)
+		transfers, transfers_packed = router.graph.transfers, router_packed.graph.transfers
+		self.assertIsInstance(transfers_packed, c.tb.t.base.PackedTransferSet)
+		self.assertEqual(len(transfers), len(transfers_packed))
+
+		dump = lambda ts: sorted(( t.ts_from.trip.id, t.ts_from.stopidx,
+			t.ts_to.trip.id, t.ts_to.stopidx, t.dt, t.id ) for t in ts)
+		self.assertEqual(dump(transfers), dump(transfers_packed))
+		for ts in it.chain.from_iterable(timetable.trips):
+			self.assertEqual(dump(transfers.from_trip_stop(ts)), dump(transfers_packed.from_trip_stop(ts)))
+		transfers, transfers_packed = router.graph.transfers_rev, router_packed.graph.transfers_rev
+		self.assertIsInstance(transfers_packed, c.tb.t.base.PackedTransferSet)
+		self.assertEqual(dump(transfers), dump(transfers_packed))
+		for ts in it.chain.from_iterable(timetable.trips):
+			self.assertEqual(dump(transfers.to_trip_stop(ts)), dump(transfers_packed.to_trip_stop(ts)))
+
+		queries = wl.generate_workload(timetable, 30, 'test')
+		self.assertEqual( list(map(wl.engine_query_func(router), queries)),
+			list(map(wl.engine_query_func(router_packed), queries)) )
+
+	def test_query_many(self):
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		conf = c.tb.engine.EngineConf()
+		conf.dst_index_cache_size = conf.src_index_cache_size = 2 # for concurrent evictions
+		router = c.tb.engine.TBRoutingEngine(timetable, conf)
+		for line in router.graph.lines: self.assertIsNotNone(line._trip_pos_cache)
+		pickle.dumps(timetable) # should not drop any caches built by freeze()
+		self.assertIsNotNone(timetable.stops._spatial_cache)
+		self.assertIsNotNone(timetable.footpaths._stats_cache)
+		queries = list( (trip[0].stop, trip[-1].stop, trip[0].dts_dep)
+			for trip in it.islice(timetable.trips, 0, None, 3) )
+		dump = lambda jns_list: list( sorted((jn.dts_dep, jn.dts_arr, jn.trip_count)
+			for jn in jns) for jns in jns_list )
+		for query_func, qs in [
+				(None, queries),
+				('query_profile', list(dict( stop_src=src, stop_dst=dst,
+					dts_edt=dts, dts_ldt=dts + 3600 ) for src, dst, dts in queries)) ]:
+			jns_list = router.query_many(qs, query_func, workers=4)
+			self.assertTrue(all(jns_list))
+			func = getattr(router, query_func or 'query_earliest_arrival')
+			self.assertEqual( dump(jns_list),
+				dump(func(**q) if isinstance(q, dict) else func(*q) for q in qs) )
+
+	def test_threads(self):
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		conf = c.tb.engine.EngineConf()
+		conf.dst_index_cache_size = conf.src_index_cache_size = 2 # for concurrent evictions
+		router = c.tb.engine.TBRoutingEngine(timetable, conf)
+		tp_router, cache = router.build_tp_engine(), c.tb.engine.QueryResultCache(router, size=4)
+		tp_tree_size, stop_missing = len(tp_router.tree.tree), c.tb.t.public.Stop('x', 'x', None, None)
+		dump = lambda jns: sorted((jn.dts_dep, jn.dts_arr, jn.trip_count) for jn in jns)
+		queries = list( (trip[0].stop, trip[-1].stop, trip[0].dts_dep)
+			for trip in it.islice(timetable.trips, 0, None, 3) )
+		results = list(dump(router.query_earliest_arrival(*q)) for q in queries)
+		results_tp = list( dump(tp_router.query_profile(src, dst, dts, dts + 3600))
+			for src, dst, dts in queries )
+
+		threads, rounds, errors = 8, 3, list()
+		barrier = threading.Barrier(threads)
+		def run(k):
+			try:
+				barrier.wait()
+				for n in range(rounds):
+					for (src, dst, dts), jns, jns_tp in it.islice(
+							it.cycle(zip(queries, results, results_tp)), k, k + len(queries) ):
+						self.assertEqual(dump(cache.query_earliest_arrival(src, dst, dts)), jns)
+						self.assertEqual(dump(tp_router.query_profile(src, dst, dts, dts + 3600)), jns_tp)
+						self.assertFalse(tp_router.tree[stop_missing].tree)
+			except Exception as err: errors.append(err)
+		switch_interval = sys.getswitchinterval()
+		sys.setswitchinterval(1e-5) # to interleave threads as much as possible with GIL
+		try:
+			threads = list(threading.Thread(target=run, args=[k]) for k in range(threads))
+			for thread in threads: thread.start()
+			for thread in threads: thread.join()
+		finally: sys.setswitchinterval(switch_interval)
+		self.assertEqual(errors, list())
+		self.assertEqual(len(tp_router.tree.tree), tp_tree_size)
+		self.assertEqual( cache.stats['hits'] + cache.stats['misses'],
+			len(threads) * rounds * len(queries) )
+
+	def test_result_cache(self):
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		router = c.tb.engine.TBRoutingEngine(timetable)
+		cache = c.tb.engine.QueryResultCache(router, size=100, bucket=3600)
+		dump = lambda jns: sorted((jn.dts_dep, jn.dts_arr, jn.trip_count, jn.id) for jn in jns)
+		queries = list( (trip[0].stop, trip[-1].stop, trip[0].dts_dep)
+			for trip in it.islice(timetable.trips, 0, None, 5) )
+		for src, dst, dts in queries:
+			for dts_edt in dts - 600, dts - 300, dts:
+				self.assertEqual( dump(cache.query_profile(src, dst, dts_edt, dts + 3600)),
+					dump(router.query_profile(src, dst, dts_edt, dts + 3600)) )
+			self.assertEqual( dump(cache.query_earliest_arrival(src, dst, dts)),
+				dump(router.query_earliest_arrival(src, dst, dts)) )
+		self.assertEqual(cache.stats['misses'], len(queries) * 2)
+		self.assertEqual(cache.stats['hits'], len(queries) * 2)
+
+		src, dst, dts = queries[0]
+		dts_day = list(map(timetable.dts_parse, ['00:00', '24:00']))
+		self.assertEqual( dump(cache.query_profile(src, dst)),
+			dump(cache.query_profile(src, dst, *dts_day)) )
+		self.assertEqual(cache.stats['misses'], len(queries) * 2 + 1)
+		self.assertEqual(cache.stats['hits'], len(queries) * 2 + 1)
+		cache.query_earliest_arrival(src, dst, dts)
+		self.assertEqual(cache.stats['hits'], len(queries) * 2 + 2)
+		router.graph.version += 1
+		cache.query_earliest_arrival(src, dst, dts)
+		self.assertEqual(cache.stats['invalidations'], 1)
+		self.assertEqual(len(cache.cache), 1)
+		budget = c.tb.engine.QueryBudget(0) # expired, returning partial results
+		self.assertTrue(cache.query_earliest_arrival(src, dst, dts + 1, budget=budget).partial)
+		self.assertEqual(len(cache.cache), 1)
+
+	def test_journey_serialization(self):
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		router = c.tb.engine.TBRoutingEngine(timetable)
+		JourneySet, dts_base = c.tb.t.public.JourneySet, timetable.timespan.dts_start
+		dump = lambda jns: sorted((jn.id, jn.dts_dep, jn.dts_arr, jn.trip_count, jn.fp_count) for jn in jns)
+		leg_types, stop_dst = set(), next(iter(timetable.stops))
+		for trip in it.islice(timetable.trips, 0, None, 3):
+			journeys = router.query_profile( trip[0].stop,
+				stop_dst, trip[0].dts_dep - 1800, trip[0].dts_dep + 3600 )
+			jns = journeys.compact(dts_base)
+			leg_types.update(leg[0] is None for jn in jns for leg in jn[3])
+			jns_json = JourneySet.from_compact(json.loads(json.dumps(jns)), dts_base)
+			with io.BytesIO() as tmp:
+				journeys.dump(tmp, dts_base)
+				tmp.seek(0)
+				jns_bin = JourneySet.load(tmp, dts_base)
+			self.assertEqual(dump(jns_json), dump(journeys))
+			self.assertEqual(dump(jns_bin), dump(journeys))
+			self.assertEqual(jns_bin.compact(dts_base), jns)
+			journeys_compact = router.query_profile( trip[0].stop, stop_dst,
+				trip[0].dts_dep - 1800, trip[0].dts_dep + 3600, compact=True )
+			self.assertEqual(dump(journeys_compact), dump(journeys))
+			self.assertEqual(journeys_compact.compact(dts_base), jns)
+		self.assertEqual(leg_types, {True, False})
+
+		jns_str = list( [dts_dep, dts_arr, transfers, list(
+			leg if leg[0] is None else ['t-{}'.format(leg[0])] + leg[1:] for leg in legs )]
+			for dts_dep, dts_arr, transfers, legs in jns )
+		self.assertTrue(any(leg[0] for jn in jns_str for leg in jn[3]))
+		with io.BytesIO() as tmp:
+			JourneySet.from_compact(jns_str, dts_base).dump(tmp, dts_base)
+			tmp.seek(0)
+			self.assertEqual(JourneySet.load(tmp, dts_base).compact(dts_base), jns_str)
+
+		src, dst, dts = trip[0].stop, trip[-1].stop, timetable.dts_format(trip[0].dts_dep)
+		params = dict(src=src.id, dst=dst.id, dts=dts, format='compact')
+		res = c.tb.server.run_query(router, params, c.tb.server.ServerConf())
+		self.assertEqual( res['journeys'], router.query_earliest_arrival(
+			src, dst, trip[0].dts_dep ).compact(dts_base) )
+		with self.assertRaisesRegex(c.tb.server.QueryError, 'format'):
+			c.tb.server.run_query(router, dict(params, format='xml'), c.tb.server.ServerConf())
+
+	def test_server(self):
+		wl = c.tb.workload
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		router = c.tb.engine.TBRoutingEngine(timetable)
+		queries = wl.generate_workload(timetable, 20, 'test')
+
+		path = Path(tempfile.mkdtemp(prefix='tb-server.'))
+		self.addCleanup(shutil.rmtree, str(path))
+		conf = c.tb.server.ServerConf()
+		conf.port, conf.unix_socket, conf.workers = None, str(path / 'sock'), 0
+		server, ready = c.tb.server.QueryServer(router, conf), threading.Event()
+		thread = threading.Thread(target=server.run, args=[lambda *a: ready.set()])
+		thread.start()
+		try:
+			self.assertTrue(ready.wait(30))
+			query_func = wl.server_query_func('unix:' + conf.unix_socket)
+			results, wall_time = wl.replay(query_func, queries, concurrency=3)
+			self.assertEqual(list(res.error for res in results), [None]*len(queries))
+			self.assertEqual( list(res.results for res in results),
+				list(map(wl.engine_query_func(router), queries)) )
+			with self.assertRaisesRegex(RuntimeError, r'^400 '):
+				query_func(queries[0]._replace(src='no-such-stop'))
+			self.assertEqual(server.status()['stats']['queries'], len(queries) + 1)
+		finally:
+			server.stop()
+			thread.join()
+		self.assertFalse((path / 'sock').exists())
+
+	def test_query_batch(self):
+		wl, batch = c.tb.workload, c.tb.batch
+		timetable = c.tb.synth.generate_timetable(self.conf(), 'test')
+		router = c.tb.engine.TBRoutingEngine(timetable)
+		queries = wl.generate_workload(timetable, 20, 'test')
+		queries.append(queries[0]._replace(src='no-such-stop'))
+
+		with tempfile.NamedTemporaryFile(prefix='tb-batch.', suffix='.csv') as tmp:
+			wl.save_workload(queries, tmp.name)
+			with open(tmp.name) as src: queries_csv = list(batch.read_queries(src))
+		queries_jsonl = list(batch.read_queries(io.StringIO(''.join(
+			json.dumps(dict(q._asdict(), id='q{}'.format(n))) + '\n' for n, q in enumerate(queries) ))))
+		self.assertEqual(len(queries_csv), len(queries))
+		self.assertEqual(list(q['id'] for q in queries_jsonl), list('q{}'.format(n) for n in range(len(queries))))
+
+		def run(queries, **conf_kws):
+			conf, dst = batch.BatchConf(), io.StringIO()
+			conf.chunk_size, conf.queue_chunks, conf.pack_graph = 2, 1, False
+			for k, v in conf_kws.items(): setattr(conf, k, v)
+			read, read_ahead, dst_write = [0], list(), dst.write
+			def queries_iter():
+				for query in queries:
+					read[0] += 1
+					yield query
+			def write(line):
+				read_ahead.append(read[0] - len(dst.getvalue().splitlines()))
+				return dst_write(line)
+			dst.write = write
+			stats = batch.run_batch(router, queries_iter(), dst, conf)
+			self.assertEqual((stats['queries'], stats['errors']), (len(queries), 1))
+			if conf.workers: # input read-ahead is limited by queue_chunks
+				self.assertLessEqual(max(read_ahead), conf.workers * conf.chunk_size + 1)
+			results = list(map(json.loads, dst.getvalue().splitlines()))
+			for res in results: res.pop('search_time', None)
+			return results
+
+		results = run(queries_csv, workers=0)
+		self.assertEqual(list(res['id'] for res in results), list(range(1, len(queries) + 1)))
+		self.assertIn('error', results[-1])
+		self.assertEqual( list(len(res['journeys']) for res in results[:-1]),
+			list(map(wl.engine_query_func(router), queries[:-1])) )
+		self.assertEqual(run(queries_csv, workers=2), results)
+		results_jsonl = run(queries_jsonl, workers=2, ordered=False)
+		self.assertEqual(
+			sorted(results_jsonl, key=op.itemgetter('id')),
+			sorted((dict(res, id='q{}'.format(res['id'] - 1)) for res in results), key=op.itemgetter('id')) )
+
+
+def load_tests(loader, tests, pattern):
+	return unittest.defaultTestLoader.loadTestsFromTestCase(SynthTests)
@@ -4,6 +4,7 @@ import itertools as it, operator as op, functools as ft
 import os, sys, pathlib, random, re, pickle
 
 import tb_routing as tb, test._common as c
+from tb_routing.synth import rand_int_align, line_dts_start_end
 
 
 class Conf:
@@ -25,24 +26,6 @@ class Conf:
 calc_dt_line = lambda km, kmh: (km / kmh) * 5 * 60
 calc_dt_fp = lambda km, kmh, dt_base: (km**2.5 / kmh) / 40 + dt_base * 60
 
-
-rand_int = random.randint
-rand_int_align = lambda a,b,step: random.randint(a//step, b//step)*step
-
-def line_dts_start_end():
-	if random.random() < 0.7:
-		line_dts_start, line_dts_end = rand_int(0, 10), rand_int(18, 24)
-	elif random.random() < 0.5:
-		line_dts_start = rand_int(5, 17)
-		line_dts_end = rand_int(line_dts_start, 23)
-		while line_dts_end - line_dts_start < 2:
-			line_dts_start = rand_int(5, line_dts_end)
-	else:
-		line_dts_start, line_dts_end = rand_int(12, 18), rand_int(20, 24)
-	line_dts_start = 3600 * line_dts_start + rand_int_align(0, 55, 5)*60
-	line_dts_end = 3600 * line_dts_end
-	return line_dts_start, line_dts_end
-
 def dist(stop_a, stop_b):
 	return (abs(stop_a.lon - stop_b.lon)**2 + abs(stop_a.lat - stop_b.lat)**2)**0.5
 
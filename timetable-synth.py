@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import itertools as it, operator as op, functools as ft
+import os, sys, pathlib, pickle
+
+import tb_routing as tb
+
+
+def main(args=None):
+	conf = tb.synth.SynthConf()
+
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Generate synthetic city-like transport network timetable'
+			' of any size (e.g. for benchmarking), with same output for same seed and parameters.'
+			' Timetable is either pickled or written as a GTFS directory, both of which'
+				' can be loaded by gtfs-tb-routing.py script.')
+	parser.add_argument('dst_path', help='Path to store pickled Timetable object or GTFS data to.')
+	parser.add_argument('--gtfs', action='store_true',
+		help='Write GTFS directory (CSV .txt files) to dst_path instead of a pickle.')
+	parser.add_argument('-s', '--seed', default='0',
+		help='Randomness seed (any string) for generated stuff. Default: %(default)s')
+
+	group = parser.add_argument_group('Network parameters')
+	group.add_argument('-l', '--layout',
+		choices=['grid', 'radial', 'random'], default=conf.layout,
+		help='Stop layout - grid, radial (rings and spokes)'
+			' or random (random geometric graph). Default: %(default)s')
+	group.add_argument('-n', '--stops', type=int, metavar='n', default=conf.stop_count,
+		help='Number of stops to generate. Default: %(default)s')
+	group.add_argument('-m', '--lines', type=int, metavar='n', default=conf.line_count,
+		help='Number of lines to generate, each with trips'
+			' running in both directions. Default: %(default)s')
+	group.add_argument('--line-stops', metavar='min:max',
+		default='{}:{}'.format(*conf.line_stops),
+		help='Min/max number of stops for each line. Default: %(default)s')
+	group.add_argument('--line-trips', type=int, metavar='n', default=conf.line_trip_max_count,
+		help='Max number of trips for each line direction. Default: %(default)s')
+	group.add_argument('--stop-spacing', type=float, metavar='km', default=conf.stop_spacing_km,
+		help='Distance between neighbor stops. Default: %(default)s')
+
+	opts = parser.parse_args(sys.argv[1:] if args is None else args)
+
+	conf.layout, conf.stop_count, conf.line_count = opts.layout, opts.stops, opts.lines
+	conf.line_stops = tuple(map(int, opts.line_stops.split(':', 1)))
+	conf.line_trip_max_count, conf.stop_spacing_km = opts.line_trips, opts.stop_spacing
+
+	timetable = tb.synth.generate_timetable(conf, opts.seed)
+	if opts.gtfs: tb.synth.write_gtfs(timetable, opts.dst_path)
+	else:
+		with pathlib.Path(opts.dst_path).open('wb') as dst: pickle.dump(timetable, dst)
+
+if __name__ == '__main__': sys.exit(main())